@@ -5,7 +5,7 @@ from .utils import quiver_autoscaler
 from ..tools.dimension_reduction import reduceDimension
 from ..tools.cell_velocities import cell_velocities
 from ..tools.Markov import velocity_on_grid
-from ..tools.scVectorField import VectorField
+from ..tools.scVectorField import VectorField, get_grid_velocity
 
 
 import scipy as sc
@@ -281,7 +281,7 @@ def _grid_velocity(adata, genes, x=0, y=1, method='SparseVFC', basis='trimap', n
     if method is 'SparseVFC' and adata.obsm['X_' + basis].shape[1] == 2:
         if 'VecFld_' + basis not in adata.uns.keys():
             VectorField(adata, basis=basis)
-        X_grid, V_grid =  adata.uns['VecFld_' + basis]['grid'], adata.uns['VecFld_' + basis]['grid_V']
+        X_grid, V_grid =  get_grid_velocity(adata.uns['VecFld_' + basis])
         N = int(np.sqrt(V_grid.shape[0]))
         X_grid, V_grid = np.array([np.unique(X_grid[:, 0]), np.unique(X_grid[:, 1])]), \
                          np.array([V_grid[:, 0].reshape((N, N)), V_grid[:, 1].reshape((N, N))])
@@ -471,7 +471,7 @@ def _streamline_plot(adata, genes, x=0, y=1, method='sparseVFC', basis='trimap',
     if method is 'SparseVFC' and adata.obsm['X_' + basis].shape[1] == 2:
         if 'VecFld_' + basis not in adata.uns.keys():
             VectorField(adata, basis=basis)
-        X_grid, V_grid =  adata.uns['VecFld_' + basis]['grid'], adata.uns['VecFld_' + basis]['grid_V']
+        X_grid, V_grid =  get_grid_velocity(adata.uns['VecFld_' + basis])
         N = int(np.sqrt(V_grid.shape[0]))
         X_grid, V_grid = np.array([np.unique(X_grid[:, 0]), np.unique(X_grid[:, 1])]), \
                  np.array([V_grid[:, 0].reshape((N, N)), V_grid[:, 1].reshape((N, N))])
@@ -670,7 +670,7 @@ def line_integral_conv(adata, basis='trimap', U_grid=None, V_grid=None, method =
 
     if 'VecFld_' + basis in adata.uns.keys():
         # first check whether the sparseVFC reconstructed vector field exists
-        X_grid_, V_grid = adata.uns['VecFld_' + basis]['grid'], adata.uns['VecFld_' + basis]['grid_V']
+        X_grid_, V_grid = get_grid_velocity(adata.uns['VecFld_' + basis])
         N = int(np.sqrt(V_grid.shape[0]))
         U_grid = np.reshape(V_grid[:, 0], (N, N)).T
         V_grid = np.reshape(V_grid[:, 1], (N, N)).T
@@ -876,7 +876,7 @@ def grid_velocity(
     if method == 'SparseVFC' and adata.obsm['X_' + basis].shape[1] == 2:
         if 'VecFld_' + basis not in adata.uns.keys():
             VectorField(adata, basis=basis)
-        X_grid, V_grid =  adata.uns['VecFld_' + basis]['grid'], adata.uns['VecFld_' + basis]['grid_V']
+        X_grid, V_grid =  get_grid_velocity(adata.uns['VecFld_' + basis])
         N = int(np.sqrt(V_grid.shape[0]))
         X_grid, V_grid = np.array([np.unique(X_grid[:, 0]), np.unique(X_grid[:, 1])]), \
                          np.array([V_grid[:, 0].reshape((N, N)), V_grid[:, 1].reshape((N, N))])
@@ -974,7 +974,7 @@ def streamline_plot(
     if method == 'SparseVFC' and adata.obsm['X_' + basis].shape[1] == 2:
         if 'VecFld_' + basis not in adata.uns.keys():
             VectorField(adata, basis=basis)
-        X_grid, V_grid =  adata.uns['VecFld_' + basis]['grid'], adata.uns['VecFld_' + basis]['grid_V']
+        X_grid, V_grid =  get_grid_velocity(adata.uns['VecFld_' + basis])
         N = int(np.sqrt(V_grid.shape[0]))
         X_grid, V_grid = np.array([np.unique(X_grid[:, 0]), np.unique(X_grid[:, 1])]), \
                          np.array([V_grid[:, 0].reshape((N, N)), V_grid[:, 1].reshape((N, N))])
@@ -1,6 +1,7 @@
 import numpy as np
 import scipy
 import matplotlib.pyplot as plt
+from ..tools.scVectorField import KernelVectorField, get_grid_velocity
 
 def plot_flow_field(vecfld, x_range, y_range, ax=None, start_points=None, n_grid=100, lw_min=0.5, lw_max=3, color='thistle', color_start_points='tomato'):
     """Plots the flow field with line thickness proportional to speed.
@@ -207,7 +208,7 @@ def topography(adata, basis, xlim, ylim, t=None, terms=['streamline', 'nullcline
     VecFld = adata.uns['VecFld'] if basis is 'X' else adata.uns['VecFld_' + basis]
 
     if VF is None:
-        VF = lambda x, t=None: vector_field_function(x=x, t=t, VecFld=VecFld)
+        VF = KernelVectorField(VecFld)
 
     # Set up the figure
     fig, ax = plt.subplots(1, 1)
@@ -222,7 +223,7 @@ def topography(adata, basis, xlim, ylim, t=None, terms=['streamline', 'nullcline
     ax.set_ylim(ylim)
 
     if t is None:
-        t = np.linspace(0, max(max(np.diff(xlim), np.diff(ylim)) / np.percentile(VecFld['grid_V'].__abs__(), 5)), 1e7)
+        t = np.linspace(0, max(max(np.diff(xlim), np.diff(ylim)) / np.percentile(get_grid_velocity(VecFld)[1].__abs__(), 5)), 1e7)
 
     if 'streamline' in terms:
         ax = plot_flow_field(ax, VF, xlim, ylim)
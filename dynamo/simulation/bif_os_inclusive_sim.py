@@ -1,9 +1,93 @@
 import numpy as np
-from .gillespie_utils import directMethod, temporal_interp
+from numba import njit
+from .gillespie_utils import directMethod, directMethod_batch, temporal_interp
+
+
+@njit
+def prop_diff_jit(C, params):
+    """The propensities of the differentiation model, used by `sim_diff.f_prop` and `directMethod_batch`; params
+    follows the order of the arguments of `sim_diff` (see `sim_diff.f_params`)."""
+    a1, b1, c1, a2, b2, c2 = params[0], params[1], params[2], params[3], params[4], params[5]
+    a1_l, b1_l, c1_l, a2_l, b2_l, c2_l = params[6], params[7], params[8], params[9], params[10], params[11]
+    K, n = params[12], params[13]
+    be1, ga1, et1, de1, be2, ga2, et2, de2 = params[14], params[15], params[16], params[17], params[18], params[19], \
+                                             params[20], params[21]
+    u1, s1, u2, s2, w1, l1, w2, l2, p1, p2 = C[0], C[1], C[2], C[3], C[4], C[5], C[6], C[7], C[8], C[9]
+
+    # propensities
+    prop = np.zeros(18)
+    # transcription
+    prop[0] = a1 * p1**n / (K**n + p1**n) + b1 * K**n / (K**n + p2**n) + c1             # 0 -> u1
+    prop[1] = a2 * p2**n / (K**n + p2**n) + b2 * K**n / (K**n + p1**n) + c2             # 0 -> u2
+    prop[2] = a1_l * p1**n / (K**n + p1**n) + b1_l * K**n / (K**n + p2**n) + c1_l       # 0 -> w1
+    prop[3] = a2_l * p2**n / (K**n + p2**n) + b2_l * K**n / (K**n + p1**n) + c2_l       # 0 -> w2
+    # splicing
+    prop[4] = be1 * u1      # u1 -> s1
+    prop[5] = be2 * u2      # u2 -> s2
+    prop[6] = be1 * w1      # w1 -> l1
+    prop[7] = be2 * w2      # w2 -> l2
+    # mRNA degradation
+    prop[8] = ga1 * s1      # s1 -> 0
+    prop[9] = ga2 * s2      # s2 -> 0
+    prop[10] = ga1 * l1     # l1 -> 0
+    prop[11] = ga2 * l2     # l2 -> 0
+    # translation
+    prop[12] = et1 * s1     # s1 --> p1
+    prop[13] = et2 * s2     # s2 --> p2
+    prop[14] = et1 * l1     # l1 --> p1
+    prop[15] = et2 * l2     # l2 --> p2
+    # protein degradation
+    prop[16] = de1 * p1     # p1 -> 0
+    prop[17] = de2 * p2     # p2 -> 0
+
+    return prop
+
+
+@njit
+def prop_osc_jit(C, params):
+    """The propensities of the oscillator model, used by `sim_osc.f_prop` and `directMethod_batch`; params follows the
+    order of the arguments of `sim_osc` (see `sim_osc.f_params`)."""
+    a1, b1, a2, b2 = params[0], params[1], params[2], params[3]
+    a1_l, b1_l, a2_l, b2_l = params[4], params[5], params[6], params[7]
+    K, n = params[8], params[9]
+    be1, ga1, et1, de1, be2, ga2, et2, de2 = params[10], params[11], params[12], params[13], params[14], params[15], \
+                                             params[16], params[17]
+    u1, s1, u2, s2, w1, l1, w2, l2, p1, p2 = C[0], C[1], C[2], C[3], C[4], C[5], C[6], C[7], C[8], C[9]
+
+    # propensities
+    prop = np.zeros(18)
+    # transcription
+    uw1 = u1 + w1; uw2 = u2 + w2
+    prop[0] = a1 * uw1**n / (K**n + uw1**n) + b1 * K**n / (K**n + uw2**n)           # 0 -> u1
+    prop[1] = a2 * uw2**n / (K**n + uw2**n) + b2 * uw1**n / (K**n + uw1**n)         # 0 -(u1 u2)-> u2
+    prop[2] = a1_l * uw1**n / (K**n + uw1**n) + b1_l * K**n / (K**n + uw2**n)       # 0 -> u1
+    prop[3] = a2_l * uw2**n / (K**n + uw2**n) + b2_l * uw1**n / (K**n + uw1**n)     # 0 -(u1 u2)-> u2
+    # splicing
+    prop[4] = be1 * u1      # u1 -> s1
+    prop[5] = be2 * u2      # u2 -> s2
+    prop[6] = be1 * w1      # w1 -> l1
+    prop[7] = be2 * w2      # w2 -> l2
+    # mRNA degradation
+    prop[8] = ga1 * s1      # s1 -> 0
+    prop[9] = ga2 * s2      # s2 -> 0
+    prop[10] = ga1 * l1     # l1 -> 0
+    prop[11] = ga2 * l2     # l2 -> 0
+    # translation
+    prop[12] = et1 * s1     # s1 --> p1
+    prop[13] = et2 * s2     # s2 --> p2
+    prop[14] = et1 * l1     # l1 --> p1
+    prop[15] = et2 * l2     # l2 --> p2
+    # protein degradation
+    prop[16] = de1 * p1     # p1 -> 0
+    prop[17] = de2 * p2     # p2 -> 0
+
+    return prop
 
 
 # Differentiation model
 class sim_diff:
+    f_prop_jit = staticmethod(prop_diff_jit)
+
     def __init__(self, a1, b1, c1, a2, b2, c2, a1_l, b1_l, c1_l, a2_l, b2_l, c2_l, K, n, be1, ga1, et1, de1, be2, ga2, et2, de2):
         self.parameters = {'a1': a1, 'b1': b1, 'c1': c1, 'a2': a2, 'b2': b2, 'c2': c2,
             'a1_l': a1_l, 'b1_l': b1_l, 'c1_l': c1_l, 'a2_l': a2_l, 'b2_l': b2_l, 'c2_l': c2_l,
@@ -11,59 +95,11 @@ class sim_diff:
             'be1': be1, 'ga1': ga1, 'et1': et1, 'de1': de1,
             'be2': be2, 'ga2': ga2, 'et2': et2, 'de2': de2 }
 
-    def f_prop(self, C):
-        # unlabeled mRNA
-        u1 = C[0]
-        s1 = C[1]
-        u2 = C[2]
-        s2 = C[3]
-
-        # labeled mRNA
-        w1 = C[4]
-        l1 = C[5]
-        w2 = C[6]
-        l2 = C[7]
-
-        # protein
-        p1 = C[8]
-        p2 = C[9]
-
-        # parameters
-        a1 = self.parameters['a1']; a2 = self.parameters['a2']
-        b1 = self.parameters['b1']; b2 = self.parameters['b2']
-        c1 = self.parameters['c1']; c2 = self.parameters['c2']
-        a1_l = self.parameters['a1_l']; a2_l = self.parameters['a2_l']
-        b1_l = self.parameters['b1_l']; b2_l = self.parameters['b2_l']
-        c1_l = self.parameters['c1_l']; c2_l = self.parameters['c2_l']
-        K = self.parameters['K']; n = self.parameters['n']
-
-        # propensities
-        prop = np.zeros(18)
-        # transcription
-        prop[0] = a1 * p1**n / (K**n + p1**n) + b1 * K**n / (K**n + p2**n) + c1             # 0 -> u1
-        prop[1] = a2 * p2**n / (K**n + p2**n) + b2 * K**n / (K**n + p1**n) + c2             # 0 -> u2
-        prop[2] = a1_l * p1**n / (K**n + p1**n) + b1_l * K**n / (K**n + p2**n) + c1_l       # 0 -> w1
-        prop[3] = a2_l * p2**n / (K**n + p2**n) + b2_l * K**n / (K**n + p1**n) + c2_l       # 0 -> w2
-        # splicing
-        prop[4] = self.parameters['be1'] * u1      # u1 -> s1
-        prop[5] = self.parameters['be2'] * u2      # u2 -> s2
-        prop[6] = self.parameters['be1'] * w1      # w1 -> l1
-        prop[7] = self.parameters['be2'] * w2      # w2 -> l2
-        # mRNA degradation
-        prop[8] = self.parameters['ga1'] * s1      # s1 -> 0
-        prop[9] = self.parameters['ga2'] * s2      # s2 -> 0
-        prop[10] = self.parameters['ga1'] * l1     # l1 -> 0
-        prop[11] = self.parameters['ga2'] * l2     # l2 -> 0
-        # translation
-        prop[12] = self.parameters['et1'] * s1      # s1 --> p1
-        prop[13] = self.parameters['et2'] * s2      # s2 --> p2
-        prop[14] = self.parameters['et1'] * l1      # l1 --> p1
-        prop[15] = self.parameters['et2'] * l2      # l2 --> p2
-        # protein degradation
-        prop[16] = self.parameters['de1'] * p1      # p1 -> 0
-        prop[17] = self.parameters['de2'] * p2      # p2 -> 0
+    def f_params(self):
+        return np.array(list(self.parameters.values()), dtype=np.float64)
 
-        return prop
+    def f_prop(self, C):
+        return prop_diff_jit(np.asarray(C, dtype=np.float64), self.f_params())
 
     def f_stoich(self):
         # species
@@ -112,6 +148,8 @@ class sim_diff:
 
 # Oscillator
 class sim_osc:
+    f_prop_jit = staticmethod(prop_osc_jit)
+
     def __init__(self, a1, b1, a2, b2, a1_l, b1_l, a2_l, b2_l, K, n, be1, ga1, et1, de1, be2, ga2, et2, de2):
         self.parameters = {'a1': a1, 'b1': b1, 'a2': a2, 'b2': b2,
                 'a1_l': a1_l, 'b1_l': b1_l, 'a2_l': a2_l, 'b2_l': b2_l,
@@ -119,52 +157,11 @@ class sim_osc:
                 'be1': be1, 'ga1': ga1, 'et1': et1, 'de1': de1,
                 'be2': be2, 'ga2': ga2, 'et2': et2, 'de2': de2 }
 
-    def f_prop(self, C):
-        # unlabeled mRNA
-        u1 = C[0]; s1 = C[1]; u2 = C[2]; s2 = C[3]
-
-        # labeled mRNA
-        w1 = C[4]; l1 = C[5]; w2 = C[6]; l2 = C[7]
-
-        # protein
-        p1 = C[8]; p2 = C[9]
+    def f_params(self):
+        return np.array(list(self.parameters.values()), dtype=np.float64)
 
-        # parameters
-        K = self.parameters['K']
-        n = self.parameters['n']
-
-        # propensities
-        prop = np.zeros(18)
-        # transcription
-        uw1 = u1 + w1; uw2 = u2 + w2
-        prop[0] = self.parameters['a1'] * uw1**n / (K**n + uw1**n) \
-            + self.parameters['b1'] * K**n / (K**n + uw2**n)           # 0 -> u1
-        prop[1] = self.parameters['a2'] * uw2**n / (K**n + uw2**n) \
-            + self.parameters['b2'] * uw1**n / (K**n + uw1**n)     # 0 -(u1 u2)-> u2
-        prop[2] = self.parameters['a1_l'] * uw1**n / (K**n + uw1**n) \
-            + self.parameters['b1_l'] * K**n / (K**n + uw2**n)           # 0 -> u1
-        prop[3] = self.parameters['a2_l'] * uw2**n / (K**n + uw2**n) \
-            + self.parameters['b2_l'] * uw1**n / (K**n + uw1**n)     # 0 -(u1 u2)-> u2
-        # splicing
-        prop[4] = self.parameters['be1'] * u1           # u1 -> s1
-        prop[5] = self.parameters['be2'] * u2           # u2 -> s2
-        prop[6] = self.parameters['be1'] * w1          # w1 -> l1
-        prop[7] = self.parameters['be2'] * w2          # w2 -> l2
-        # mRNA degradation
-        prop[8] = self.parameters['ga1'] * s1          # s1 -> 0
-        prop[9] = self.parameters['ga2'] * s2          # s2 -> 0
-        prop[10] = self.parameters['ga1'] * l1          # l1 -> 0
-        prop[11] = self.parameters['ga2'] * l2          # l2 -> 0
-        # translation
-        prop[12] = self.parameters['et1'] * s1          # s1 --> p1
-        prop[13] = self.parameters['et2'] * s2          # s2 --> p2
-        prop[14] = self.parameters['et1'] * l1          # l1 --> p1
-        prop[15] = self.parameters['et2'] * l2          # l2 --> p2
-        # protein degradation
-        prop[16] = self.parameters['de1'] * p1          # p1 -> 0
-        prop[17] = self.parameters['de2'] * p2          # p2 -> 0
-
-        return prop
+    def f_prop(self, C):
+        return prop_osc_jit(np.asarray(C, dtype=np.float64), self.f_params())
 
     def f_stoich(self):
         # species
@@ -203,8 +200,16 @@ class sim_osc:
 
         return stoich
 
-def simulate(model, C0, t_span, n_traj, report=False):
+def simulate(model, C0, t_span, n_traj, report=False, seed=None):
     stoich = model.f_stoich()
+
+    if hasattr(model, 'f_prop_jit'):
+        trajs_T, trajs_C = directMethod_batch(model.f_prop_jit, stoich, t_span, np.array(C0)[:n_traj],
+                                              params=model.f_params(), n_traj=n_traj, seed=seed)
+        if report:
+            print ('%d trajectories finished.'%(n_traj))
+        return trajs_T, trajs_C
+
     update_func = lambda C, mu: C + stoich[mu, :]
 
     trajs_T = [[]] * n_traj
@@ -1,4 +1,5 @@
 import numpy as np
+from numba import njit, prange
 
 def directMethod(prop_fcn, update_fcn, tspan, C0,
                  record_skip_steps=0, record_max_length=1e5):
@@ -28,6 +29,175 @@ def directMethod(prop_fcn, update_fcn, tspan, C0,
     
     return retT, retC
 
+@njit
+def _rand_uniform(rng_state):
+    """Draw a uniform number in [0, 1) from a xoroshiro128+ stream. The 2-element uint64 `rng_state` is updated in
+    place so that every trajectory owns an independent, reproducible random stream."""
+    s0, s1 = rng_state[0], rng_state[1]
+    res = s0 + s1
+    s1 ^= s0
+    rng_state[0] = ((s0 << np.uint64(24)) | (s0 >> np.uint64(40))) ^ s1 ^ (s1 << np.uint64(16))
+    rng_state[1] = (s1 << np.uint64(37)) | (s1 >> np.uint64(27))
+    return (res >> np.uint64(11)) * 1.1102230246251565e-16
+
+
+@njit
+def _ssa_step(prop_fcn, params, c, rng_state):
+    """Draw the waiting time and the index of the next reaction with the direct method. Returns a negative index when
+    all propensities vanish."""
+    a = prop_fcn(c, params)
+    a0 = a.sum()
+    if not a0 > 0:
+        return 0., -1
+
+    tau = -np.log(1. - _rand_uniform(rng_state)) / a0
+    r = _rand_uniform(rng_state) * a0
+    mu, acc = 0, a[0]
+    while acc <= r and mu < len(a) - 1:
+        mu += 1
+        acc += a[mu]
+
+    return tau, mu
+
+
+@njit(parallel=True)
+def _ssa_direct_batch(prop_fcn, stoich, params, C0, t0, t_end, rng_states, max_len, offsets, retT, retC, record):
+    """Run the direct method for all trajectories in parallel. With `record` the events of trajectory i are written
+    into `retT[offsets[i]:]` and `retC[:, offsets[i]:]`; the number of recorded time points is returned either way."""
+    n_traj = C0.shape[0]
+    counts = np.zeros(n_traj, np.int64)
+    for i in prange(n_traj):
+        c, t, count, rng_state = C0[i].copy(), t0, 0, rng_states[i]
+        if record:
+            retT[offsets[i]] = t
+            retC[:, offsets[i]] = c
+        while t <= t_end and count < max_len - 1:
+            tau, mu = _ssa_step(prop_fcn, params, c, rng_state)
+            if mu < 0:
+                break
+            t += tau
+            c += stoich[mu]
+            count += 1
+            if record:
+                retT[offsets[i] + count] = t
+                retC[:, offsets[i] + count] = c
+        counts[i] = count + 1
+
+    return counts
+
+
+@njit(parallel=True)
+def _ssa_direct_batch_on_grid(prop_fcn, stoich, params, C0, t0, t_eval, rng_states, retC):
+    """Run the direct method for all trajectories in parallel and write the (piecewise constant) state of trajectory i
+    at each time point of the sorted `t_eval` into `retC[i]`."""
+    n_traj, n_t = C0.shape[0], len(t_eval)
+    for i in prange(n_traj):
+        c, t, k, rng_state = C0[i].copy(), t0, 0, rng_states[i]
+        while k < n_t:
+            tau, mu = _ssa_step(prop_fcn, params, c, rng_state)
+            t_next = t + tau if mu >= 0 else np.inf
+            while k < n_t and t_eval[k] < t_next:
+                retC[i, :, k] = c
+                k += 1
+            if mu < 0:
+                break
+            t = t_next
+            c += stoich[mu]
+
+
+def init_rng_states(n_traj, seed=None):
+    """Create independent xoroshiro128+ states (one per trajectory) from a seed with numpy's SeedSequence.
+
+    Parameters
+    ----------
+        n_traj: `int`
+            The number of random streams.
+        seed: `int` or None (default: None)
+            The seed of the root SeedSequence. Fresh entropy from the OS is used when it is None.
+
+    Returns
+    -------
+        rng_states: `numpy.ndarray`
+            A n_traj x 2 uint64 array of generator states.
+    """
+    children = np.random.SeedSequence(seed).spawn(n_traj)
+    rng_states = np.array([child.generate_state(2, np.uint64) for child in children], dtype=np.uint64).reshape((-1, 2))
+    # the all-zero state is a fixed point of xoroshiro128+
+    rng_states[(rng_states == 0).all(1), 0] = 1
+
+    return rng_states
+
+
+def directMethod_batch(prop_fcn, stoich, tspan, C0, params=None, n_traj=None, t_eval=None, seed=None,
+                       record_max_length=1e5):
+    """Simulate many trajectories of a chemical reaction network with a compiled Gillespie direct method. Trajectories
+    run in parallel (numba threads), each drawing from its own seeded random stream, so results are reproducible for a
+    given seed regardless of the number of threads.
+
+    Parameters
+    ----------
+        prop_fcn: `numba.core.registry.CPUDispatcher`
+            A numba jitted propensity function with signature prop_fcn(C, params) -> 1d `numpy.ndarray` (one propensity
+            per reaction), e.g. `prop_slam_jit`.
+        stoich: `numpy.ndarray`
+            The n_reactions x n_species stoichiometry matrix.
+        tspan: `list`
+            The begin and end time of the simulation.
+        C0: `numpy.ndarray`
+            Initial state of the species, either a 1d array shared by all trajectories or a n_traj x n_species array.
+        params: `numpy.ndarray` or None (default: None)
+            The 1d array of parameters passed to `prop_fcn`.
+        n_traj: `int` or None (default: None)
+            The number of trajectories. Defaults to the number of rows of a 2d `C0`, or 1.
+        t_eval: `numpy.ndarray` or None (default: None)
+            The time points at which the states are sampled. When it is None all reaction events are recorded.
+        seed: `int` or None (default: None)
+            The seed used to create the random streams of the trajectories.
+        record_max_length: `int` (default: 1e5)
+            The maximal number of time points recorded per trajectory when t_eval is None.
+
+    Returns
+    -------
+        If `t_eval` is None, a tuple of two lists `trajs_T`, `trajs_C` in the same format as returned by
+        `simulate_Gillespie`, i.e. the event times and the n_species x n_events states of each trajectory (views into
+        two preallocated arrays). Otherwise, `t_eval` and a n_traj x n_species x len(t_eval) array of states.
+    """
+    stoich = np.asarray(stoich, dtype=np.float64)
+    C0 = np.asarray(C0, dtype=np.float64)
+    if C0.ndim != 2 or C0.shape[1] != stoich.shape[1]:
+        # a single initial state, possibly given as a column vector
+        C0 = C0.reshape((1, -1))
+    if n_traj is None:
+        n_traj = C0.shape[0]
+    if C0.shape[0] == 1:
+        C0 = np.repeat(C0, n_traj, axis=0)
+    elif C0.shape[0] != n_traj:
+        raise Exception('C0 should either be a single initial state or have one initial state per trajectory.')
+    if C0.shape[1] != stoich.shape[1]:
+        raise Exception('The number of species in C0 and the stoichiometry matrix are different.')
+    params = np.zeros(0) if params is None else np.asarray(params, dtype=np.float64)
+    rng_states = init_rng_states(n_traj, seed)
+
+    if t_eval is not None:
+        t_eval = np.asarray(t_eval, dtype=np.float64)
+        retC = np.zeros((n_traj, C0.shape[1], len(t_eval)))
+        _ssa_direct_batch_on_grid(prop_fcn, stoich, params, C0, float(tspan[0]), t_eval, rng_states, retC)
+        return t_eval, retC
+
+    # a first pass counts the events so that a single array of the exact size can be allocated; the second pass replays
+    # the same random streams and records the trajectories.
+    dummy_T, dummy_C, offsets = np.zeros(0), np.zeros((C0.shape[1], 0)), np.zeros(n_traj + 1, np.int64)
+    counts = _ssa_direct_batch(prop_fcn, stoich, params, C0, float(tspan[0]), float(tspan[-1]), rng_states.copy(),
+                               int(record_max_length), offsets, dummy_T, dummy_C, False)
+    offsets[1:] = np.cumsum(counts)
+    retT, retC = np.zeros(offsets[-1]), np.zeros((C0.shape[1], offsets[-1]))
+    _ssa_direct_batch(prop_fcn, stoich, params, C0, float(tspan[0]), float(tspan[-1]), rng_states,
+                      int(record_max_length), offsets, retT, retC, True)
+
+    trajs_T = [retT[offsets[i]:offsets[i + 1]] for i in range(n_traj)]
+    trajs_C = [retC[:, offsets[i]:offsets[i + 1]] for i in range(n_traj)]
+    return trajs_T, trajs_C
+
 def prop_slam(C, a, b, la, aa, ai, si, be, ga):
     # species
     s = C[0]
@@ -55,7 +225,32 @@ def prop_slam(C, a, b, la, aa, ai, si, be, ga):
 
     return prop
 
-def simulate_Gillespie(a, b, la, aa, ai, si, be, ga, C0, t_span, n_traj, report=False):
+@njit
+def prop_slam_jit(C, params):
+    """The numba version of `prop_slam` used by `directMethod_batch`; params is the array [a, b, la, aa, ai, si, be,
+    ga]."""
+    a, b, la, aa, ai, si, be, ga = params[0], params[1], params[2], params[3], params[4], params[5], params[6], params[7]
+
+    # propensities
+    prop = np.zeros(11)
+    if C[0] > 0:                 # promoter is active
+        prop[0] = a             # A -> I
+        prop[2] = la * aa       # A --> ul
+        prop[3] = (1-la) * aa   # A --> uu
+    else:                        # promoter is inactive
+        prop[1] = b             # I -> A
+        prop[4] = la * ai       # I --> ul
+        prop[5] = (1-la) * ai   # I --> uu
+
+    prop[6] = (1-si)*be*C[1]    # ul -> sl
+    prop[7] = si*be*C[1]        # ul -> su
+    prop[8] = be*C[2]           # uu -> su
+    prop[9] = ga*C[3]           # sl -> 0
+    prop[10] = ga*C[4]          # su -> 0
+
+    return prop
+
+def stoich_slam():
     # species
     s = 0
     u_l = 1
@@ -80,17 +275,18 @@ def simulate_Gillespie(a, b, la, aa, ai, si, be, ga, C0, t_span, n_traj, report=
     stoich[8, s_u] = 1
     stoich[9, s_l] = -1   # s_l --> 0
     stoich[10, s_u] = -1   # s_u --> 0
-    update_func = lambda C, mu: C + stoich[mu, :]
 
-    trajs_T = [[]] * n_traj
-    trajs_C = [[]] * n_traj
+    return stoich
+
+def simulate_Gillespie(a, b, la, aa, ai, si, be, ga, C0, t_span, n_traj, report=False, seed=None):
+    stoich = stoich_slam()
+    params = np.array([a, b, la, aa, ai, si, be, ga], dtype=np.float64)
 
-    for i in range(n_traj):
-        T, C = directMethod(lambda C: prop_slam(C, a, b, la, aa, ai, si, be, ga), update_func, t_span, C0[i])
-        trajs_T[i] = T
-        trajs_C[i] = C
-        if report:
-            print ('Iteration %d/%d finished.'%(i+1, n_traj), end='\r')
+    C0 = np.array(C0)
+    trajs_T, trajs_C = directMethod_batch(prop_slam_jit, stoich, t_span, C0[:n_traj] if C0.ndim > 1 else C0,
+                                          params=params, n_traj=n_traj, seed=seed)
+    if report:
+        print ('%d trajectories finished.'%(n_traj))
     return trajs_T, trajs_C
 
 def prop_2bifurgenes(C, a1, b1, a2, b2, K, n, be1, ga1, be2, ga2):
@@ -131,19 +327,33 @@ def stoich_2bifurgenes():
 
     return stoich
 
-def simulate_2bifurgenes(a1, b1, a2, b2, K, n, be1, ga1, be2, ga2, C0, t_span, n_traj, report=False):
-    stoich = stoich_2bifurgenes()
-    update_func = lambda C, mu: C + stoich[mu, :]
+@njit
+def prop_2bifurgenes_jit(C, params):
+    """The numba version of `prop_2bifurgenes` used by `directMethod_batch`; params is the array [a1, b1, a2, b2, K, n,
+    be1, ga1, be2, ga2]."""
+    a1, b1, a2, b2, K, n = params[0], params[1], params[2], params[3], params[4], params[5]
+    be1, ga1, be2, ga2 = params[6], params[7], params[8], params[9]
+    u1, s1, u2, s2 = C[0], C[1], C[2], C[3]
 
-    trajs_T = [[]] * n_traj
-    trajs_C = [[]] * n_traj
+    # propensities
+    prop = np.zeros(6)
+    prop[0] = a1 * s1**n / (K**n + s1**n) + b1 * K**n / (K**n + s2**n)      # 0 -> u1
+    prop[1] = be1 * u1      # u1 -> s1
+    prop[2] = ga1 * s1      # s1 -> 0
+    prop[3] = a2 * s2**n / (K**n + s2**n) + b2 * K**n / (K**n + s1**n)      # 0 -> u2
+    prop[4] = be2 * u2      # u2 -> s2
+    prop[5] = ga2 * s2      # s2 -> 0
+
+    return prop
+
+def simulate_2bifurgenes(a1, b1, a2, b2, K, n, be1, ga1, be2, ga2, C0, t_span, n_traj, report=False, seed=None):
+    stoich = stoich_2bifurgenes()
+    params = np.array([a1, b1, a2, b2, K, n, be1, ga1, be2, ga2], dtype=np.float64)
 
-    for i in range(n_traj):
-        T, C = directMethod(lambda C: prop_2bifurgenes(C, a1, b1, a2, b2, K, n, be1, ga1, be2, ga2), update_func, t_span, C0)
-        trajs_T[i] = T
-        trajs_C[i] = C
-        if report:
-            print ('Iteration %d/%d finished.'%(i+1, n_traj), end='\r')
+    trajs_T, trajs_C = directMethod_batch(prop_2bifurgenes_jit, stoich, t_span, C0, params=params, n_traj=n_traj,
+                                          seed=seed)
+    if report:
+        print ('%d trajectories finished.'%(n_traj))
     return trajs_T, trajs_C
 
 def temporal_average(t, trajs_T, trajs_C, species, f=lambda x: x):
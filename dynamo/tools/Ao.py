@@ -103,10 +103,12 @@ def Ao_pot_map(vecFunc, X, D=None):
     D = 0.1 * np.eye(ndim) if D is None else D
     U = np.zeros((nobs, 1))
     vecMat, S, A = [None] * nobs, [None] * nobs, [None] * nobs
+    # use the analytic Jacobian if the vector field provides one (e.g. KernelVectorField), computed for all cells at once
+    Js = vecFunc.jacobian(X) if hasattr(vecFunc, 'jacobian') else None
 
     for i in range(nobs):
         X_s = X[i, :]
-        F = nda.Jacobian(vecFunc)(X_s)
+        F = nda.Jacobian(vecFunc)(X_s) if Js is None else Js[i]
         Q, _ = solveQ(D, F)
         H = np.linalg.inv(D + Q).dot(F)
         U[i] = - 0.5 * X_s.dot(H).dot(X_s)
@@ -1,11 +1,14 @@
 # create by Yan Zhang, minor adjusted by Xiaojie Qiu
 
 import numpy as np
+import warnings
 import scipy.sparse as sp
 from sklearn.neighbors import NearestNeighbors
 from scipy.stats import norm
 from scipy.linalg import eig, null_space
-from numba import jit
+from scipy.optimize import linear_sum_assignment
+from numba import jit, njit, prange
+from .neighbor_index import get_neighbor_index, _fingerprint
 
 
 def markov_combination(x, v, X):
@@ -57,6 +60,105 @@ def compute_markov_trans_prob(x, v, X, s=None, cont_time=False):
     return p
 
 
+@njit
+def _project_capped_simplex(y, cont_time):
+    """Euclidean projection onto {p >= 0} (cont_time) or {p >= 0, sum(p) <= 1}."""
+    p = np.maximum(y, 0)
+    if cont_time or p.sum() <= 1:
+        return p
+    u = np.sort(y)[::-1]
+    css = np.cumsum(u) - 1
+    theta = 0.
+    for j in range(len(u)):
+        if u[j] - css[j] / (j + 1) > 0:
+            theta = css[j] / (j + 1)
+    return np.maximum(y - theta, 0)
+
+
+@njit(parallel=True)
+def _simplex_lsq_batch(A, b, P0, cont_time, tol, max_iter):
+    """Accelerated projected gradient (FISTA with adaptive restart) for min 0.5 * ||A_i^T p - b_i||^2 over the feasible
+    set of each cell, solved for all cells in parallel."""
+    n, k = A.shape[0], A.shape[1]
+    P = np.zeros((n, k))
+    for i in prange(n):
+        Ai = A[i]
+        H = Ai @ Ai.T
+        f = Ai @ b[i]
+        L = max(np.trace(H), 1e-12) # upper bound of the largest eigenvalue of H
+        x = _project_capped_simplex(P0[i], cont_time)
+        y = x.copy()
+        t = 1.
+        obj = 0.5 * x @ H @ x - f @ x
+        for _ in range(max_iter):
+            x_new = _project_capped_simplex(y - (H @ y - f) / L, cont_time)
+            obj_new = 0.5 * x_new @ H @ x_new - f @ x_new
+            if obj_new > obj:
+                # restart the momentum
+                y = x.copy()
+                t = 1.
+                continue
+            t_new = 0.5 * (1 + np.sqrt(1 + 4 * t * t))
+            y = x_new + (t - 1) / t_new * (x_new - x)
+            # stop when the projected gradient vanishes (H is rank deficient, so x itself may still move along a flat face)
+            g = H @ x_new - f
+            converged = np.max(np.abs(x_new - _project_capped_simplex(x_new - g / L, cont_time))) < tol
+            x, t, obj = x_new, t_new, obj_new
+            if converged:
+                break
+        P[i] = x
+    return P
+
+
+def compute_markov_trans_prob_batch(X, V, Idx, s=None, cont_time=False, P0=None, tol=1e-8, max_iter=10000):
+    """Compute the transition probabilities of `compute_markov_trans_prob` for all cells at once.
+
+    The per-cell quadratic programs, min 0.5 * ||A^T p - b||^2 subject to p >= 0 (and sum(p) <= 1 for discrete time),
+    are solved in parallel with an accelerated projected gradient method instead of calling cvxopt once per cell.
+
+    Parameters
+    ----------
+        X: `np.ndarray`
+            The (n_cells x d) coordinates of cells.
+        V: `np.ndarray`
+            The (n_cells x d) velocities of cells.
+        Idx: `np.ndarray`
+            The (n_cells x k) indices of the neighbors of each cell (without the cell itself).
+        s: `np.ndarray` or None (default: None)
+            The diffusion (standard deviation) of each dimension. If not None, the second moments are also matched.
+        cont_time: `bool` (default: False)
+            Whether to compute transition rates of a continuous time Markov chain (only p >= 0 is enforced).
+        P0: `np.ndarray` or None (default: None)
+            The (n_cells x k) initial guess of the solutions (warm start), e.g. from a previous fit.
+        tol: `float` (default: 1e-8)
+            The convergence tolerance on the projected gradient step.
+        max_iter: `int` (default: 10000)
+            The maximal number of iterations for each cell.
+
+    Returns
+    -------
+        P: `np.ndarray`
+            The (n_cells x k) transition probabilities (rates) from each cell to its neighbors.
+    """
+
+    R = X[Idx] - X[:, None, :]
+    # normalize R, v, and s
+    scale = np.abs(R.max(1) - R.min(1))
+    Rn = R / scale[:, None, :]
+    vn = V / scale
+    if s is not None:
+        sn = s / scale
+        A = np.concatenate((Rn, 0.5 * Rn * Rn), axis=2)
+        b = np.hstack((vn, 0.5 * sn * sn))
+    else:
+        A, b = Rn, vn
+
+    if P0 is None:
+        P0 = np.zeros(Idx.shape)
+    return _simplex_lsq_batch(np.ascontiguousarray(A, dtype=np.float64), np.ascontiguousarray(b, dtype=np.float64),
+                              np.ascontiguousarray(P0, dtype=np.float64), cont_time, tol, int(max_iter))
+
+
 @jit(nopython=True)
 def compute_kernel_trans_prob(x, v, X, inv_s, cont_time=False):
     n = X.shape[0]
@@ -145,6 +247,213 @@ def compute_density_kernel(x, X, inv_eps):
     return k
 
 
+def compute_density_kernel_batch(X, Idx, inv_eps, mask=None, chunk_size=None):
+    """Compute the Gaussian density kernels of `compute_density_kernel` of all cells to their neighbors at once.
+
+    Parameters
+    ----------
+        X: `np.ndarray`
+            The (n_cells x d) coordinates of cells.
+        Idx: `np.ndarray`
+            The (n_cells x k) padded indices of the neighbors of each cell.
+        inv_eps: `float`
+            The inverse of the kernel bandwidth epsilon.
+        mask: `np.ndarray` or None (default: None)
+            The (n_cells x k) boolean mask of valid neighbors. Kernels of invalid (padded) entries are set to 0.
+        chunk_size: `int` or None (default: None)
+            The number of cells processed at once. By default about 1e7 // (k * d) cells.
+
+    Returns
+    -------
+        Kd: `np.ndarray`
+            The (n_cells x k) density kernels.
+    """
+
+    n, k = Idx.shape
+    chunk_size = max(1, int(1e7 // (k * X.shape[1]))) if chunk_size is None else chunk_size
+    Kd = np.zeros((n, k))
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        d = X[Idx[start:end]] - X[start:end, None, :]
+        Kd[start:end] = np.exp(-0.25 * inv_eps * np.einsum('ikd,ikd->ik', d, d))
+    if mask is not None:
+        Kd[~mask] = 0
+    return Kd
+
+
+def compute_density_normalization(X, Idx, inv_eps, mask=None):
+    """Build the sparse density kernel matrix on the neighbor graph and the density of each cell.
+
+    Returns
+    -------
+        Kd: `scipy.sparse.csr_matrix`
+            The (n_cells x n_cells) density kernel matrix, Kd[i, Idx[i, j]] is the kernel between cell i and its j-th
+            neighbor.
+        D: `np.ndarray`
+            The density of each cell, i.e. the row sums of the CSR matrix Kd^T (the column sums of Kd).
+    """
+
+    n = Idx.shape[0]
+    if mask is None:
+        mask = np.ones(Idx.shape, dtype=bool)
+    Kd = compute_density_kernel_batch(X, Idx, inv_eps, mask=mask)
+    indptr = np.concatenate(([0], np.cumsum(mask.sum(1))))
+    Kd = sp.csr_matrix((Kd[mask], Idx[mask], indptr), shape=(n, n))
+    D = np.asarray(Kd.T.tocsr().sum(1)).flatten()
+    return Kd, D
+
+
+def pad_neighbor_indices(Idx):
+    """Convert (possibly ragged) neighbor indices into a padded index array and a validity mask.
+
+    Parameters
+    ----------
+        Idx: `np.ndarray` or `list`
+            Either a (n_cells x k) array of neighbor indices, a list of 1d index arrays with different lengths, as
+            returned by `append_iterative_neighbor_indices`, or a sparse matrix whose row i stores the neighbors of cell
+            i in its column indices (see `iterative_neighbor_indices_csr`).
+
+    Returns
+    -------
+        Idx_pad: `np.ndarray`
+            A (n_cells x k_max) integer array of neighbor indices. Padded entries point to the cell itself.
+        mask: `np.ndarray`
+            A (n_cells x k_max) boolean array that is True for valid neighbors.
+    """
+
+    if isinstance(Idx, np.ndarray) and Idx.ndim == 2:
+        return Idx.astype(np.int64, copy=False), np.ones(Idx.shape, dtype=bool)
+
+    if sp.issparse(Idx):
+        Idx = sp.csr_matrix(Idx)
+        n, lens, nbrs = Idx.shape[0], np.diff(Idx.indptr), Idx.indices
+    else:
+        n = len(Idx)
+        lens = np.array([len(i) for i in Idx], dtype=np.int64)
+        nbrs = np.concatenate(Idx) if n > 0 else []
+    mask = np.arange(lens.max() if n > 0 else 0)[None, :] < lens[:, None]
+    Idx_pad = np.repeat(np.arange(n, dtype=np.int64)[:, None], mask.shape[1], axis=1)
+    Idx_pad[mask] = nbrs
+    return Idx_pad, mask
+
+
+def sample_neighbor_indices(Idx, sample_fraction):
+    """Randomly keep a fraction of the neighbors of each cell (kNN downsampling, adapted from velocyto). The cell itself
+    is never kept.
+
+    Parameters
+    ----------
+        Idx: `np.ndarray`, `list` or sparse matrix
+            The neighbor indices, in any format accepted by `pad_neighbor_indices`. The rows of a (n_cells x k) array
+            are assumed to be sorted by distance, and farther neighbors are sampled with a higher probability (weights
+            increasing linearly from 0.5 to 1), as in velocyto. Ragged or sparse (e.g. recursive) neighbor indices are
+            not ordered by distance and are sampled uniformly.
+        sample_fraction: `float`
+            The fraction of neighbors to keep: int(sample_fraction * (k + 1)) for a cell with k neighbors.
+
+    Returns
+    -------
+        Idx_sampled: `np.ndarray` or sparse `csr_matrix`
+            A (n_cells x k') array of the kept neighbors, in their original order, if all cells keep the same number of
+            neighbors; otherwise a boolean sparse matrix whose row i stores the kept neighbors of cell i.
+    """
+
+    Idx_pad, mask = pad_neighbor_indices(Idx)
+    n, k = Idx_pad.shape
+    candidates = mask & (Idx_pad != np.arange(n)[:, None])
+    w = np.linspace(0.5, 1, k)[None, :] if isinstance(Idx, np.ndarray) and Idx.ndim == 2 else np.ones((1, k))
+
+    # weighted sampling without replacement of all rows at once (Efraimidis & Spirakis): keep the smallest -log(u) / w
+    keys = np.where(candidates, -np.log(1 - np.random.random((n, k))) / w, np.inf)
+    size = np.minimum((sample_fraction * (mask.sum(1) + 1)).astype(np.int64), candidates.sum(1))
+    keep = np.zeros((n, k), dtype=bool)
+    np.put_along_axis(keep, np.argsort(keys, axis=1), np.arange(k)[None, :] < size[:, None], axis=1)
+
+    if np.all(size == size[0]):
+        return Idx_pad[keep].reshape((n, -1))
+    indptr = np.concatenate(([0], np.cumsum(size)))
+    return sp.csr_matrix((np.ones(indptr[-1], dtype=bool), Idx_pad[keep], indptr), shape=(n, n))
+
+
+def _row_quantile(A, mask, q):
+    """Row-wise quantile (linear interpolation, as in `np.quantile`) over the valid entries of a padded array."""
+    lens = mask.sum(1)
+    A_sorted = np.sort(np.where(mask, A, np.inf), axis=1)
+    pos = q * (np.maximum(lens, 1) - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(lens, 1) - 1)
+    rows = np.arange(A.shape[0])
+    a, b, t = A_sorted[rows, lo], A_sorted[rows, hi], pos - lo
+    return np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+
+
+def compute_drift_kernel_batch(X, V, Idx, inv_s, mask=None, adaptive_local_kernel=False, chunk_size=None):
+    """Compute the Itô drift kernels of all cells to their neighbors in a vectorized way.
+
+    This gives the same results as calling `compute_drift_kernel` (or `compute_drift_local_kernel` when
+    `adaptive_local_kernel` is True) for each cell, but works on padded (n_cells x k) arrays and processes cells in
+    chunks so that the (chunk x k x d) temporary stays bounded.
+
+    Parameters
+    ----------
+        X: `np.ndarray`
+            The (n_cells x d) coordinates of cells.
+        V: `np.ndarray`
+            The (n_cells x d) velocity vectors of cells.
+        Idx: `np.ndarray`
+            The padded (n_cells x k) neighbor indices, see `pad_neighbor_indices`.
+        inv_s: `float` or `np.ndarray`
+            The inverse of the diffusion matrix (a scalar for isotropic diffusion).
+        mask: `np.ndarray` or None (default: `None`)
+            The (n_cells x k) boolean mask of valid neighbors. All neighbors are valid if None.
+        adaptive_local_kernel: `bool` (default: `False`)
+            Whether to use the adaptive local kernel that rescales the kernel by the local time step tau.
+        chunk_size: `int` or None (default: `None`)
+            The number of cells processed at once. If None, it is chosen so that each chunk has about 1e7 elements.
+
+    Returns
+    -------
+        K: `np.ndarray`
+            The (n_cells x k) kernel values. Padded entries are zero.
+    """
+
+    n, d = X.shape
+    k = Idx.shape[1]
+    if mask is None: mask = np.ones(Idx.shape, dtype=bool)
+    if chunk_size is None: chunk_size = max(1, int(1e7 // max(1, k * d)))
+    is_scalar = np.isscalar(inv_s)
+
+    K = np.zeros((n, k))
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        msk, v = mask[start:end], V[start:end]
+        D = X[Idx[start:end]] - X[start:end, None, :]
+
+        if adaptive_local_kernel:
+            dists = np.linalg.norm(D, axis=2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vds = np.where(dists > 0, np.einsum('ckd,cd->ck', D, v) / dists, 0)
+            i_dir = (vds >= _row_quantile(vds, msk, 0.7)[:, None]) & (vds > 0) & msk
+            has_dir = i_dir.any(1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                tau = np.where(i_dir, dists / vds, 0).sum(1) / i_dir.sum(1)
+            tau = np.where(has_dir, np.minimum(tau, 1e2), 1e2)
+            vv = np.einsum('cd,cd->c', v, v)
+            with np.errstate(divide='ignore'):
+                scale = 1 / (tau * vv)
+            R = D - (np.where(has_dir, tau, 0)[:, None] * v)[:, None, :]
+        else:
+            scale = np.ones(end - start)
+            R = D - v[:, None, :]
+
+        quad = np.einsum('ckd,ckd->ck', R, R) if is_scalar else np.einsum('ckd,de,cke->ck', R, inv_s, R)
+        if is_scalar: scale = scale * inv_s
+        with np.errstate(invalid='ignore'):
+            K[start:end] = np.where(msk, np.exp(-0.25 * scale[:, None] * quad), 0)
+
+    return K
+
+
 @jit(nopython=True)
 def makeTransitionMatrix(Qnn, I, tol=0.):
     n = Qnn.shape[0]
@@ -221,9 +530,7 @@ def velocity_on_grid(X_emb, V_emb, xy_grid_nums, density=None, smooth=None, n_ne
 
     # estimate grid velocities
     if n_neighbors is None: n_neighbors = int(n_obs / 50)
-    nn = NearestNeighbors(n_neighbors=n_neighbors, n_jobs=-1)
-    nn.fit(X_emb)
-    dists, neighs = nn.kneighbors(X_grid)
+    dists, neighs = get_neighbor_index(X_emb).query(X_grid, k=n_neighbors)
 
     scale = np.mean([(g[1] - g[0]) for g in grs]) * smooth
     weight = norm.pdf(x=dists, scale=scale)
@@ -267,8 +574,9 @@ def smoothen_drift_on_grid(X, V, n_grid, nbrs=None, k=None, smoothness=1):
 
     if nbrs is None:
         if k is None: k = 100
-        nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
-    dists, neighs = nbrs.kneighbors(gridpoints_coordinates)
+        dists, neighs = get_neighbor_index(X).query(gridpoints_coordinates, k=k)
+    else:
+        dists, neighs = nbrs.kneighbors(gridpoints_coordinates)
 
     from scipy.stats import norm as normal
     std = np.mean([(g[1] - g[0]) for g in grs])
@@ -279,6 +587,180 @@ def smoothen_drift_on_grid(X, V, n_grid, nbrs=None, k=None, smoothness=1):
     U = (V[neighs[:, :k]] * gaussian_w[:, :, None]).sum(1) / np.maximum(1, total_p_mass)[:, None]  # weighed average
     return U, gridpoints_coordinates
 
+def _row_normalize(M):
+    """Normalize the rows of a (sparse or dense) non-negative matrix to sum to one."""
+    s = np.asarray(M.sum(1)).flatten()
+    s[s == 0] = 1
+    if sp.issparse(M):
+        return sp.diags(1 / s) @ M
+    return M / s[:, None]
+
+
+def _stationary_by_power(M, p0=None, tol=1e-10, max_iter=10000):
+    """Power iteration of the lazy chain (I + M) / 2, which has the same stationary distribution as `M` but is aperiodic.
+    It converges at the rate of the second largest eigenvalue modulus of the lazy chain, so it can be slow for slowly
+    mixing chains; a warning is raised if it has not converged after `max_iter` iterations."""
+    n = M.shape[0]
+    MT = M.T.tocsr() if sp.issparse(M) else np.asarray(M).T
+    p = np.ones(n) / n if p0 is None else np.asarray(p0, dtype=float).flatten() / np.sum(p0)
+    for _ in range(int(max_iter)):
+        p_new = 0.5 * (p + MT @ p)
+        p_new /= p_new.sum()
+        delta = np.abs(p_new - p).sum()
+        if delta < tol:
+            return p_new
+        p = p_new
+    warnings.warn('The power iteration did not converge after {} iterations (L1 change {:.2e} > tol {:.2e}); the chain '
+                  'may be slowly mixing, consider the `eigs` or `solve` method.'.format(int(max_iter), delta, tol))
+    return p
+
+
+def _stationary_by_eigs(M, p0=None, tol=1e-10, max_iter=None):
+    """Leading left eigenvector of `M` with ARPACK (implicitly restarted Arnoldi); `p0` is used as the starting vector."""
+    from scipy.sparse.linalg import eigs
+    v0 = None if p0 is None else np.asarray(p0, dtype=float).flatten()
+    _, vecs = eigs(sp.csr_matrix(M).T, k=1, which='LR', v0=v0, tol=tol, maxiter=max_iter)
+    p = np.abs(np.real(vecs[:, 0]))
+    return p
+
+
+def _stationary_by_solve(M):
+    """Solve (I - M^T) p = 0 with the last equation replaced by the normalization sum(p) = 1 (irreducible chains)."""
+    from scipy.sparse.linalg import spsolve
+    n = M.shape[0]
+    A = (sp.identity(n, format='csr') - sp.csr_matrix(M).T).tocsr()
+    A = sp.vstack([A[:n - 1], sp.csr_matrix(np.ones((1, n)))])
+    b = np.zeros(n)
+    b[n - 1] = 1
+    p = spsolve(A.tocsc(), b)
+    return np.abs(p)
+
+
+def stationary_distribution_sparse(M, method='eigs', p0=None, tol=1e-10, max_iter=10000):
+    """Compute the stationary distribution of a (large, sparse) Markov chain without forming dense eigensystems.
+
+    Arguments
+    ---------
+        M: `scipy.sparse matrix` or `numpy.ndarray` (dimension n x n)
+            The row-stochastic transition matrix (source is on the row, target on the column).
+        method: `str` (default: `eigs`)
+            The solver, one of `eigs` (ARPACK), `power` (power iteration of the lazy chain, which may need many
+            iterations for slowly mixing chains and warns if it does not converge within `max_iter`) or `solve` (sparse
+            LU of the balance equations).
+        p0: `numpy.ndarray` or None (default: None)
+            An initial guess of the distribution (warm start), e.g. the result from a previous, similar transition matrix.
+            Used by the `power` and `eigs` methods.
+        tol: `float` (default: 1e-10)
+            The convergence tolerance (L1 change of successive iterates for `power`, relative accuracy for `eigs`).
+        max_iter: `int` (default: 10000)
+            The maximal number of iterations.
+
+    Returns
+    -------
+        p: `numpy.ndarray`
+            The stationary distribution, normalized to sum to one.
+    """
+
+    if method == 'power':
+        p = _stationary_by_power(M, p0, tol, max_iter)
+    elif method == 'eigs':
+        p = _stationary_by_eigs(M, p0, tol, max_iter)
+    elif method == 'solve':
+        p = _stationary_by_solve(M)
+    else:
+        raise Exception(f'The method {method} is not supported. Please use one of `eigs`, `power` or `solve`.')
+
+    p[p < 0] = 0
+    return p / np.sum(p)
+
+
+def propagate_distribution(M, p0=None, steps=1):
+    """Propagate a state distribution over `steps` steps of a Markov chain by repeated sparse matrix-vector products, so
+    that the matrix power of `M` is never formed.
+
+    Arguments
+    ---------
+        M: `scipy.sparse matrix` or `numpy.ndarray` (dimension n x n)
+            The row-stochastic transition matrix (source is on the row, target on the column).
+        p0: `numpy.ndarray` or None (default: None)
+            The initial distribution (n, ) or a set of initial distributions (m x n). If None, the uniform distribution
+            is used.
+        steps: `int` (default: 1)
+            The number of steps.
+
+    Returns
+    -------
+        p: `numpy.ndarray`
+            The distribution(s) after `steps` steps.
+    """
+
+    n = M.shape[0]
+    MT = M.T.tocsr() if sp.issparse(M) else np.asarray(M).T
+    p = np.ones(n) / n if p0 is None else np.asarray(p0, dtype=float)
+    p = p.T
+    for _ in range(int(steps)):
+        p = MT @ p
+    return np.asarray(p).T
+
+
+def mean_first_passage_time(M, targets, method='direct', x0=None, tol=1e-8, max_iter=None):
+    """Compute the mean first passage times of all states to a set of target states with sparse linear solves.
+
+    The hitting times m satisfy m_i = 0 for targets and m_i = 1 + sum_j M_ij m_j otherwise, i.e. (I - M_QQ) m_Q = 1 on
+    the non-target states Q.
+
+    Arguments
+    ---------
+        M: `scipy.sparse matrix` or `numpy.ndarray` (dimension n x n)
+            The row-stochastic transition matrix (source is on the row, target on the column).
+        targets: `list` or `numpy.ndarray`
+            The indices (or a boolean mask) of the target (absorbing) states.
+        method: `str` (default: `direct`)
+            The solver, either `direct` (sparse LU) or `bicgstab` / `gmres` (iterative Krylov solvers).
+        x0: `numpy.ndarray` or None (default: None)
+            The initial guess (n, ) for the iterative solvers (warm start).
+        tol: `float` (default: 1e-8)
+            The relative tolerance of the iterative solvers.
+        max_iter: `int` or None (default: None)
+            The maximal number of iterations of the iterative solvers.
+
+    Returns
+    -------
+        m: `numpy.ndarray`
+            The mean first passage time of each state to the target set (0 for the targets, inf for states that can not
+            reach the targets).
+    """
+    import scipy.sparse.linalg as spla
+
+    n = M.shape[0]
+    M = sp.csr_matrix(M)
+    is_target = np.zeros(n, dtype=bool)
+    is_target[targets] = True
+    Q = np.where(~is_target)[0]
+
+    A = (sp.identity(len(Q), format='csr') - M[Q][:, Q]).tocsc()
+    b = np.ones(len(Q))
+    if method == 'direct':
+        m_Q = spla.spsolve(A, b)
+    elif method in ['bicgstab', 'gmres']:
+        solver = getattr(spla, method)
+        x0_Q = None if x0 is None else np.asarray(x0, dtype=float)[Q]
+        try:
+            m_Q, info = solver(A, b, x0=x0_Q, rtol=tol, maxiter=max_iter)
+        except TypeError:
+            m_Q, info = solver(A, b, x0=x0_Q, tol=tol, maxiter=max_iter)
+        if info > 0:
+            warnings.warn(f'The {method} solver did not converge within {info} iterations.')
+    else:
+        raise Exception(f'The method {method} is not supported. Please use one of `direct`, `bicgstab` or `gmres`.')
+
+    m = np.zeros(n)
+    m_Q = np.asarray(m_Q).flatten()
+    m_Q[~np.isfinite(m_Q) | (m_Q < 0)] = np.inf
+    m[Q] = m_Q
+    return m
+
+
 def get_iterative_indices(indices, index, n_recurse_neighbors=2, max_neighs=None):
     # These codes are borrowed from scvelo. Need to be rewritten later.
     def iterate_indices(indices, index, n_recurse_neighbors):
@@ -289,13 +771,71 @@ def get_iterative_indices(indices, index, n_recurse_neighbors=2, max_neighs=None
         indices = np.random.choice(indices, max_neighs, replace=False)
     return indices
 
-def append_iterative_neighbor_indices(indices, n_recurse_neighbors=2, max_neighs=None):
-    indices_rec = []
-    for i in range(indices.shape[0]):
-        neig = get_iterative_indices(indices, i, n_recurse_neighbors, max_neighs)
-        indices_rec.append(neig)
-    return indices_rec
-    
+def iterative_neighbor_indices_csr(indices, n_recurse_neighbors=2, max_neighs=None, seed=0):
+    """Expand the nearest neighbors of all cells to their `n_recurse_neighbors`-th order neighbors with one boolean sparse
+    matrix power, A^n, where A is the kNN adjacency matrix.
+
+    Parameters
+    ----------
+        indices: `np.ndarray`
+            The (n_cells x k) array of nearest neighbor indices.
+        n_recurse_neighbors: `int` (default: 2)
+            The order of the recursive neighbors (1 returns the unique neighbors of each cell).
+        max_neighs: `int` or None (default: None)
+            The maximal number of neighbors to keep for each cell. Rows with more neighbors are randomly subsampled.
+        seed: `int` (default: 0)
+            The seed of the random number generator used for subsampling, so that the expansion is reproducible.
+
+    Returns
+    -------
+        indptr: `np.ndarray`
+            The (n_cells + 1) CSR row pointer array; the neighbors of cell i are indices[indptr[i]:indptr[i + 1]].
+        indices: `np.ndarray`
+            The sorted neighbor indices of all cells, concatenated.
+    """
+
+    n, k = indices.shape
+    A = sp.csr_matrix((np.ones(n * k, dtype=np.float32), indices.flatten(), np.arange(0, n * k + 1, k)), shape=(n, n))
+    A.sum_duplicates()
+    A.data[:] = 1
+    B = A
+    for _ in range(n_recurse_neighbors - 1):
+        B = B @ A
+        B.data[:] = 1 # keep the pattern only
+    B.sort_indices()
+    indptr, nbrs = B.indptr.astype(np.int64), B.indices.astype(np.int64)
+
+    if max_neighs is not None and np.diff(indptr).max(initial=0) > max_neighs:
+        # random ranks within each row; keep the `max_neighs` smallest ones and restore the sorted column order
+        rows = np.repeat(np.arange(n), np.diff(indptr))
+        order = np.lexsort((np.random.default_rng(seed).random(len(nbrs)), rows))
+        keep = np.sort(order[np.arange(len(nbrs)) - indptr[rows] < max_neighs])
+        nbrs = nbrs[keep]
+        indptr = np.concatenate(([0], np.cumsum(np.minimum(np.diff(indptr), max_neighs))))
+
+    return indptr, nbrs
+
+
+def append_iterative_neighbor_indices(indices, n_recurse_neighbors=2, max_neighs=None, seed=0):
+    indptr, nbrs = iterative_neighbor_indices_csr(indices, n_recurse_neighbors, max_neighs, seed)
+    return np.split(nbrs, indptr[1:-1])
+
+
+def _assemble_kNN_transition_matrix(Idx, p, diag=None):
+    """Assemble the sparse column-stochastic matrix (row: target, column: source) with P[Idx[i, j], i] = p[i, j] and,
+    if given, P[i, i] = diag[i] (which takes precedence over a self neighbor)."""
+    n = Idx.shape[0]
+    rows, cols, vals = Idx.flatten(), np.repeat(np.arange(n), Idx.shape[1]), p.flatten()
+    if diag is not None:
+        valid = rows != cols
+        rows = np.concatenate((rows[valid], np.arange(n)))
+        cols = np.concatenate((cols[valid], np.arange(n)))
+        vals = np.concatenate((vals[valid], diag))
+    P = sp.csc_matrix((vals, (rows, cols)), shape=(n, n))
+    P.eliminate_zeros()
+    return P
+
+
 class MarkovChain:
     def __init__(self, P=None):
         self.P = P
@@ -303,11 +843,30 @@ class MarkovChain:
         self.U = None  # left eigenvectors
         self.W = None  # right eigenvectors
 
-    def eigsys(self):
-        D, U, W = eig(self.P, left=True, right=True)
+    def eigsys(self, k=None):
+        """Compute the eigenvalues (D) and the left (U) and right (W) eigenvectors of P, sorted by decreasing eigenvalue.
+        The full eigensystem requires a dense P; for a sparse P only the `k` eigenpairs of largest real part are
+        computed (with ARPACK), and an error is raised if `k` is not given instead of densifying P. The left
+        eigenvectors are then computed separately from P^T and matched to the right ones by eigenvalue; an error is
+        raised if the two sets of eigenvalues differ, e.g. when a complex conjugate pair is split at the k-th one."""
+        if sp.issparse(self.P):
+            if k is None:
+                raise Exception('The full eigensystem of a sparse transition matrix requires a dense matrix. Pass k to '
+                                'compute the k leading eigenpairs, or convert P to a dense array.')
+            D, W = sp.linalg.eigs(self.P, k=k, which='LR')
+            D_left, U = sp.linalg.eigs(self.P.T, k=k, which='LR')
+            # as for scipy.linalg.eig, the left eigenvector of the eigenvalue d is an eigenvector of P^T for conj(d)
+            dist = np.abs(D[:, None] - np.conj(D_left)[None, :])
+            _, cols = linear_sum_assignment(dist)
+            if np.any(dist[np.arange(len(D)), cols] > 1e-6 * np.maximum(1, np.abs(D))):
+                raise Exception('The leading eigenvalues of P and P^T do not agree, try a different k.')
+            U = U[:, cols][:, D.argsort()[::-1]]
+        else:
+            D, U, W = eig(self.P, left=True, right=True)
+            U = U[:, D.argsort()[::-1]]
         idx = D.argsort()[::-1]
         self.D = D[idx]
-        self.U = U[:, idx]
+        self.U = U
         self.W = W[:, idx]
 
     def get_num_states(self):
@@ -324,72 +883,54 @@ class KernelMarkovChain(MarkovChain):
         super().__init__(P)
         self.Kd = None
         self.Idx = None
+        self._cache = {}
+
+    def __reset__(self):
+        super().__reset__()
+        self._cache = {}
 
     def fit(self, X, V, M_diff, neighbor_idx=None, n_recurse_neighbors=None, k=200, epsilon=None, adaptive_local_kernel=False, tol=1e-4,
             sparse_construct=True, sample_fraction=None):
+        self.__reset__()
         # compute connectivity
         if neighbor_idx is None:
-            nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
-            _, self.Idx = nbrs.kneighbors(X)
+            _, self.Idx = get_neighbor_index(X).query(k=k)
         else:
             if n_recurse_neighbors is not None:
-                self.Idx = append_iterative_neighbor_indices(neighbor_idx, n_recurse_neighbors)
+                indptr, nbrs = iterative_neighbor_indices_csr(neighbor_idx, n_recurse_neighbors)
+                self.Idx = sp.csr_matrix((np.ones(len(nbrs), dtype=bool), nbrs, indptr), shape=(X.shape[0], X.shape[0]))
             else:
                 self.Idx = neighbor_idx
         
         # apply kNN downsampling to accelerate calculation (adapted from velocyto)
         if sample_fraction is not None:
-            neighbor_idx = self.Idx
-            p = np.linspace(0.5, 1, neighbor_idx.shape[1])
-            p = p / p.sum()
-
-            sampling_ixs = np.stack((np.random.choice(np.arange(1,neighbor_idx.shape[1]-1),
-                                                      size=int(sample_fraction * (neighbor_idx.shape[1] + 1)),
-                                                      replace=False,
-                                                      p=p) for i in range(neighbor_idx.shape[0])), 0)
-            self.Idx = self.Idx[np.arange(neighbor_idx.shape[0])[:, None], sampling_ixs]
+            self.Idx = sample_neighbor_indices(self.Idx, sample_fraction)
         
         n = X.shape[0]
-        if sparse_construct:
-            self.P = sp.lil_matrix((n, n))
-        else:
-            self.P = np.zeros((n, n))
+        Idx, mask = pad_neighbor_indices(self.Idx)
 
         # compute density kernel
         if epsilon is not None:
-            if sparse_construct:
-                self.Kd = sp.lil_matrix((n, n))
-            else:
-                self.Kd = np.zeros((n, n))
-            inv_eps = 1 / epsilon
-            for i in range(n):
-                self.Kd[i, self.Idx[i]] = compute_density_kernel(X[i], X[self.Idx[i]], inv_eps)
-            self.Kd = sp.csc_matrix(self.Kd)
-            D = np.sum(self.Kd, 0)
+            self.Kd, D = compute_density_normalization(X, Idx, 1 / epsilon, mask=mask)
 
-        # compute transition prob.
+        # compute transition prob. for all cells at once on the padded neighbor arrays
         if np.isscalar(M_diff):
             inv_s = 1/M_diff
         else:
             inv_s = np.linalg.inv(M_diff)
-        for i in range(n):
-            y = X[i]
-            v = V[i]
-            Y = X[self.Idx[i]]
-            if adaptive_local_kernel:
-                k = compute_drift_local_kernel(y, v, Y, inv_s)
-            else:
-                k = compute_drift_kernel(y, v, Y, inv_s)
-            if epsilon is not None:
-                k = k / D[0, self.Idx[i]]
-            else:
-                k = np.matrix(k)
-            p = k / np.sum(k)
-            p[p <= tol] = 0  # tolerance check
-            p = p / np.sum(p)
-            self.P[self.Idx[i], i] = p.A[0]
-
-        self.P = sp.csc_matrix(self.P)
+        K = compute_drift_kernel_batch(X, V, Idx, inv_s, mask=mask, adaptive_local_kernel=adaptive_local_kernel)
+        if epsilon is not None:
+            K = np.where(mask, K / D[Idx], 0)
+        P = K / np.sum(K, 1)[:, None]
+        P[P <= tol] = 0  # tolerance check
+        P = P / np.sum(P, 1)[:, None]
+
+        # assemble the column-stochastic matrix directly from the COO triplets (row: target, column: source)
+        cols = np.repeat(np.arange(n), mask.sum(1))
+        self.P = sp.csc_matrix((P[mask], (Idx[mask], cols)), shape=(n, n))
+        self.P.eliminate_zeros()
+        if not sparse_construct:
+            self.P = self.P.A
 
     def propagate_P(self, num_prop):
         ret = sp.csc_matrix(self.P, copy=True)
@@ -397,34 +938,92 @@ class KernelMarkovChain(MarkovChain):
             ret = self.P * ret # sparse matrix (ret) is a `np.matrix`
         return ret
 
+    def _cached(self, key, keys, func):
+        """Return `func()` cached under (`key`, `keys`); entries are only reused when P and the input arrays have the
+        same content hash, so that arrays modified in place are not served stale results."""
+        def content_hash(a):
+            if sp.issparse(a) or (isinstance(a, np.ndarray) and a.dtype != object):
+                return _fingerprint(a)
+            # ragged neighbor indices (a list or an object array of index arrays)
+            lens = np.array([len(i) for i in a])
+            return _fingerprint(lens), _fingerprint(np.concatenate([np.asarray(i) for i in a]) if len(a) else lens)
+
+        fingerprint = tuple(content_hash(a) for a in (self.P,) + tuple(keys))
+        hit = self._cache.get(key)
+        if hit is not None and hit[0] == fingerprint:
+            return hit[1]
+        ret = func()
+        self._cache[key] = (fingerprint, ret)
+        return ret
+
+    def propagate_X(self, X, num_prop=1):
+        """Compute (P^t)^T X with t = `num_prop` repeated sparse matrix-dense block products, without forming P^t.
+
+        Rows of the result are the expected values of X after `num_prop` steps starting from each cell, together with
+        an appended last column holding the total transition probability (the column sums of P^t).
+        """
+        def func():
+            PT = self.P.T.tocsr() if sp.issparse(self.P) else np.asarray(self.P).T
+            Y = np.hstack((X, np.ones((X.shape[0], 1))))
+            for _ in range(int(num_prop)):
+                Y = PT @ Y
+            return np.asarray(Y)
+        return self._cached(('X', int(num_prop)), (X,), func)
+
+    def _gather_P(self, Idx):
+        """Gather P[Idx[i, j], i] for padded neighbor indices."""
+        cols = np.repeat(np.arange(Idx.shape[0])[:, None], Idx.shape[1], axis=1)
+        P = self.P.tocsr() if sp.issparse(self.P) else np.asarray(self.P)
+        return np.asarray(P[Idx.flatten(), cols.flatten()]).reshape(Idx.shape)
+
     def compute_drift(self, X, num_prop=1):
-        n = self.get_num_states()
-        V = np.zeros_like(X)
-        P = self.propagate_P(int(num_prop))
-        for i in range(n):
-            V[i] = (X - X[i]).T.dot(P[:, i].A.flatten())
+        Y = self.propagate_X(X, num_prop)
+        V = Y[:, :-1] - X * Y[:, -1:]
         return V
 
-    def compute_density_corrected_drift(self, X, neighbor_idx=None, k=None, num_prop=1, normalize_vector=False, correct_by_mean=True):
-        n = self.get_num_states()
-        V = np.zeros_like(X)
-        P = self.propagate_P(num_prop)
+    def compute_density_corrected_drift(self, X, neighbor_idx=None, k=None, num_prop=1, normalize_vector=False, correct_by_mean=True,
+                                        chunk_size=None):
+        """Compute the drift corrected by the expected displacement to the neighbors of each cell.
+
+        For `num_prop` > 1 the entries of P^t are never formed: the drift is computed from `num_prop` sparse products
+        with the data (see `propagate_X`). It therefore sums over all states reached in `num_prop` steps rather than
+        over `neighbor_idx` only, and the mean correction uses the total propagated probability of each cell.
+        """
         if neighbor_idx is None: neighbor_idx = self.Idx
-        for i in range(n):
-            Idx = neighbor_idx[i]
-            D = X[Idx] - X[i]
-            if normalize_vector:
-                D = D / np.linalg.norm(D, 1)
-            p = P[Idx, i].A.flatten()
+        Idx, mask = pad_neighbor_indices(neighbor_idx)
+        n, d = X.shape
+        chunk_size = max(1, int(1e7 // (Idx.shape[1] * d))) if chunk_size is None else chunk_size
+
+        num_prop = int(num_prop)
+        if num_prop == 1:
+            P = self._cached(('P_nbr',), (neighbor_idx,), lambda: self._gather_P(Idx))
+        else:
+            Y = self.propagate_X(X, num_prop)
+            drift, p_sum = Y[:, :-1] - X * Y[:, -1:], Y[:, -1]
+        V = np.zeros_like(X)
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            m = mask[start:end]
+            D = np.where(m[:, :, None], X[Idx[start:end]] - X[start:end, None, :], 0)
+            if num_prop == 1:
+                p = np.where(m, P[start:end], 0)
+                s = p.sum(1)
+            else:
+                s = p_sum[start:end]
             if k is None:
                 if not correct_by_mean:
-                    k_inv = 1/len(Idx)
+                    k_inv = 1 / m.sum(1)
                 else:
-                    k_inv = np.mean(p)
+                    k_inv = s / m.sum(1)
             else:
-                k_inv = 1/k
-            p -= k_inv
-            V[i] = D.T.dot(p)
+                k_inv = np.full(end - start, 1 / k)
+            if num_prop == 1:
+                p = np.where(m, p - k_inv[:, None], 0)
+                V[start:end] = np.einsum('ikd,ik->id', D, p)
+            else:
+                V[start:end] = drift[start:end] - k_inv[:, None] * D.sum(1)
+            if normalize_vector:
+                V[start:end] /= np.abs(D).sum(1).max(1)[:, None]
         return V
 
     def compute_stationary_distribution(self):
@@ -447,96 +1046,92 @@ class DiscreteTimeMarkovChain(MarkovChain):
     def __init__(self, P=None):
         super().__init__(P)
         self.Kd = None
+        self.P_qp = None # QP solutions on the kNN graph, used for warm starts
 
-    def fit(self, X, V, k, s=None, method='qp', eps=None, tol=1e-4): # pass index
+    def fit(self, X, V, k, s=None, method='qp', eps=None, tol=1e-4, qp_solver='batch', warm_start=False): # pass index
         # the parameter k will be replaced by a connectivity matrix in the future.
         self.__reset__()
         # knn clustering
-        nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
-        _, Idx = nbrs.kneighbors(X)
+        _, Idx = get_neighbor_index(X).query(k=k)
         # compute transition prob.
         n = X.shape[0]
-        self.P = np.zeros((n, n))
-        if method == 'kernel':
+        if method == 'qp':
+            if qp_solver == 'batch':
+                # solve the QPs of all cells at once, optionally warm started from the previous fit
+                P0 = self.P_qp if warm_start and self.P_qp is not None and self.P_qp.shape == Idx[:, 1:].shape else None
+                p = compute_markov_trans_prob_batch(X, V, Idx[:, 1:], s, P0=P0)
+            else:
+                p = np.vstack([compute_markov_trans_prob(X[i], V[i], X[Idx[i, 1:]], s) for i in range(n)])
+            self.P_qp = p.copy()
+            p[p <= tol] = 0  # tolerance check
+            self.P = _assemble_kNN_transition_matrix(Idx[:, 1:], p, 1 - np.sum(p, 1))
+        else:
             inv_s = np.linalg.inv(s)
+            K = compute_drift_kernel_batch(X, V, Idx, inv_s)
             # compute density kernel
             if eps is not None:
-                self.Kd = np.zeros((n, n))
-                inv_eps = 1 / eps
-                for i in range(n):
-                    self.Kd[i, Idx[i]] = compute_density_kernel(X[i], X[Idx[i]], inv_eps)
-                D = np.sum(self.Kd, 0)
-        for i in range(n):
-            y = X[i]
-            v = V[i]
-            if method == 'qp':
-                Y = X[Idx[i, 1:]]
-                p = compute_markov_trans_prob(y, v, Y, s)
-                p[p <= tol] = 0  # tolerance check
-                self.P[Idx[i, 1:], i] = p
-                self.P[i, i] = 1 - np.sum(p)
-            else:
-                Y = X[Idx[i]]
-                # p = compute_kernel_trans_prob(y, v, Y, inv_s)
-                k = compute_drift_kernel(y, v, Y, inv_s)
-                if eps is not None:
-                    k /= D[Idx[i]]
-                p = k / np.sum(k)
-                p[p <= tol] = 0  # tolerance check
-                p = p / np.sum(p)
-                self.P[Idx[i], i] = p
+                self.Kd, D = compute_density_normalization(X, Idx, 1 / eps)
+                K = K / D[Idx]
+            p = K / np.sum(K, 1)[:, None]
+            p[p <= tol] = 0  # tolerance check
+            p = p / np.sum(p, 1)[:, None]
+            self.P = _assemble_kNN_transition_matrix(Idx, p)
 
     def propagate_P(self, num_prop):
-        ret = np.array(self.P, copy=True)
+        ret = sp.csc_matrix(self.P, copy=True)
         for i in range(num_prop - 1):
             ret = self.P @ ret
         return ret
 
     def compute_drift(self, X, num_prop=1):
-        n = self.get_num_states()
-        V = np.zeros_like(X)
-        P = self.propagate_P(num_prop)
-        for i in range(n):
-            V[i] = (X - X[i]).T.dot(P[:, i])
+        Y = np.hstack((X, np.ones((X.shape[0], 1))))
+        PT = sp.csr_matrix(self.P.T)
+        for _ in range(int(num_prop)):
+            Y = PT @ Y
+        V = Y[:, :-1] - X * Y[:, -1:]
         return V
 
     def compute_density_corrected_drift(self, X, k=None, normalize_vector=False):
         n = self.get_num_states()
         if k is None:
             k = n
-        V = np.zeros_like(X)
-        for i in range(n):
-            d = X - X[i] ###############################no self.nbrs_idx[i] is here.... may be wrong?
-            if normalize_vector:
-                d /= np.linalg.norm(d)
-            V[i] = d.T.dot(self.P[:, i] - 1 / k)
+        # d_i = X - X[i] for all cells, so that d_i.T.dot(P[:, i] - 1 / k) only needs P^T X, the column sums of P, and
+        # the sum of X
+        V = sp.csr_matrix(self.P.T) @ X - X * np.asarray(self.P.sum(0)).T - (X.sum(0) - n * X) / k
+        if normalize_vector:
+            sq_norm = np.sum(X ** 2) - 2 * X.dot(X.sum(0)) + n * np.sum(X ** 2, 1)
+            V /= np.sqrt(np.maximum(sq_norm, 0))[:, None]
         return V
 
     def solve_distribution(self, p0, n, method='naive'):
+        """Compute the distribution after `n` steps from the initial distribution `p0`, either by `n` repeated
+        (sparse) matrix-vector products (`naive`) or from the full eigendecomposition of P (`eig`), which is only
+        available for a dense P."""
         if method == 'naive':
             p = p0
             for _ in range(n):
                 p = self.P.dot(p)
-        else:
+        elif method == 'eig':
+            if sp.issparse(self.P):
+                raise Exception("The method 'eig' requires a dense transition matrix, use method='naive' for a sparse P.")
             if self.D is None:
                 self.eigsys()
             p = np.real(self.W @ np.diag(self.D ** n) @ np.linalg.inv(self.W)).dot(p0)
+        else:
+            raise Exception(f'The method {method} is not supported.')
         return p
 
     def compute_stationary_distribution(self, method='eig'):
-        if method == 'solve':
-            p = np.real(null_space(self.P - np.eye(self.P.shape[0])[:, 0]).flatten())
-        else:
-            if self.W is None:
-                self.eigsys()
-            p = np.abs(np.real(self.W[:, 0]))
-        p = p / np.sum(p)
+        # P is column stochastic (source on the column)
+        p = stationary_distribution_sparse(sp.csr_matrix(self.P.T), method='solve' if method == 'solve' else 'eigs')
         return p
 
     def diffusion_map_embedding(self, n_dims=2, t=1):
-        if self.W is None:
-            self.eigsys()
-        Y = np.real(self.D[1:n_dims + 1] ** t) * np.real(self.U[:, 1:n_dims + 1])
+        # truncated eigensystem of P^T, whose eigenvectors are the left eigenvectors of P
+        D, U = sp.linalg.eigs(sp.csc_matrix(self.P.T), k=n_dims + 1, which='LR')
+        idx = D.argsort()[::-1]
+        D, U = D[idx], U[:, idx]
+        Y = np.real(D[1:n_dims + 1] ** t) * np.real(U[:, 1:n_dims + 1])
         return Y
 
 
@@ -545,55 +1140,52 @@ class ContinuousTimeMarkovChain(MarkovChain):
         super().__init__(P)
         self.Kd = None
         self.nbrs_idx = nbrs_idx
+        self.P_qp = None # QP solutions on the kNN graph, used for warm starts
 
-    def fit(self, X, V, k, s=None, tol=1e-4):
+    def fit(self, X, V, k, s=None, tol=1e-4, qp_solver='batch', warm_start=False):
         self.__reset__()
         # knn clustering
         if self.nbrs_idx is None:
-            nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
-            _, Idx = nbrs.kneighbors(X)
+            _, Idx = get_neighbor_index(X).query(k=k)
             self.nbrs_idx = Idx
         else:
             Idx = self.nbrs_idx
         # compute transition prob.
         n = X.shape[0]
-        self.P = np.zeros((n, n))
-        for i in range(n):
-            y = X[i]
-            v = V[i]
-            Y = X[Idx[i, 1:]]
-            p = compute_markov_trans_prob(y, v, Y, s, cont_time=True)
-            p[p <= tol] = 0  # tolerance check
-            self.P[Idx[i, 1:], i] = p
-            self.P[i, i] = - np.sum(p)
+        if qp_solver == 'batch':
+            # solve the QPs of all cells at once, optionally warm started from the previous fit
+            P0 = self.P_qp if warm_start and self.P_qp is not None and self.P_qp.shape == Idx[:, 1:].shape else None
+            p = compute_markov_trans_prob_batch(X, V, Idx[:, 1:], s, cont_time=True, P0=P0)
+        else:
+            p = np.vstack([compute_markov_trans_prob(X[i], V[i], X[Idx[i, 1:]], s, cont_time=True) for i in range(n)])
+        self.P_qp = p.copy()
+        p[p <= tol] = 0  # tolerance check
+        self.P = _assemble_kNN_transition_matrix(Idx[:, 1:], p, - np.sum(p, 1))
 
     def compute_drift(self, X):
-        n = self.get_num_states()
-        V = np.zeros_like(X)
-        for i in range(n):
-            V[i] = (X - X[i]).T.dot(self.P[:, i])
+        V = sp.csr_matrix(self.P.T) @ X - X * np.asarray(self.P.sum(0)).T
         return V
 
     def compute_density_corrected_drift(self, X, k=None, normalize_vector=False):
         n = self.get_num_states()
         if k is None:
             k = n
-        V = np.zeros_like(X)
-        for i in range(n):
-            d = X[self.nbrs_idx[i]] - X[i]
-            if normalize_vector:
-                d /= np.linalg.norm(d)
-            V[i] = d.T.dot(self.P[self.nbrs_idx[i], i] - 1 / k)
+        Idx = self.nbrs_idx
+        d = X[Idx] - X[:, None, :]
+        if normalize_vector:
+            d /= np.linalg.norm(d, axis=(1, 2))[:, None, None]
+        p = np.asarray(sp.csr_matrix(self.P)[Idx.flatten(), np.repeat(np.arange(n), Idx.shape[1])]).reshape(Idx.shape)
+        V = np.einsum('ikd,ik->id', d, p - 1 / k)
         return V
 
     def solve_distribution(self, p0, t):
-        if self.D is None:
-            self.eigsys()
-        p = np.real(self.W @ np.diag(np.exp(self.D * t)) @ np.linalg.inv(self.W)).dot(p0)
+        from scipy.sparse.linalg import expm_multiply
+        p = expm_multiply(sp.csc_matrix(self.P) * t, p0)
         return p
 
     def compute_stationary_distribution(self):
-        p = np.real(null_space(self.P)[:, 0].flatten())
-        p = p / np.sum(p)
+        # stationary distribution of the uniformized chain I + P / q, which has the same null space as P
+        q = np.max(np.abs(self.P.diagonal()))
+        M = sp.identity(self.P.shape[0], format='csc') + sp.csc_matrix(self.P) / q
+        p = stationary_distribution_sparse(sp.csr_matrix(M.T), method='eigs')
         return p
-
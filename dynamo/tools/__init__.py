@@ -6,7 +6,7 @@
 # from .dynamo_fitting import sol_u, sol_s, sol_p, sol_ode, sol_num, fit_gamma_labelling, fit_beta_lsq, fit_alpha_labelling, fit_alpha_synthesis, fit_gamma_splicing, fit_gamma
 from .moments import Estimation
 
-from .velocity import sol_u, sol_s, sol_p, fit_linreg, fit_first_order_deg_lsq, solve_first_order_deg, fit_gamma_lsq, fit_alpha_synthesis, fit_alpha_degradation, velocity, estimation
+from .velocity import sol_u, sol_s, sol_p, fit_linreg, solve_gamma_steady_state, fit_first_order_deg_lsq, solve_first_order_deg, fit_gamma_lsq, fit_alpha_synthesis, fit_alpha_degradation, velocity, estimation
 from .cell_velocities import cell_velocities, generalized_diffusion_map, stationary_distribution, diffusion, expected_return_time
 
 from .dynamics import dynamics
@@ -16,10 +16,10 @@ from .velocyto_scvelo import vlm_to_adata, converter, run_velocyto, run_scvelo,
 
 # vector field related
 from .velocity_metric import cell_wise_confidence 
-from .scVectorField import SparseVFC, con_K, get_P, VectorField, vector_field_function #, evaluate, con_K_div_cur_free, vector_field_function, vector_field_function_auto, auto_con_K
+from .scVectorField import SparseVFC, con_K, con_K_dot, get_P, VectorField, vector_field_function, KernelVectorField, LazyGridVelocity, get_grid_velocity #, evaluate, con_K_div_cur_free, vector_field_function, vector_field_function_auto, auto_con_K
 
 # Markov chain related:
-from .Markov import markov_combination, compute_markov_trans_prob, compute_kernel_trans_prob, compute_drift_kernel, compute_drift_local_kernel, compute_density_kernel, makeTransitionMatrix, compute_tau, smoothen_drift_on_grid, MarkovChain, KernelMarkovChain, DiscreteTimeMarkovChain, ContinuousTimeMarkovChain
+from .Markov import markov_combination, compute_markov_trans_prob, compute_markov_trans_prob_batch, compute_kernel_trans_prob, compute_drift_kernel, compute_drift_local_kernel, compute_drift_kernel_batch, compute_density_kernel, compute_density_kernel_batch, makeTransitionMatrix, compute_tau, smoothen_drift_on_grid, iterative_neighbor_indices_csr, stationary_distribution_sparse, propagate_distribution, mean_first_passage_time, MarkovChain, KernelMarkovChain, DiscreteTimeMarkovChain, ContinuousTimeMarkovChain
 
 # potential related
 from .scPotential import gen_fixed_points, gen_gradient, IntGrad, DiffusionMatrix, action, Potential #, vector_field_function
@@ -28,13 +28,14 @@ from .Wang import Wang_action, Wang_LAP, transition_rate, MFPT
 from .Ao import Ao_pot_map
 
 # cell fate related
-from .fate import Fate, fate
+from .fate import Fate, fate, integrate_vf
 
 # dimension reduction related
 from .dimension_reduction import reduceDimension
 
 # mnn related
-from .connectivity import mnn, smoother
+from .connectivity import mnn, smoother, smooth_layers, get_neighbor_graph
+from .neighbor_index import NeighborIndex, get_neighbor_index, clear_neighbor_index_cache
 
 # Pseudotime related
 from .DDRTree import DDRTree_py as DDRTree
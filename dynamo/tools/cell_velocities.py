@@ -2,11 +2,28 @@ import scipy as scp
 from scipy.sparse import csr_matrix, issparse
 from sklearn.decomposition import PCA
 from .Markov import *
+from .Markov import _row_normalize
 from .connectivity import extract_indices_dist_from_graph
 from .utils import set_velocity_genes, get_finite_inds, get_ekey_vkey_from_adata
+from .neighbor_index import _fingerprint
+
+
+def _input_hash(*args):
+    """Content hash of the arrays and parameters that determine the transition matrix."""
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    for a in args:
+        if issparse(a) or isinstance(a, np.ndarray):
+            a = _fingerprint(a)
+        elif isinstance(a, dict):
+            a = sorted(a.items())
+        h.update(repr(a).encode())
+    return h.hexdigest()
+
 
 def cell_velocities(adata, ekey=None, vkey=None, use_mnn=False, n_pca_components=25, min_r2=0.5, basis='umap', method='analytical', neg_cells_trick=False, calc_rnd_vel=False,
-                    xy_grid_nums=(50, 50), correct_density=True, sample_fraction=None, random_seed=19491001, **kmc_kwargs):
+                    xy_grid_nums=(50, 50), correct_density=True, sample_fraction=None, random_seed=19491001, use_cache=True,
+                    pca_chunk_size=None, **kmc_kwargs):
     """Compute transition probability and project high dimension velocity vector to existing low dimension embedding.
 
     It is powered by the Itô kernel that not only considers the correlation between the vector from any cell to its
@@ -55,6 +72,17 @@ def cell_velocities(adata, ekey=None, vkey=None, use_mnn=False, n_pca_components
         random_seed: `int` (default: 19491001)
             The random seed for numba to ensure consistency of the random velocity vectors. Default value 19491001 is a special
             day for those who care.
+        use_cache: `bool` (default: `True`)
+            Whether to reuse the kernel Markov chain (including the expanded neighbor indices and the transition matrix)
+            stored in `adata.uns['kmc']` by a previous call with the same expression, velocity, neighbors and kernel
+            parameters, so that only the drift and grid velocities are recomputed, e.g. for a different `basis`,
+            `xy_grid_nums` or `correct_density`. The inputs are identified by a content hash kept in the `input_hash`
+            attribute of the chain; no copy of the data is kept outside of `adata`.
+        pca_chunk_size: `int` or None (default: `None`)
+            If not None, the PCA used by the `analytical` method is fitted without densifying X as a whole (a randomized
+            PCA with implicit centering for sparse X; the accumulated gene covariance, or an incremental PCA for many
+            genes, on blocks of `pca_chunk_size` cells for dense X) and X, V are projected block by block, so that the
+            peak memory is bounded regardless of the cell number.
 
     Returns
     -------
@@ -85,28 +113,31 @@ def cell_velocities(adata, ekey=None, vkey=None, use_mnn=False, n_pca_components
     V_mat = adata[:, adata.var.use_for_velocity.values].layers[vkey] if vkey in adata.layers.keys() else None
 
     X_embedding = adata.obsm['X_'+basis][:, :2]
-    V_mat = V_mat.A if issparse(V_mat) else V_mat
-    X = X.A if issparse(X) else X
     finite_inds = get_finite_inds(V_mat)
     X, V_mat = X[:, finite_inds], V_mat[:, finite_inds]
+    if method != 'analytical' or n_pca_components is None or pca_chunk_size is None:
+        V_mat = V_mat.A if issparse(V_mat) else V_mat
+        X = X.A if issparse(X) else X
 
     # add both source and sink distribution
     if method == 'analytical':
-        kmc = KernelMarkovChain()
         kmc_args = {"n_recurse_neighbors": 2, "M_diff": 0.2, "epsilon": None, "adaptive_local_kernel": True, "tol": 1e-7}
         kmc_args.update(kmc_kwargs)
 
-        # number of kNN in neighbor_idx may be too small
-        if n_pca_components is not None:
-            pca = PCA()
-            pca.fit(X)
-            X_pca = pca.transform(X)
-            Y_pca = pca.transform(X + V_mat)
-            V_pca = Y_pca - X_pca
+        # the fitted kernel Markov chain only depends on these inputs (and not on the basis), so the chain of a previous
+        # call stored in adata is reused. Subsampled kNN graphs are random and thus not cached.
+        key = _input_hash(X, V_mat, indices, n_pca_components, pca_chunk_size, kmc_args) \
+            if use_cache and sample_fraction is None else None
+        kmc = adata.uns['kmc'] if 'kmc' in adata.uns.keys() else None
+        reuse = key is not None and isinstance(kmc, KernelMarkovChain) and getattr(kmc, 'input_hash', None) == key
 
-            X, V_mat = X_pca[:, :n_pca_components], V_pca[:, :n_pca_components]
-
-        kmc.fit(X, V_mat, neighbor_idx=indices, sample_fraction=sample_fraction, **kmc_args) #
+        # number of kNN in neighbor_idx may be too small
+        if n_pca_components is not None and (not reuse or calc_rnd_vel):
+            X, V_mat = _pca_project(X, V_mat, n_pca_components, pca_chunk_size)
+        if not reuse:
+            kmc = KernelMarkovChain()
+            kmc.fit(X, V_mat, neighbor_idx=indices, sample_fraction=sample_fraction, **kmc_args) #
+            kmc.input_hash = key
         T = kmc.P
         if correct_density:
             delta_X = kmc.compute_density_corrected_drift(X_embedding, kmc.Idx, normalize_vector=True) # indices, k = 500
@@ -119,14 +150,14 @@ def cell_velocities(adata, ekey=None, vkey=None, use_mnn=False, n_pca_components
         X_grid, V_grid, D = velocity_on_grid(X_embedding, delta_X, xy_grid_nums=xy_grid_nums)
 
         if calc_rnd_vel:
-            kmc = KernelMarkovChain()
+            kmc_rnd = KernelMarkovChain()
             permute_rows_nsign(V_mat)
-            kmc.fit(X, V_mat, **kmc_args)  # neighbor_idx=indices,
-            T_rnd = kmc.P
+            kmc_rnd.fit(X, V_mat, **kmc_args)  # neighbor_idx=indices,
+            T_rnd = kmc_rnd.P
             if correct_density:
-                delta_X_rnd = kmc.compute_density_corrected_drift(X_embedding, kmc.Idx, normalize_vector=True)  # indices, k = 500
+                delta_X_rnd = kmc_rnd.compute_density_corrected_drift(X_embedding, kmc_rnd.Idx, normalize_vector=True)  # indices, k = 500
             else:
-                delta_X_rnd = kmc.compute_drift(X_embedding)
+                delta_X_rnd = kmc_rnd.compute_drift(X_embedding)
             # P_rnd = kmc.compute_stationary_distribution()
             # adata.obs['stationary_distribution_rnd'] = P_rnd
             X_grid_rnd, V_grid_rnd, D_rnd = velocity_on_grid(X_embedding, delta_X_rnd, xy_grid_nums=xy_grid_nums)
@@ -151,6 +182,80 @@ def cell_velocities(adata, ekey=None, vkey=None, use_mnn=False, n_pca_components
     return adata
 
 
+def _pca_project(X, V, n_components, chunk_size=None, max_cov_genes=5000):
+    """Project X and the velocity V onto the first principal components of X.
+
+    Since the projection is affine, the velocity is projected linearly, V_pca = V W^T, which equals
+    pca.transform(X + V) - pca.transform(X) without forming X + V. If `chunk_size` is given, X and V are projected in
+    blocks of cells. A sparse X is fitted with a randomized PCA that centers X implicitly, so that it is never densified.
+    For a dense X, the exact gene covariance matrix is accumulated block by block when there are at most
+    `max_cov_genes` genes, otherwise an incremental PCA is fitted.
+    """
+    n_components = min(n_components, *X.shape)
+    if chunk_size is None:
+        # the full SVD is deterministic, unlike the randomized solver sklearn picks for large inputs
+        pca = PCA(n_components=n_components, svd_solver='full')
+        X_pca = pca.fit_transform(X)
+        V_pca = V.dot(pca.components_.T)
+        return X_pca, np.asarray(V_pca)
+
+    n, g = X.shape
+    chunk_size = max(int(chunk_size), n_components)
+    blocks = [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+    if len(blocks) > 1 and blocks[-1][1] - blocks[-1][0] < n_components:
+        # each partial fit of the incremental PCA needs at least n_components cells
+        blocks[-2:] = [(blocks[-2][0], n)]
+
+    if issparse(X):
+        mean, W = _randomized_pca_sparse(X, n_components)
+    elif g <= max_cov_genes:
+        mean, C = np.zeros(g), np.zeros((g, g))
+        for start, end in blocks:
+            X_block = np.asarray(X[start:end], dtype=float)
+            mean += X_block.sum(0)
+            C += X_block.T.dot(X_block)
+        mean /= n
+        C = C / n - np.outer(mean, mean)
+        _, vecs = scp.linalg.eigh(C, subset_by_index=[g - n_components, g - 1])
+        W = vecs[:, ::-1]
+    else:
+        from sklearn.decomposition import IncrementalPCA
+        pca = IncrementalPCA(n_components=n_components)
+        for start, end in blocks:
+            pca.partial_fit(X[start:end])
+        mean, W = pca.mean_, pca.components_.T
+
+    X_pca, V_pca = np.zeros((n, n_components)), np.zeros((n, n_components))
+    for start, end in blocks:
+        X_pca[start:end] = np.asarray(X[start:end].dot(W)) - mean.dot(W)
+        V_pca[start:end] = np.asarray(V[start:end].dot(W))
+    return X_pca, V_pca
+
+
+def _randomized_pca_sparse(X, n_components, n_oversamples=10, n_iter=7, random_state=0):
+    """Randomized PCA (Halko et al., 2011) of a sparse matrix. X is centered implicitly, (X - mean) W = X W - mean W,
+    so that only sparse-dense products with (n_components + n_oversamples) columns are computed.
+
+    Returns
+    -------
+    A tuple of the gene means and the (n_genes x n_components) principal axes.
+    """
+    mean = np.asarray(X.mean(0)).flatten()
+    Xc_dot = lambda W: np.asarray(X.dot(W)) - mean.dot(W)[None, :]
+    Xc_T_dot = lambda Z: np.asarray(X.T.dot(Z)) - np.outer(mean, Z.sum(0))
+
+    # find an orthonormal basis of the range of the centered X with a few normalized power iterations
+    Q = Xc_dot(np.random.RandomState(random_state).normal(size=(X.shape[1], n_components + n_oversamples)))
+    for _ in range(n_iter):
+        Q = scp.linalg.qr(Q, mode='economic')[0]
+        Q = Xc_dot(scp.linalg.qr(Xc_T_dot(Q), mode='economic')[0])
+    Q = scp.linalg.qr(Q, mode='economic')[0]
+
+    # the right singular vectors of the small projected matrix Q^T (X - mean) are the principal axes
+    _, _, Wt = scp.linalg.svd(Xc_T_dot(Q).T, full_matrices=False)
+    return mean, Wt[:n_components].T
+
+
 def stationary_distribution(adata, method='kmc', direction='both', calc_rnd=True):
     """Compute stationary distribution of cells using the transition matrix.
 
@@ -250,19 +355,29 @@ def generalized_diffusion_map(adata, **kwargs):
     adata.obsm['X_diffusion_map'] = dm
 
 
-def diffusion(M, P0=None, steps=None, backward=False):
+def diffusion(M, P0=None, steps=None, backward=False, method=None, tol=1e-10, max_iter=10000):
     """Find the state distribution of a Markov process.
 
     Parameters
     ----------
-        M: `numpy.ndarray` (dimension n x n, where n is the cell number)
+        M: `numpy.ndarray` or `scipy.sparse matrix` (dimension n x n, where n is the cell number)
             The transition matrix.
         P0: `numpy.ndarray` (default None; dimension is n, )
-            The initial cell state.
+            The initial cell state. When `steps` is None, it is used as the warm start of the iterative stationary
+            distribution solvers.
         steps: `int` (default None)
             The random walk steps on the Markov transitioin matrix.
         backward: `bool` (default False)
             Whether the backward transition will be considered.
+        method: `str` or None (default None)
+            The method to compute the steady state distribution, one of `eig` (dense eigendecomposition), `eigs`
+            (ARPACK), `power` (power iteration, only used on request since it can be slow for slowly mixing chains; a
+            warning is raised if it does not converge within `max_iter` iterations) or `solve` (sparse linear solve). If
+            None, `eig` is used for dense matrices with less than 5000 states and `eigs` otherwise.
+        tol: `float` (default 1e-10)
+            The convergence tolerance of the iterative solvers.
+        max_iter: `int` (default 10000)
+            The maximal number of iterations of the iterative solvers.
 
     Returns
     -------
@@ -272,37 +387,46 @@ def diffusion(M, P0=None, steps=None, backward=False):
 
     if backward is True:
         M = M.T
-        M = M / M.sum(1)
+        M = _row_normalize(M)
 
     if steps is None:
-        # code inspired from  https://github.com/prob140/prob140/blob/master/prob140/markov_chains.py#L284
-        from scipy.sparse.linalg import eigs
-        eigenvalue, eigenvector = scp.linalg.eig(M, left=True, right=False) # if not issparse(M) else eigs(M) # source is on the row
-
-        eigenvector = np.real(eigenvector) if not issparse(M) else np.real(eigenvector.T)
-        eigenvalue_1_ind = np.isclose(eigenvalue, 1)
-        mu = eigenvector[:, eigenvalue_1_ind] / np.sum(eigenvector[:, eigenvalue_1_ind])
-
-        # Zero out floating poing errors that are negative.
-        indices = np.logical_and(np.isclose(mu, 0),
-                                 mu < 0)
-        mu[indices] = 0 # steady state distribution
+        if method is None:
+            method = 'eig' if not issparse(M) and M.shape[0] < 5000 else 'eigs'
+
+        if method == 'eig':
+            # code inspired from  https://github.com/prob140/prob140/blob/master/prob140/markov_chains.py#L284
+            M = M.A if issparse(M) else np.asarray(M)
+            eigenvalue, eigenvector = scp.linalg.eig(M, left=True, right=False) # source is on the row
+
+            eigenvector = np.real(eigenvector)
+            eigenvalue_1_ind = np.isclose(eigenvalue, 1)
+            mu = eigenvector[:, eigenvalue_1_ind] / np.sum(eigenvector[:, eigenvalue_1_ind])
+
+            # Zero out floating poing errors that are negative.
+            indices = np.logical_and(np.isclose(mu, 0),
+                                     mu < 0)
+            mu[indices] = 0 # steady state distribution
+        else:
+            mu = stationary_distribution_sparse(M, method=method, p0=P0, tol=tol, max_iter=max_iter)
 
     else:
-        mu = np.nanmean(M.dot(np.linalg.matrix_power(M, steps)), 0) if P0 is None else P0.dot(np.linalg.matrix_power(M, steps))
+        # repeated (sparse) matrix-vector products instead of the dense matrix power
+        mu = propagate_distribution(M, P0, steps) if P0 is not None else propagate_distribution(M, None, steps + 1)
 
     return mu
 
 
-def expected_return_time(M, backward=False):
+def expected_return_time(M, backward=False, **kwargs):
     """Find the expected returning time.
 
     Parameters
     ----------
-        M: `numpy.ndarray` (dimension n x n, where n is the cell number)
+        M: `numpy.ndarray` or `scipy.sparse matrix` (dimension n x n, where n is the cell number)
             The transition matrix.
         backward: `bool` (default False)
             Whether the backward transition will be considered.
+        kwargs:
+            Additional parameters (`method`, `P0`, `tol`, `max_iter`) that will be passed to the diffusion function.
 
     Returns
     -------
@@ -310,75 +434,73 @@ def expected_return_time(M, backward=False):
             The expected return time (1 / steady_state_probability).
 
     """
-    steady_state = diffusion(M, P0=None, steps=None, backward=backward)
+    P0 = kwargs.pop('P0', None)
+    steady_state = diffusion(M, P0=P0, steps=None, backward=backward, **kwargs)
 
     T = 1 / steady_state
     return T
 
 
-def _empirical_vec(X_pca, X_embedding, V_mat, indices, neg_cells_trick, xy_grid_nums, neighbors):
-    """utility function for calculating the transition matrix or low dimensional velocity embedding via the original correlation kernel."""
-    n = X_pca.shape[0]
-    if indices is not None:
-        knn = indices.shape[1] - 1 #remove the first one in kNN
-        rows = np.zeros((n * knn, 1))
-        cols = np.zeros((n * knn, 1))
-        vals = np.zeros((n * knn, 1))
+def _empirical_vec(X_pca, X_embedding, V_mat, indices, neg_cells_trick, xy_grid_nums, neighbors, chunk_size=None):
+    """utility function for calculating the transition matrix or low dimensional velocity embedding via the original correlation kernel.
 
+    Cells are processed in chunks (by default of about 1e7 // (k * d) cells): the sign-sqrt transformed differences to
+    the k nearest neighbors form a chunk x k x d tensor, from which the Pearson correlations with the transformed
+    velocities, the softmax transition probabilities and the embedding displacements are computed with array operations.
+    """
+    n, knn = X_pca.shape[0], indices.shape[1] - 1 #remove the first one in kNN
+    chunk_size = max(1, int(1e7 // (knn * X_pca.shape[1]))) if chunk_size is None else chunk_size
+
+    rows, cols = np.repeat(np.arange(n), knn), indices[:, 1:].flatten()
+    vals = np.zeros((n, knn))
     delta_X = np.zeros((n, X_embedding.shape[1]))
-    idx = 0
-    for i in range(n):
-        i_vals = np.zeros((knn, 1))
-        velocity = V_mat[i, :]  # project V_mat to pca space
-        diff_velocity = np.sign(velocity) * np.sqrt(np.abs(velocity))
-
-        for j in np.arange(1, knn + 1):
-            neighbor_ind_j = indices[i, j]
-            diff = X_pca[neighbor_ind_j, :] - X_pca[i, :]
-            diff_rho = np.sign(diff) * np.sqrt(np.abs(diff))
-            pearson_corr = np.corrcoef(diff_rho, diff_velocity)[0, 1]
-
-            rows[idx] = i
-            cols[idx] = neighbor_ind_j
-            i_vals[j - 1] = pearson_corr
-            idx = idx + 1
+
+    for start in range(0, n, chunk_size):
+        i = np.arange(start, min(start + chunk_size, n))
+        j = indices[i, 1:]
+
+        diff_velocity = np.sign(V_mat[i]) * np.sqrt(np.abs(V_mat[i]))  # project V_mat to pca space
+        diff = X_pca[j] - X_pca[i, None, :]
+        diff_rho = np.sign(diff) * np.sqrt(np.abs(diff))
+
+        # row-wise pearson correlation between each neighbor difference and the velocity of the cell
+        diff_rho -= diff_rho.mean(2)[:, :, None]
+        diff_velocity = diff_velocity - diff_velocity.mean(1)[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            i_vals = np.einsum('ikd,id->ik', diff_rho, diff_velocity) / \
+                     np.sqrt(np.sum(diff_rho**2, 2) * np.sum(diff_velocity**2, 1)[:, None])
+
+            # unit displacements to the neighbors on the embedding
+            numerator = X_embedding[j] - X_embedding[i, None, :]
+            numerator /= np.linalg.norm(numerator, axis=2)[:, :, None]
 
         if neg_cells_trick:
-            val_ind_vec = np.array(range(i * knn, (i + 1) * knn))
             for sig in [-1, 1]:
-                cur_ind = np.where(np.sign(i_vals) == sig)[0]
-                if len(cur_ind) == 0:
+                cur_ind = np.sign(i_vals) == sig
+                n_cur = cur_ind.sum(1)
+                if not n_cur.any():
                     continue
 
-                cur_i_vals = i_vals[cur_ind]
-                sigma = max(abs(cur_i_vals))
-                exp_i_vals = np.exp(np.abs(cur_i_vals) / sigma)
-                denominator = sum(exp_i_vals)
-                i_prob = exp_i_vals / denominator
-                vals[val_ind_vec[cur_ind]] = sig * i_prob
+                cur_i_vals = np.where(cur_ind, np.abs(i_vals), 0)
+                sigma = cur_i_vals.max(1)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    exp_i_vals = np.where(cur_ind, np.exp(cur_i_vals / sigma[:, None]), 0)
+                    i_prob = exp_i_vals / exp_i_vals.sum(1)[:, None]
+                    weight = np.where(cur_ind, i_prob - 1 / n_cur[:, None], 0)
+                vals[i] = np.where(cur_ind, sig * i_prob, vals[i])
 
-                j_vec = indices[i, 1:][cur_ind]
-                numerator = sig * np.array([X_embedding[j, :] - X_embedding[i, :] for j in j_vec])
-                denominator = np.array([[scp.linalg.norm(numerator[j]) for j in range(len(j_vec))]]).T
-
-                delta_X[i, :] += 0.5 * (i_prob - 1 / len(cur_ind)).T.dot(
-                    numerator / np.hstack((denominator, denominator))).flatten()
+                delta_X[i] += 0.5 * np.einsum('ik,ikd->id', weight, np.where(cur_ind[:, :, None], sig * numerator, 0))
         else:
-            sigma = max(abs(i_vals))
-            exp_i_vals = np.exp(i_vals / sigma)
-            denominator = sum(exp_i_vals)
-            i_prob = exp_i_vals / denominator
-            vals[i * knn:(i + 1) * knn] = i_prob
-
-            j_vec = indices[i, 1:]
-            numerator = np.array([X_embedding[j, :] - X_embedding[i, :] for j in j_vec])
-            denominator = np.array([[scp.linalg.norm(numerator[j]) for j in range(knn)]]).T
+            sigma = np.abs(i_vals).max(1)
+            exp_i_vals = np.exp(i_vals / sigma[:, None])
+            i_prob = exp_i_vals / exp_i_vals.sum(1)[:, None]
+            vals[i] = i_prob
 
-            delta_X[i, :] = (i_prob - 1 / knn).T.dot(numerator / np.hstack((denominator, denominator)))
+            delta_X[i] = np.einsum('ik,ikd->id', i_prob - 1 / knn, numerator)
 
-        X_grid, V_grid, D = velocity_on_grid(X_embedding, X_embedding + delta_X, xy_grid_nums=xy_grid_nums)
+    X_grid, V_grid, D = velocity_on_grid(X_embedding, X_embedding + delta_X, xy_grid_nums=xy_grid_nums)
 
-    T = csr_matrix((vals.flatten(), (rows.flatten(), cols.flatten())), shape=neighbors.shape)
+    T = csr_matrix((vals.flatten(), (rows, cols)), shape=neighbors.shape)
 
     return T, delta_X, X_grid, V_grid, D
 
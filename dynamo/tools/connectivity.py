@@ -3,11 +3,10 @@ import scipy
 from scipy.sparse import issparse
 from sklearn.decomposition import TruncatedSVD
 import warnings
-from copy import deepcopy
-from inspect import signature
 from sklearn.utils import sparsefuncs
 from ..preprocessing.utils import get_layer_keys
 from .utils import get_mapper
+from .neighbor_index import get_neighbor_index, _fingerprint
 
 def extract_indices_dist_from_graph(graph, n_neighbors):
     """Extract the matrices for index, distance from the associated kNN sparse graph
@@ -25,28 +24,28 @@ def extract_indices_dist_from_graph(graph, n_neighbors):
             The matrix (n_cell x n_neighbors) that stores the indices for the each cell's n_neighbors nearest neighbors.
         dist_mat: :class:`~numpy.ndarray`
             The matrix (n_cell x n_neighbors) that stores the distances for the each cell's n_neighbors nearest neighbors.
+            Neighbors are sorted by distance; cells with fewer than n_neighbors - 1 neighbors are padded with themselves.
     """
 
+    graph = scipy.sparse.csr_matrix(graph)
     n_cells = graph.shape[0]
-    ind_mat = np.zeros((n_cells, n_neighbors), dtype=int)
+    ind_mat = np.repeat(np.arange(n_cells)[:, None], n_neighbors, axis=1)
     dist_mat = np.zeros((n_cells, n_neighbors), dtype=graph.dtype)
 
-    for cur_cell in range(n_cells):
-        cur_neighbors = graph[cur_cell, :].nonzero()  # returns the coordinate tuple for non-zero items
-
-        # set itself as the nearest neighbor
-        ind_mat[cur_cell, 0] = cur_cell
-        dist_mat[cur_cell, 0] = 0
-
-        # there could be more or less than n_neighbors because of an approximate search
-        cur_n_neighbors = len(cur_neighbors[1])
-        if cur_n_neighbors != n_neighbors - 1:  # could not broadcast input array from shape (13) into shape (14)
-            sorted_indices = np.argsort(graph[cur_cell][:, cur_neighbors[1]].A)[0][:(n_neighbors - 1)]
-            ind_mat[cur_cell, 1:] = cur_neighbors[1][sorted_indices]
-            dist_mat[cur_cell, 1:] = graph[cur_cell][0, cur_neighbors[1][sorted_indices]].A
-        else:
-            ind_mat[cur_cell, 1:] = cur_neighbors[1]
-            dist_mat[cur_cell, 1:] = graph[cur_cell][:, cur_neighbors[1]].A
+    # segmented sort of the non-zero entries of all rows by (row, distance); the first column is the cell itself
+    nonzero = graph.data != 0
+    rows = np.repeat(np.arange(n_cells), np.diff(graph.indptr))[nonzero]
+    cols, data = graph.indices[nonzero], graph.data[nonzero]
+    order = np.lexsort((data, rows))
+    rows, cols, data = rows[order], cols[order], data[order]
+
+    # there could be more or less than n_neighbors because of an approximate search: keep the n_neighbors - 1 closest
+    # ones, rows with fewer neighbors are padded with the cell itself (distance 0)
+    starts = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n_cells))))
+    ranks = np.arange(len(rows)) - starts[rows]
+    keep = ranks < n_neighbors - 1
+    ind_mat[rows[keep], ranks[keep] + 1] = cols[keep]
+    dist_mat[rows[keep], ranks[keep] + 1] = data[keep]
 
     return ind_mat, dist_mat
 
@@ -57,7 +56,9 @@ def umap_conn_indices_dist_embedding(X,
         metric="euclidean",
         min_dist=0.1,
         random_state=0,
-        verbose=False):
+        verbose=False,
+        angular=False,
+        graph_only=False):
     """Compute connectivity graph, matrices for kNN neighbor indices, distance matrix and low dimension embedding with UMAP.
     This code is adapted from umap-learn (https://github.com/lmcinnes/umap/blob/97d33f57459de796774ab2d7fcf73c639835676d/umap/umap_.py)
 
@@ -81,68 +82,50 @@ def umap_conn_indices_dist_embedding(X,
             the random number generator; If None, the random number generator is the RandomState instance used by `numpy.random`.
         verbose: `bool` (optional, default False)
             Controls verbosity of logging.
+        angular: `bool` (optional, default False)
+            Whether to use angular random projection trees for the approximate nearest neighbor search of large data
+            (recommended for cosine-like metrics).
+        graph_only: `bool` (optional, default False)
+            Whether to only compute the connectivity graph and kNN, and skip the (spectral initialization and
+            optimization of the) low dimensional embedding, which is then returned as None.
 
     Returns
     -------
         graph, knn_indices, knn_dists, embedding_
             A tuple of kNN graph (`graph`), indices of nearest neighbors of each cell (knn_indicies), distances of nearest
-            neighbors (knn_dists) and finally the low dimensional embedding (embedding_).
+            neighbors (knn_dists) and finally the low dimensional embedding (embedding_, None if `graph_only`).
     """
 
     from sklearn.utils import check_random_state
-    from sklearn.metrics import pairwise_distances
-    from umap.umap_ import nearest_neighbors, fuzzy_simplicial_set, simplicial_set_embedding, find_ab_params
+    from umap.umap_ import fuzzy_simplicial_set, simplicial_set_embedding, find_ab_params
 
     random_state = check_random_state(42)
 
     _raw_data = X
 
-    if X.shape[0] < 4096: #1
-        dmat = pairwise_distances(X, metric=metric)
-        graph = fuzzy_simplicial_set(
-            X=dmat,
-            n_neighbors=n_neighbors,
-            random_state=random_state,
-            metric="precomputed",
-            verbose=verbose
-        )
-        # extract knn_indices, knn_dist
-        g_tmp = deepcopy(graph)
-        g_tmp[graph.nonzero()] = dmat[graph.nonzero()]
-        knn_indices, knn_dists = extract_indices_dist_from_graph(g_tmp, n_neighbors=n_neighbors)
+    # exact kNN for small data (no dense pairwise distance matrix is formed), otherwise the approximate nearest neighbors
+    # of umap, both through the shared neighbor index
+    if X.shape[0] < 4096:
+        neighbor_index = get_neighbor_index(X, metric=metric, method='exact')
     else:
-        # Standard case
-        (knn_indices, knn_dists, rp_forest) = nearest_neighbors(
-            X=X,
-            n_neighbors=n_neighbors,
-            metric=metric,
-            metric_kwds={},
-            angular=False,
-            random_state=random_state,
-            verbose=verbose
-        )
-
-        graph = fuzzy_simplicial_set(
-            X=X,
-            n_neighbors=n_neighbors,
-            random_state=random_state,
-            metric=metric,
-            knn_indices=knn_indices,
-            knn_dists=knn_dists,
-            angular=rp_forest,
-            verbose=verbose
-        )
-
-        _raw_data = X
-        _transform_available = True
-        _search_graph = scipy.sparse.lil_matrix(
-            (X.shape[0], X.shape[0]), dtype=np.int8
-        )
-        _search_graph.rows = knn_indices # An array (self.rows) of rows, each of which is a sorted list of column indices of non-zero elements.
-        _search_graph.data = (knn_dists != 0).astype(np.int8) # The corresponding nonzero values are stored in similar fashion in self.data.
-        _search_graph = _search_graph.maximum( # Element-wise maximum between this and another matrix.
-            _search_graph.transpose()
-        ).tocsr()
+        neighbor_index = get_neighbor_index(X, metric=metric, method='umap', angular=angular, random_state=42)
+    knn_dists, knn_indices = neighbor_index.query(k=n_neighbors)
+
+    graph = fuzzy_simplicial_set(
+        X=X,
+        n_neighbors=n_neighbors,
+        random_state=random_state,
+        metric=metric,
+        knn_indices=knn_indices,
+        knn_dists=knn_dists,
+        angular=angular,
+        verbose=verbose
+    )
+    # umap-learn >= 0.4 also returns the sigmas and rhos of the fuzzy simplicial set
+    graph = graph[0] if isinstance(graph, tuple) else graph
+
+    if graph_only:
+        return graph, knn_indices, knn_dists, None
 
     if verbose:
         print("Construct embedding")
@@ -169,6 +152,92 @@ def umap_conn_indices_dist_embedding(X,
     return graph, knn_indices, knn_dists, embedding_
 
 
+def _register_neighbor_graph(adata, rep, n_neighbors, metric, X, graph, distances, indices, source):
+    """Store a kNN graph in the neighbor graph registry (`adata.uns['neighbor_graphs']`) with its provenance."""
+    registry = adata.uns['neighbor_graphs'] if 'neighbor_graphs' in adata.uns.keys() else {}
+    registry['{}_{}_{}'.format(rep, metric, n_neighbors)] = {
+        'params': {'rep': rep, 'n_neighbors': n_neighbors, 'metric': metric, 'method': 'umap', 'source': source,
+                   'data_hash': _fingerprint(X)},
+        'connectivities': graph, 'distances': distances, 'indices': indices}
+    adata.uns['neighbor_graphs'] = registry
+
+    return registry['{}_{}_{}'.format(rep, metric, n_neighbors)]
+
+
+def _is_valid_neighbor_graph(neighbors, n_obs, n_neighbors):
+    """Check that a `neighbors` entry holds a sparse n_obs x n_obs graph and kNN indices and distances of at least
+    n_neighbors columns."""
+    graph, indices, distances = neighbors.get('connectivities'), neighbors.get('indices'), neighbors.get('distances')
+    if not issparse(graph) or graph.shape != (n_obs, n_obs) or indices is None or distances is None:
+        return False
+
+    indices, distances = np.asarray(indices), np.asarray(distances)
+    return all(a.ndim == 2 and a.shape[0] == n_obs and a.shape[1] >= n_neighbors for a in (indices, distances))
+
+
+def get_neighbor_graph(adata, rep='X_pca', n_neighbors=30, metric='euclidean', X=None):
+    """Look up the kNN graph of a representation in the neighbor graph registry of the AnnData object, and build and
+    register it only if it is missing.
+
+    Graphs are stored in `adata.uns['neighbor_graphs']` under the key `{rep}_{metric}_{n_neighbors}`, together with
+    their parameters, the function that built them (`source`) and a content hash of the data they were built from, so
+    that a graph is rebuilt when the representation changes. An existing `adata.uns['neighbors']` graph with matching
+    parameters is registered instead of being rebuilt if it holds a sparse n_obs x n_obs `connectivities` matrix and
+    `indices` / `distances` with at least `n_neighbors` columns; otherwise the graph is rebuilt and replaces it.
+
+    Arguments
+    ---------
+        adata: :class:`~anndata.AnnData`
+            an Annodata object.
+        rep: `str` (default: `X_pca`)
+            The key of the representation, by default in the `.obsm` attribute.
+        n_neighbors: `int` (default: 30)
+            The number of nearest neighbors.
+        metric: `str` (default: `euclidean`)
+            The distance metric.
+        X: `np.ndarray` or None (default: None)
+            The data of the representation, if it is not stored in `adata.obsm[rep]`.
+
+    Returns
+    -------
+        neighbor_graph: `dict`
+            A dictionary with the `connectivities` (fuzzy simplicial set), `distances`, `indices` and `params` of the
+            graph.
+    """
+
+    X = adata.obsm[rep] if X is None else X
+    key = '{}_{}_{}'.format(rep, metric, n_neighbors)
+    stale = False
+    if 'neighbor_graphs' in adata.uns.keys() and key in adata.uns['neighbor_graphs'].keys():
+        neighbor_graph = adata.uns['neighbor_graphs'][key]
+        if neighbor_graph['params']['data_hash'] == _fingerprint(X):
+            return neighbor_graph
+        stale = True # the representation has changed since the graph was built
+
+    neighbors = adata.uns['neighbors'] if 'neighbors' in adata.uns.keys() else None
+    adopt = not stale and isinstance(neighbors, dict) and 'params' in neighbors.keys() and \
+        neighbors['params'].get('n_neighbors') == n_neighbors and \
+        neighbors['params'].get('metric', 'euclidean') == metric and neighbors['params'].get('use_rep', 'X_pca') == rep
+    if adopt and _is_valid_neighbor_graph(neighbors, adata.n_obs, n_neighbors):
+        return _register_neighbor_graph(adata, rep, n_neighbors, metric, X, neighbors['connectivities'],
+                                        np.asarray(neighbors['distances'])[:, :n_neighbors],
+                                        np.asarray(neighbors['indices'])[:, :n_neighbors], source='neighbors')
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        graph, knn_indices, knn_dists, _ = umap_conn_indices_dist_embedding(X, n_neighbors=n_neighbors, metric=metric,
+                                                                            graph_only=True)
+
+    if adopt:
+        # the matching `neighbors` entry is incomplete (e.g. written by trimap or tSNE without a graph), replace it
+        adata.uns['neighbors'] = {'params': {'n_neighbors': n_neighbors, 'method': 'umap', 'metric': metric,
+                                             'use_rep': rep},
+                                  'connectivities': graph, 'distances': knn_dists, 'indices': knn_indices}
+
+    return _register_neighbor_graph(adata, rep, n_neighbors, metric, X, graph, knn_dists, knn_indices,
+                                    source='umap_conn_indices_dist_embedding')
+
+
 def mnn_from_list(knn_graph_list):
     """Apply reduce function to calculate the mutual kNN.
     """
@@ -230,16 +299,18 @@ def mnn(adata, n_pca_components=25, n_neighbors=250, layers='all', use_pca_fit=T
             transformer = TruncatedSVD(n_components=n_pca_components + 1, random_state=0)
             layer_pca = transformer.fit_transform(layer_X)[:, 1:]
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            graph, knn_indices, knn_dists, X_dim = umap_conn_indices_dist_embedding(layer_pca, n_neighbors=n_neighbors)
-
         if save_all_to_adata:
-            adata.obsm[layer + '_pca'], adata.obsm[layer + '_umap'] = layer_pca, X_dim
-            n_neighbors = signature(umap_conn_indices_dist_embedding).parameters['n_neighbors']
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                graph, knn_indices, knn_dists, X_dim = umap_conn_indices_dist_embedding(layer_pca, n_neighbors=n_neighbors)
+            _register_neighbor_graph(adata, layer + '_pca', n_neighbors, 'euclidean', layer_pca, graph, knn_dists,
+                                     knn_indices, source='mnn')
 
-            adata.uns[layer + '_neighbors'] = {'params': {'n_neighbors': eval(n_neighbors), 'method': 'umap'},
+            adata.obsm[layer + '_pca'], adata.obsm[layer + '_umap'] = layer_pca, X_dim
+            adata.uns[layer + '_neighbors'] = {'params': {'n_neighbors': n_neighbors, 'method': 'umap'},
                                       'connectivities': graph, 'distances': knn_dists, 'indices': knn_indices}
+        else:
+            graph = get_neighbor_graph(adata, layer + '_pca', n_neighbors, X=layer_pca)['connectivities']
 
         knn_graph_list.append(graph > 0)
 
@@ -248,7 +319,80 @@ def mnn(adata, n_pca_components=25, n_neighbors=250, layers='all', use_pca_fit=T
 
     return adata
 
-def smoother(adata, use_mnn=False, layers='all'):
+def smooth_layers(kNN, layer_dict, chunk_size=10000, output='auto', dtype=np.float32):
+    """Smooth several data matrices with the same (row normalized) kNN graph in one pass over the graph.
+
+    The rows of the graph are processed in chunks, and each chunk is multiplied with all data matrices, so that the
+    graph is traversed once and the sparse temporaries stay bounded. The input matrices are not modified.
+
+    Arguments
+    ---------
+        kNN: sparse matrix
+            The (n_cell x n_cell) row normalized kNN graph.
+        layer_dict: `dict`
+            A dictionary of (n_cell x n_genes) dense or sparse data matrices (already transformed to the linear scale).
+        chunk_size: `int` (default: 10000)
+            The number of rows of the graph processed at once.
+        output: `str` (default: `auto`)
+            The output density policy, one of `dense`, `sparse` or `auto` (sparse results for sparse inputs and dense
+            results for dense inputs).
+        dtype: `numpy.dtype` (default: `np.float32`)
+            The data type of the results.
+
+    Returns
+    -------
+        smoothed_dict: `dict`
+            A dictionary with the smoothed matrices, with the same keys as `layer_dict`.
+    """
+
+    if output not in ['auto', 'dense', 'sparse']:
+        raise Exception('The output density policy {} is not supported.'.format(output))
+    kNN = scipy.sparse.csr_matrix(kNN, dtype=dtype)
+    n = kNN.shape[0]
+    layer_dict = {key: scipy.sparse.csr_matrix(X, dtype=dtype) if issparse(X) else np.asarray(X, dtype=dtype)
+                  for key, X in layer_dict.items()}
+    as_sparse = {key: issparse(X) if output == 'auto' else output == 'sparse' for key, X in layer_dict.items()}
+
+    chunks = {key: [] for key in layer_dict.keys()}
+    dense_res = {key: np.zeros(X.shape, dtype=dtype) for key, X in layer_dict.items() if not as_sparse[key]}
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        kNN_chunk = kNN[start:end]
+        for key, X in layer_dict.items():
+            res = kNN_chunk.dot(X)
+            if as_sparse[key]:
+                chunks[key].append(scipy.sparse.csr_matrix(res, dtype=dtype))
+            else:
+                dense_res[key][start:end] = res.toarray() if issparse(res) else res
+
+    smoothed_dict = {}
+    for key in layer_dict.keys():
+        smoothed_dict[key] = scipy.sparse.vstack(chunks[key], format='csr', dtype=dtype) if as_sparse[key] else dense_res[key]
+    return smoothed_dict
+
+
+def smoother(adata, use_mnn=False, layers='all', chunk_size=10000, output='auto'):
+    """Smooth the (log transformed) data layers with the kNN graph to obtain the first moments (`M_s`, `M_u`, ...).
+
+    Parameters
+    ----------
+        adata: :class:`~anndata.AnnData`
+            an Annodata object.
+        use_mnn: `bool` (default: `False`)
+            Whether to use the mutual nearest neighbor graph instead of the kNN graph of `X_pca`.
+        layers: str or list (default: `all`)
+            The layer(s) to be smoothed.
+        chunk_size: `int` (default: 10000)
+            The number of rows of the graph processed at once.
+        output: `str` (default: `auto`)
+            The output density policy, one of `dense`, `sparse` or `auto` (follows the density of each layer).
+
+    Returns
+    -------
+        adata: :AnnData
+            A updated anndata object with the smoothed layers (in float32). The input layers are not modified.
+    """
+
     mapper = get_mapper()
 
     if use_mnn:
@@ -256,27 +400,33 @@ def smoother(adata, use_mnn=False, layers='all'):
             adata = mnn(adata, n_pca_components=25, layers='all', use_pca_fit=True, save_all_to_adata=False)
         kNN = adata.uns['mnn']
     else:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            kNN, _, _, _ = umap_conn_indices_dist_embedding(adata.obsm['X_pca'], n_neighbors=30)
+        kNN = get_neighbor_graph(adata, 'X_pca', n_neighbors=30)['connectivities']
         kNN = normalize_knn_graph(kNN > 0)
 
     layers = get_layer_keys(adata, layers, False)
     layers = [layer for layer in layers if layer.startswith('X_') and (not layer.endswith('_matrix') and
                                                                not layer.endswith('_ambiguous'))]
 
+    layer_dict = {}
     for layer in layers:
         layer_X = adata.layers[layer]
 
+        # undo the log transformation on a copy of the values (the sparsity structure is shared with the layer)
         if issparse(layer_X):
-            layer_X.data = 2**layer_X.data - 1
+            layer_X = scipy.sparse.csr_matrix(layer_X)
+            layer_X = scipy.sparse.csr_matrix((np.exp2(layer_X.data, dtype=np.float32) - 1, layer_X.indices,
+                                               layer_X.indptr), shape=layer_X.shape)
         else:
-            layer_X = 2** layer_X - 1
-
-        adata.layers[mapper[layer]] = kNN.dot(layer_X)
+            layer_X = np.exp2(layer_X, dtype=np.float32) - 1
+        layer_dict[mapper[layer]] = layer_X
 
     if 'X_protein' in adata.obsm.keys(): # may need to update with mnn or just use knn from protein layer itself.
-        adata.obsm[mapper['X_protein']] = kNN.dot(adata.obsm['X_protein'])
+        layer_dict['obsm_X_protein'] = adata.obsm['X_protein']
 
-    return adata
+    smoothed_dict = smooth_layers(kNN, layer_dict, chunk_size=chunk_size, output=output)
+    for layer in layers:
+        adata.layers[mapper[layer]] = smoothed_dict[mapper[layer]]
+    if 'X_protein' in adata.obsm.keys():
+        adata.obsm[mapper['X_protein']] = smoothed_dict['obsm_X_protein']
 
+    return adata
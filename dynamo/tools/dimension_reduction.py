@@ -78,8 +78,9 @@ def reduceDimension(adata, n_pca_components=25, n_components=2, n_neighbors=10,
             warnings.simplefilter("ignore")
             graph, knn_indices, knn_dists, X_dim = umap_conn_indices_dist_embedding(X_pca) # X_pca
         adata.obsm['X_umap'] = X_dim
-        adata.uns['neighbors'] = {'params': {'n_neighbors': n_neighbors, 'method': reduction_method}, 'connectivities': graph, \
-                                  'distances': knn_dists, 'indices': knn_indices}
+        # record the number of neighbors the graph was actually built with
+        adata.uns['neighbors'] = {'params': {'n_neighbors': knn_indices.shape[1], 'method': reduction_method},
+                                  'connectivities': graph, 'distances': knn_dists, 'indices': knn_indices}
     elif reduction_method is 'psl':
         adj_mat, X_dim = psl_py(X_pca, d=n_components, K=n_neighbors) # this need to be updated
         adata.obsm['X_psl'] = X_dim
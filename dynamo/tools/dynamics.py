@@ -9,7 +9,7 @@ from .utils import moment_model
 # incorporate the model selection code soon
 def dynamics(adata, tkey=None, filter_gene_mode='final', mode='deterministic', use_smoothed=True, group=None, protein_names=None,
              experiment_type=None, assumption_mRNA=None, assumption_protein='ss', NTR_vel=True, concat_data=False,
-             log_unnormalized=True):
+             log_unnormalized=True, n_jobs=1, backend='loky'):
     """Inclusive model of expression dynamics considers splicing, metabolic labeling and protein translation. It supports
     learning high-dimensional velocity vector samples for droplet based (10x, inDrop, drop-seq, etc), scSLAM-seq, NASC-seq
     sci-fate, scNT-seq or cite-seq datasets.
@@ -53,6 +53,11 @@ def dynamics(adata, tkey=None, filter_gene_mode='final', mode='deterministic', u
             Whether to concatenate data before estimation. If your data is a list of matrices for each time point, this need to be set as True.
         log_unnormalized: `bool` (default: `True`)
             Whether to log transform the unnormalized data.
+        n_jobs: `int` (default: `1`)
+            The number of parallel workers used for the gene-wise kinetic parameter fits in the `deterministic` mode. -1
+            uses all cores.
+        backend: `str` (default: `loky`)
+            The joblib backend (`loky`, `multiprocessing` or `threading`) used for the parallel fits when n_jobs is not 1.
 
     Returns
     -------
@@ -93,7 +98,7 @@ def dynamics(adata, tkey=None, filter_gene_mode='final', mode='deterministic', u
                              experiment_type=experiment_type,
                              assumption_mRNA=assumption_mRNA, assumption_protein=assumption_protein,
                              concat_data=concat_data)
-            est.fit()
+            est.fit(n_jobs=n_jobs, backend=backend)
 
             alpha, beta, gamma, eta, delta = est.parameters.values()
 
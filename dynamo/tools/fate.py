@@ -1,7 +1,6 @@
 from .scVectorField import VectorField
 import numpy as np
-from scipy.integrate import odeint
-from .scVectorField import vector_field_function
+from .scVectorField import KernelVectorField
 from scipy.sparse import issparse
 
 
@@ -58,7 +57,7 @@ def Fate(adata, VecFld_true=None, basis='X', query_cell_str="steady_states=='roo
         adata.uns["Fate_true"] = {'t': t, 'prediction': prediction}
 
 
-def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direction='both', average=False):
+def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direction='both', average=False, rtol=1e-6, atol=1e-8):
     """Predict the historical and future cell transcriptomic states over arbitrary time scales by integrating vector field
     functions from one or a set of initial cell state(s).
 
@@ -77,11 +76,16 @@ def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direct
         step_size: `float` or None (default None)
             Step size for integrating the future or history cell state, used by the odeint function. By default it is None,
             and the step_size will be automatically calculated to ensure 250 total integration time-steps will be used.
+            Note that the integrator chooses its own internal steps, step_size only determines the returned time points.
         direction: `string` (default: both)
             The direction to predict the cell fate. One of the `forward`, `backward`or `both` string.
         average: `bool` (default: False)
             A boolean flag to determine whether to smooth the trajectory by calculating the average cell state at each time
             step.
+        rtol: `float` (default 1e-6)
+            Relative tolerance of the integration, see `integrate_vf`.
+        atol: `float` (default 1e-8)
+            Absolute tolerance of the integration, see `integrate_vf`.
 
     Returns
     -------
@@ -95,33 +99,26 @@ def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direct
         at each time point is calculated for all cells.
     """
 
-    V_func = lambda x, t: vector_field_function(x=x, t=t, VecFld=VecFld) if VecFld_true is None else VecFld_true
+    V_func = KernelVectorField(VecFld) if VecFld_true is None else VecFld_true
 
     if step_size is None:
         t1=np.linspace(0, t_end, 250)
     else:
         t1 = np.arange(0, t_end + step_size, step_size)
-    n_cell, n_feature, n_steps = init_state.shape[0], init_state.shape[1], len(t1)
+    n_cell, n_steps = init_state.shape[0], len(t1)
 
     if direction is 'both':
         t0 = - t1 #[::-1] # reverse and negate the time-points
 
-        history, future = np.zeros((n_cell * n_steps, n_feature)), np.zeros((n_cell * n_steps, n_feature))
-        for i in range(n_cell):
-            history[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t0)
-            future[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t1)
+        history = integrate_vf(init_state, t0, V_func, rtol=rtol, atol=atol)
+        future = integrate_vf(init_state, t1, V_func, rtol=rtol, atol=atol)
         t, prediction = np.hstack((t0, t1)), np.vstack((history, future))
     elif direction is 'forward':
-        prediction = np.zeros((n_cell * n_steps, n_feature))
-
-        for i in range(n_cell):
-            prediction[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t1)
+        prediction = integrate_vf(init_state, t1, V_func, rtol=rtol, atol=atol)
         t=t1
     elif direction is "backward":
         t0 = - t1 #[::-1] # reverse and negate the time-points
-        prediction = np.zeros((n_cell * n_steps, n_feature))
-        for i in range(n_cell):
-            prediction[(n_steps * i):(n_steps * (i + 1)), :] = odeint(V_func, init_state[i, :], t=t0)
+        prediction = integrate_vf(init_state, t0, V_func, rtol=rtol, atol=atol)
         t=t0
     else:
         raise Exception('both, forward, backward are the only valid direction argument string')
@@ -135,6 +132,102 @@ def fate(VecFld, init_state, VecFld_true = None, t_end=1, step_size=None, direct
 
     return t, prediction
 
+def integrate_vf(init_states, t, V_func, rtol=1e-6, atol=1e-8, max_iter=1e6):
+    """Integrate the vector field from a batch of initial states with a vectorized Dormand-Prince (RK45) solver. All
+    initial states are advanced together with a shared adaptive step size, so each stage of a step evaluates the vector
+    field once on the whole batch instead of once per cell. States at the requested time points are obtained from the
+    continuous extension of the solver, so the steps are not bound to the spacing of t.
+
+    Arguments
+    ---------
+        init_states: `numpy.ndarray`
+            A n_cell x n_feature array of initial cell states.
+        t: `numpy.ndarray`
+            The monotonically increasing (or decreasing for backward integration) time points at which the states are
+            returned. The integration starts at t[0].
+        V_func: `function`
+            The vector field function, which takes a n_cell x n_feature array of states (and the time t) and returns the
+            velocity of each state in an array of the same shape.
+        rtol: `float` (default 1e-6)
+            Relative tolerance. The step is accepted if the (rms) error estimate of every cell is within tolerance.
+        atol: `float` (default 1e-8)
+            Absolute tolerance.
+        max_iter: `int` (default 1e6)
+            The maximal number of attempted steps.
+
+    Returns
+    -------
+    Y: `numpy.ndarray`
+        The states of each cell at the time points t, concatenated by rows, with dimension (n_cells * len(t), n_features).
+    """
+
+    Y0 = np.array(init_states, dtype=float)
+    n_cell, n_feature = Y0.shape
+    t = np.asarray(t, dtype=float)
+    Y = np.zeros((n_cell, len(t), n_feature))
+    Y[:, 0] = Y0
+    if len(t) < 2:
+        return Y.reshape((-1, n_feature))
+
+    # Dormand-Prince 5(4) coefficients and the 4th order continuous extension used for dense output
+    C = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1])
+    A = [[], [1 / 5], [3 / 40, 9 / 40], [44 / 45, -56 / 15, 32 / 9],
+         [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+         [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656]]
+    B = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+    E = np.array([-71 / 57600, 0, 71 / 16695, -71 / 1920, 17253 / 339200, -22 / 525, 1 / 40])
+    P = np.array([[1, -8048581381 / 2820520608, 8663915743 / 2820520608, -12715105075 / 11282082432],
+                  [0, 0, 0, 0],
+                  [0, 131558114200 / 32700410799, -68118460800 / 10900136933, 87487479700 / 32700410799],
+                  [0, -1754552775 / 470086768, 14199869525 / 1410260304, -10690763975 / 1880347072],
+                  [0, 127303824393 / 49829197408, -318862633887 / 49829197408, 701980252875 / 199316789632],
+                  [0, -282668133 / 205662961, 2019193451 / 616988883, -1453857185 / 822651844],
+                  [0, 40617522 / 29380423, -110615467 / 29380423, 69997945 / 29380423]])
+
+    f = lambda y, t_: np.reshape(V_func(y, t_), (n_cell, n_feature))
+    direction, t_bound = np.sign(t[-1] - t[0]), t[-1]
+    t_cur, y, k_first = t[0], Y0, f(Y0, t[0])
+
+    # initial step size as in Hairer, Norsett & Wanner
+    scale = atol + rtol * np.abs(y)
+    d0, d1 = np.sqrt(np.mean((y / scale) ** 2)), np.sqrt(np.mean((k_first / scale) ** 2))
+    h = np.abs(t_bound - t[0]) if d1 == 0 else (1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1)
+
+    i, n_iter = 1, 0
+    while i < len(t):
+        n_iter += 1
+        if n_iter > max_iter:
+            raise Exception('The integration did not reach the end time within max_iter steps.')
+
+        h_try = min(h, np.abs(t_bound - t_cur))
+        dt = direction * h_try
+        K = [k_first]
+        for s in range(1, 6):
+            K.append(f(y + dt * sum(a * k for a, k in zip(A[s], K)), t_cur + C[s] * dt))
+        y_new = y + dt * sum(b * k for b, k in zip(B, K))
+        K.append(f(y_new, t_cur + dt))
+
+        scale = atol + rtol * np.maximum(np.abs(y), np.abs(y_new))
+        err = dt * sum(e * k for e, k in zip(E, K))
+        err = np.sqrt(np.mean((err / scale) ** 2, 1)).max()
+
+        if err <= 1:
+            t_new = t_bound if h_try == np.abs(t_bound - t_cur) else t_cur + dt
+            # interpolate all the requested time points passed by this step
+            Q = np.tensordot(P, np.array(K), axes=(0, 0))
+            while i < len(t) and direction * (t[i] - t_new) <= 0:
+                x = (t[i] - t_cur) / dt
+                Y[:, i] = y_new if t[i] == t_new else y + dt * sum(Q[j] * x ** (j + 1) for j in range(4))
+                i += 1
+            t_cur, y, k_first = t_new, y_new, K[-1]
+            h = h_try * (5 if err == 0 else min(5, 0.9 * err ** -0.2))
+        else:
+            h = h_try * max(0.2, 0.9 * err ** -0.2)
+            if h < 1e-12 * max(1, np.abs(t_cur)):
+                raise Exception('The step size of the integration becomes too small.')
+
+    return Y.reshape((-1, n_feature))
+
 # def fate_(adata, time, direction = 'forward'):
 #     from .moments import *
 #     gene_exprs = adata.X
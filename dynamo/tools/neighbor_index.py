@@ -0,0 +1,198 @@
+import numpy as np
+import hashlib
+from collections import OrderedDict
+from scipy.sparse import issparse
+from sklearn.neighbors import NearestNeighbors, BallTree
+
+
+_NEIGHBOR_INDEX_CACHE = OrderedDict()
+_NEIGHBOR_INDEX_CACHE_SIZE = 8
+_NEIGHBOR_INDEX_CACHE_BYTES = 2 ** 30  # the cache holds the data and self queries of the indices, at most 1 GB of them
+
+
+def _fingerprint(X):
+    """Content hash of a (dense or sparse) data matrix, used as the key of cached neighbor indices."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((X.shape, X.dtype)).encode())
+    if issparse(X):
+        X = X.tocsr()
+        for a in (X.data, X.indices, X.indptr):
+            h.update(np.ascontiguousarray(a).view(np.uint8))
+    else:
+        h.update(np.ascontiguousarray(X).view(np.uint8))
+    return h.hexdigest()
+
+
+class NeighborIndex:
+    """A nearest neighbor index with exchangeable backends.
+
+    Arguments
+    ---------
+        X: `np.ndarray` or sparse matrix
+            The (n_cells x n_dims) data points to be indexed.
+        metric: `str` (default: `euclidean`)
+            The distance metric.
+        method: `str` (default: `auto`)
+            The backend, one of `exact` (brute force), `ball_tree`, `kd_tree`, `umap` (the approximate nearest
+            neighbors of umap-learn, only supports self queries), `nndescent` (approximate nearest neighbor descent,
+            requires `pynndescent`), `hnsw` (approximate hierarchical navigable small world graphs, requires `hnswlib`)
+            or `auto`. `auto` always resolves to an exact search, a ball tree (or brute force for sparse data and
+            metrics not supported by ball trees), so that the neighbors do not depend on the installed packages.
+        n_jobs: `int` (default: -1)
+            The number of parallel jobs.
+        random_state: `int` (default: 0)
+            The seed of the approximate backends.
+        angular: `bool` (default: False)
+            Whether to use angular random projection trees to initialize the `umap` backend (recommended for
+            cosine-like metrics).
+    """
+
+    def __init__(self, X, metric='euclidean', method='auto', n_jobs=-1, random_state=0, angular=False):
+        self.X = X
+        self.metric = metric
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.angular = angular
+        self.method = self._resolve_method(method)
+        self._index = None
+        self._self_query = None  # (dists, indices) of the largest self query so far
+
+    def _resolve_method(self, method):
+        if method != 'auto':
+            if method not in ['exact', 'ball_tree', 'kd_tree', 'umap', 'nndescent', 'hnsw']:
+                raise Exception(f'The neighbor index method {method} is not supported.')
+            return method
+
+        return 'ball_tree' if not issparse(self.X) and self.metric in BallTree.valid_metrics else 'exact'
+
+    def _build(self, k):
+        if self.method in ['exact', 'ball_tree', 'kd_tree']:
+            if self._index is None:
+                algorithm = 'brute' if self.method == 'exact' else self.method
+                self._index = NearestNeighbors(algorithm=algorithm, metric=self.metric, n_jobs=self.n_jobs).fit(self.X)
+        elif self.method == 'umap':
+            # the approximate kNN graph is built for a fixed k, rebuild for larger queries
+            if self._index is None or self._index[0].shape[1] < k:
+                from sklearn.utils import check_random_state
+                from umap.umap_ import nearest_neighbors
+                knn_indices, knn_dists = nearest_neighbors(X=self.X, n_neighbors=k, metric=self.metric, metric_kwds={},
+                                                           angular=self.angular,
+                                                           random_state=check_random_state(self.random_state))[:2]
+                self._index = (knn_indices, knn_dists)
+        elif self.method == 'nndescent':
+            # the neighbor graph of the nndescent index is built for a fixed k, rebuild for larger queries
+            if self._index is None or self._index.n_neighbors < k:
+                from pynndescent import NNDescent
+                self._index = NNDescent(self.X, metric=self.metric, n_neighbors=max(k, 15),
+                                        random_state=self.random_state, n_jobs=self.n_jobs)
+        elif self.method == 'hnsw':
+            if self._index is None:
+                import hnswlib
+                space = {'euclidean': 'l2', 'cosine': 'cosine', 'inner_product': 'ip'}
+                if self.metric not in space:
+                    raise Exception(f'The metric {self.metric} is not supported by the hnsw backend.')
+                X = np.asarray(self.X.A if issparse(self.X) else self.X, dtype=np.float32)
+                self._index = hnswlib.Index(space=space[self.metric], dim=X.shape[1])
+                self._index.init_index(max_elements=X.shape[0], ef_construction=200, M=16, random_seed=self.random_state)
+                self._index.set_num_threads(self.n_jobs if self.n_jobs > 0 else -1)
+                self._index.add_items(X)
+
+    def _query(self, Y, k):
+        self._build(k)
+        if self.method in ['exact', 'ball_tree', 'kd_tree']:
+            dists, indices = self._index.kneighbors(Y, n_neighbors=k)
+        elif self.method == 'umap':
+            if Y is not self.X:
+                raise Exception('The umap backend only supports queries of the indexed points.')
+            indices, dists = self._index[0][:, :k], self._index[1][:, :k]
+        elif self.method == 'nndescent':
+            if Y is self.X:
+                indices, dists = self._index.neighbor_graph
+                indices, dists = indices[:, :k], dists[:, :k]
+            else:
+                indices, dists = self._index.query(Y, k=k)
+        else:
+            self._index.set_ef(max(2 * k, 50))
+            indices, dists = self._index.knn_query(np.asarray(Y.A if issparse(Y) else Y, dtype=np.float32), k=k)
+            if self.metric == 'euclidean':
+                dists = np.sqrt(np.maximum(dists, 0))
+        return dists, indices.astype(np.int64, copy=False)
+
+    def query(self, Y=None, k=15):
+        """Find the k nearest neighbors of the query points.
+
+        Arguments
+        ---------
+            Y: `np.ndarray` or None (default: None)
+                The query points. If None, the indexed points are queried (each point is returned as its own first
+                neighbor) and the result is cached, so that repeated queries with the same or a smaller k are free.
+                Copies of the cached arrays are returned, so the caller may modify them in place.
+            k: `int` (default: 15)
+                The number of nearest neighbors.
+
+        Returns
+        -------
+            dists, indices: `tuple`
+                The (n_queries x k) distances and indices of the nearest neighbors, sorted by distance.
+        """
+
+        k = int(min(k, self.X.shape[0]))
+        if Y is not None:
+            return self._query(Y, k)
+
+        if self._self_query is None or self._self_query[0].shape[1] < k:
+            self._self_query = self._query(self.X, k)
+        dists, indices = self._self_query
+        return dists[:, :k].copy(), indices[:, :k].copy()
+
+    @property
+    def nbytes(self):
+        """The approximate memory held by the index: the indexed data and the cached self query."""
+        X = self.X.data if issparse(self.X) else np.asarray(self.X)
+        return X.nbytes + (0 if self._self_query is None else sum(a.nbytes for a in self._self_query))
+
+
+def get_neighbor_index(X, metric='euclidean', method='auto', **kwargs):
+    """Get a (shared) nearest neighbor index of the data points, building it only if no index for the same data, metric,
+    method and parameters was built before. Indices are kept in a small least-recently-used cache keyed by a content hash
+    of X, which holds at most 8 indices and 1 GB of data and self queries; larger indices are not cached.
+
+    Arguments
+    ---------
+        X: `np.ndarray` or sparse matrix
+            The (n_cells x n_dims) data points, e.g. an embedding.
+        metric: `str` (default: `euclidean`)
+            The distance metric.
+        method: `str` (default: `auto`)
+            The backend, see `NeighborIndex`.
+        kwargs:
+            Additional parameters that will be passed to `NeighborIndex`.
+
+    Returns
+    -------
+        index: `NeighborIndex`
+            The neighbor index, whose `query` method returns the distances and indices of the nearest neighbors.
+    """
+
+    key = (_fingerprint(X), metric, method, tuple(sorted(kwargs.items())))
+    if key in _NEIGHBOR_INDEX_CACHE:
+        _NEIGHBOR_INDEX_CACHE.move_to_end(key)
+        index = _NEIGHBOR_INDEX_CACHE[key]
+    else:
+        index = NeighborIndex(X, metric=metric, method=method, **kwargs)
+        _NEIGHBOR_INDEX_CACHE[key] = index
+    _trim_neighbor_index_cache()
+    return index
+
+
+def _trim_neighbor_index_cache():
+    """Evict the least recently used indices until the cache fits its size and memory limits. The self queries of
+    the cached indices grow after they are returned, so the memory is re-checked on every lookup."""
+    while len(_NEIGHBOR_INDEX_CACHE) > _NEIGHBOR_INDEX_CACHE_SIZE or \
+            sum(index.nbytes for index in _NEIGHBOR_INDEX_CACHE.values()) > _NEIGHBOR_INDEX_CACHE_BYTES:
+        _NEIGHBOR_INDEX_CACHE.popitem(last=False)
+
+
+def clear_neighbor_index_cache():
+    """Remove all cached neighbor indices."""
+    _NEIGHBOR_INDEX_CACHE.clear()
@@ -12,6 +12,8 @@ from scipy.sparse.linalg import eigs
 import functools
 import operator
 
+from .neighbor_index import get_neighbor_index
+
 def sqdist (a,b):
     """calculate the square distance between a, b
     Arguments
@@ -128,8 +130,7 @@ def psl_py(Y, sG = None, dist = None, K = 10, C = 1e3, param_gamma = 1e-3, d = 2
 
     if sG is None:
         if not dist:
-            tree = ss.cKDTree(Y)
-            dist_mat, idx_mat = tree.query(Y, k=K + 1)
+            dist_mat, idx_mat = get_neighbor_index(Y, method='kd_tree').query(k=K + 1)
             N = Y.shape[0]
             distances = dist_mat[:, 1:]
             indices = idx_mat[:, 1:]
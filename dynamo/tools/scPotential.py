@@ -8,6 +8,7 @@ from sympy import *
 from .Bhattacharya import path_integral, alignment
 from .Ao import Ao_pot_map
 from .Wang import Wang_action, Wang_LAP
+from .scVectorField import KernelVectorField
 
 # the LAP method should be rewritten in TensorFlow/PyTorch using optimization with SGD
 
@@ -49,6 +50,11 @@ def gen_fixed_points(func, auto_func, dim_range, RandNum, EqNum, reverse=False,
         func_ = lambda x: -func(x)
     else:
         func_ = func
+    # use the analytic Jacobian if the vector field provides one (e.g. KernelVectorField)
+    if hasattr(func, 'jacobian'):
+        jac_ = (lambda x: -func.jacobian(x)) if reverse is True else func.jacobian
+    else:
+        jac_ = nda.Jacobian(func_)
     ZeroConst = 1e-8
     FixedPointConst = 1e-20
     MaxSolution = 1000
@@ -82,7 +88,7 @@ def gen_fixed_points(func, auto_func, dim_range, RandNum, EqNum, reverse=False,
             #     jacobian_mat=(fval_dict["fjac"]).dot(matrixr)
             # else:
             fval = fval_dict['fvec']
-            jacobian_mat = nda.Jacobian(func_)(np.array(x)) # autonp.array?
+            jacobian_mat = jac_(np.array(x)) # autonp.array?
 
             jacobian_mat[np.isinf(jacobian_mat)] = 0
             if fval.dot(fval) < FixedPointConst:
@@ -107,7 +113,7 @@ def gen_fixed_points(func, auto_func, dim_range, RandNum, EqNum, reverse=False,
             #     jacobian_mat=(fval_dict["fjac"]).dot(matrixr)
             # else:
             fval = fval_dict['fvec']
-            jacobian_mat = nda.Jacobian(func_)(np.array(x)) # autonp.array?
+            jacobian_mat = jac_(np.array(x)) # autonp.array?
 
             jacobian_mat[np.isinf(jacobian_mat)] = 0
             if fval.dot(fval) < FixedPointConst:
@@ -339,7 +345,7 @@ def Potential(adata, DiffMat=None, method='Ao', **kwargs):
 
     """
 
-    Function = adata.uns['VecFld']
+    Function = KernelVectorField(adata.uns['VecFld'])
     DiffMat = DiffusionMatrix if DiffMat is None else DiffMat
     pot = Pot(Function, DiffMat, **kwargs)
     pot.fit(method=method)
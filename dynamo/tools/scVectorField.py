@@ -2,6 +2,8 @@ import numpy as np
 import scipy
 import numpy.matlib
 from scipy.sparse import issparse
+from collections import OrderedDict
+from .neighbor_index import _fingerprint
 
 
 def norm(X, V, T):
@@ -57,20 +59,15 @@ def auto_con_K(self, x, y, beta):
             the kernel to represent the vector field function.
     """
 
-    n, d = x.shape
-    m, d = y.shape
-
-    # https://stackoverflow.com/questions/1721802/what-is-the-equivalent-of-matlabs-repmat-in-numpy
-    # https://stackoverflow.com/questions/12787475/matlabs-permute-in-python
-    K = np.matlib.tile(x[:, :, None], [1, 1, m]) - np.transpose(np.matlib.tile(y[:, :, None], [1, 1, n]), [2, 1, 0])
-    K = np.squeeze(np.sum(K**2, 1))
+    K = np.sum(x**2, 1)[:, None] + np.sum(y**2, 1)[None, :] - 2 * np.dot(x, y.T)
+    K = np.squeeze(np.maximum(K, 0))
     K = - beta * K
     K = np.exp(K) #
 
     return K
 
 
-def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, lambda_ = 3, minP = 1e-5, MaxIter = 500, theta = 0.75, div_cur_free_kernels = False):
+def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, lambda_ = 3, minP = 1e-5, MaxIter = 500, theta = 0.75, div_cur_free_kernels = False, batch_size = None):
     """Apply sparseVFC (vector field consensus) algorithm to learn a functional form of the vector field on the entire space robustly and efficiently.
     Reference: Regularized vector field learning with sparse approximation for mismatch removal, Ma, Jiayi, etc. al, Pattern Recognition
 
@@ -100,6 +97,11 @@ def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, l
             Maximum iterition times.
         theta: 'float' (default: 0.75)
             Define how could be an inlier. If the posterior probability of a sample is an inlier is larger than theta, then it is regarded as an inlier.
+        batch_size: 'int' or None (default: None)
+            If not None, use the low memory mode for very large number of cells: the kernel between cells and control
+            points is never stored but recomputed for batch_size cells at a time to accumulate the M x M normal
+            equations of the M-step, which are solved with a Cholesky factorization. The iterations stop early when the
+            energy change rate drops below ecr, as in the default mode. Not supported with div_cur_free_kernels.
 
     Returns
     -------
@@ -119,10 +121,20 @@ def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, l
     ctrl_pts = tmp_X[idx, :]
     # ctrl_pts = X[range(500), :]
 
+    if batch_size is not None and div_cur_free_kernels is not False:
+        raise Exception('The low memory mode (batch_size) is not supported with div_cur_free_kernels.')
+
     K = con_K(ctrl_pts, ctrl_pts, beta) if div_cur_free_kernels is False else con_K_div_cur_free(ctrl_pts, ctrl_pts)[0]
+    if batch_size is not None:
+        M = ctrl_pts.shape[0]
+        C, V, P, sigma2 = _SparseVFC_batch(X, Y, ctrl_pts, K, batch_size, a, beta, ecr, gamma, lambda_, minP, MaxIter, theta)
+        grid_V = None if Grid is None else con_K_dot(Grid, ctrl_pts, beta, C)
+
+        return {"X": ctrl_pts, "Y": Y, "beta": beta, "V": V, "C": C, "P": P, "VFCIndex": np.where(P > theta)[0], "sigma2": sigma2, "grid": Grid, "grid_V": grid_V}
+
     U = con_K(X, ctrl_pts, beta) if div_cur_free_kernels is False else con_K_div_cur_free(X, ctrl_pts)[0]
-    if Grid is not None:
-        grid_U = con_K(Grid, ctrl_pts, beta) if div_cur_free_kernels is False else con_K_div_cur_free(Grid, ctrl_pts)[0]
+    if Grid is not None and div_cur_free_kernels is not False:
+        grid_U = con_K_div_cur_free(Grid, ctrl_pts)[0]
     M = ctrl_pts.shape[0]
 
     # Initialization
@@ -165,16 +177,79 @@ def SparseVFC(X, Y, Grid, M = 100, a = 5, beta = 0.1, ecr = 1e-5, gamma = 0.9, l
 
     grid_V = None
     if Grid is not None:
-        grid_V = np.dot(grid_U, C)
+        grid_V = con_K_dot(Grid, ctrl_pts, beta, C) if grid_U is None else np.dot(grid_U, C)
 
     VecFld = {"X": ctrl_pts, "Y": Y, "beta": beta, "V": V, "C": C, "P": P, "VFCIndex": np.where(P > theta)[0], "sigma2": sigma2, "grid": Grid, "grid_V": grid_V}
 
     return VecFld
 
 
-def con_K(x, y, beta):
+def _SparseVFC_batch(X, Y, ctrl_pts, K, batch_size, a, beta, ecr, gamma, lambda_, minP, MaxIter, theta):
+    """The low memory EM iterations of SparseVFC. The kernel U between the cells and the control points is never
+    stored: each iteration does the E-step on all cells from the velocities V = U C (computed in batches by con_K_dot),
+    so the results do not depend on batch_size, and then streams the cells in batches to accumulate the weighted normal
+    equations U^T diag(P) U and U^T diag(P) Y, so that only M x M and M x D matrices are kept. sigma2 is obtained from
+    the accumulated quantities.
+
+    Returns
+    -------
+    A tuple of the coefficients C, the velocities V = U.dot(C) on X, the posterior probability P and sigma2.
+    """
+    N, D = Y.shape
+    M = ctrl_pts.shape[0]
+    batches = [slice(i, i + batch_size) for i in range(0, N, batch_size)]
+
+    C = np.zeros((M, D))
+    iter, tecr, E = 1, 1, 1
+    sigma2 = np.sum(Y**2) / (N * D)
+
+    while iter < MaxIter and tecr > ecr and sigma2 > 1e-8:
+        # E_step
+        E_old = E
+        V = con_K_dot(X, ctrl_pts, beta, C, max_mem=batch_size * M * 8) if np.any(C) else np.zeros((N, D))
+        P, E = get_P(Y, V, sigma2, gamma, a)
+        P = np.maximum(P, minP)
+
+        UPU, UPY, PYY = np.zeros((M, M)), np.zeros((M, D)), 0
+        for idx in batches:
+            U = con_K(X[idx], ctrl_pts, beta).reshape((-1, M))
+            # accumulate the normal equations by weighting the rows of U with P
+            PU = U * P[idx, None]
+            UPU += PU.T.dot(U)
+            UPY += PU.T.dot(Y[idx])
+            PYY += P[idx].dot(np.sum(Y[idx]**2, 1))
+
+        E = E + lambda_ / 2 * np.trace(C.T.dot(K).dot(C))
+        tecr = abs((E - E_old) / E)
+
+        # M-step. Solve linear system for C.
+        A = UPU + lambda_ * sigma2 * K
+        try:
+            C = scipy.linalg.cho_solve(scipy.linalg.cho_factor(A), UPY)
+        except np.linalg.LinAlgError:
+            C = scipy.linalg.lstsq(A, UPY)[0]
+
+        # Update sigma**2 with sum(P * ||Y - U C||^2) = sum(P * ||Y||^2) - 2 tr(C^T U^T P Y) + tr(C^T U^T P U C)
+        Sp = np.sum(P)
+        sigma2 = max(PYY - 2 * np.sum(C * UPY) + np.sum(C * UPU.dot(C)), 0) / (Sp * D)
+
+        # Update gamma
+        numcorr = len(np.where(P > theta)[0])
+        gamma = min(max(numcorr / N, 0.05), 0.95)
+
+        iter += 1
+
+    V = con_K_dot(X, ctrl_pts, beta, C, max_mem=batch_size * M * 8)
+
+    return C, V, P, sigma2
+
+
+def con_K(x, y, beta, dtype=None):
     """Con_K constructs the kernel K, where K(i, j) = k(x, y) = exp(-beta * ||x - y||^2).
 
+    The squared distances are computed with the expansion ||x||^2 + ||y||^2 - 2 x y^T (one matrix product) directly in
+    the output array, so no n x d x m temporary is created.
+
     Arguments
     ---------
         x: 'np.ndarray'
@@ -183,6 +258,8 @@ def con_K(x, y, beta):
             Control points used to build kernel basis functions.
         beta: 'float' (default: 0.1)
             Paramerter of Gaussian Kernel, k(x, y) = exp(-beta*||x-y||^2),
+        dtype: 'np.dtype' or None (default: None)
+            The data type of the kernel, for example np.float32 to halve the memory. Defaults to float64.
 
     Returns
     -------
@@ -190,17 +267,59 @@ def con_K(x, y, beta):
     the kernel to represent the vector field function.
     """
 
-    n, d = x.shape
-    m, d = y.shape
+    dtype = np.float64 if dtype is None else dtype
+    x, y = np.atleast_2d(x), np.atleast_2d(y)
 
-    # https://stackoverflow.com/questions/1721802/what-is-the-equivalent-of-matlabs-repmat-in-numpy
-    # https://stackoverflow.com/questions/12787475/matlabs-permute-in-python
-    K = np.matlib.tile(x[:, :, None], [1, 1, m]) - np.transpose(np.matlib.tile(y[:, :, None], [1, 1, n]), [2, 1, 0])
-    K = np.squeeze(np.sum(K**2, 1))
-    K = - beta * K
-    K = np.exp(K) #
+    # center both sets of points to reduce the cancellation error of the expansion
+    center = y.mean(0)
+    x, y = (x - center).astype(dtype, copy=False), (y - center).astype(dtype, copy=False)
 
-    return K
+    K = np.dot(x, y.T)
+    K *= -2
+    K += np.sum(x**2, 1)[:, None]
+    K += np.sum(y**2, 1)[None, :]
+    np.maximum(K, 0, out=K)
+    K *= - beta
+    np.exp(K, out=K)
+
+    return np.squeeze(K)
+
+
+def con_K_dot(x, y, beta, C, dtype=None, max_mem=2**28):
+    """Compute con_K(x, y, beta).dot(C) in chunks of rows of x, so that at most max_mem bytes of kernel are held in
+    memory at once. This is used to evaluate the vector field on many points (cells or grid points).
+
+    Arguments
+    ---------
+        x: 'np.ndarray'
+            The points where the vector field is evaluated.
+        y: 'np.ndarray'
+            Control points used to build kernel basis functions.
+        beta: 'float'
+            Paramerter of Gaussian Kernel, k(x, y) = exp(-beta*||x-y||^2),
+        C: 'np.ndarray'
+            The coefficients of the kernel basis functions.
+        dtype: 'np.dtype' or None (default: None)
+            The data type of the kernel, see `con_K`.
+        max_mem: 'int' (default: 2**28)
+            The memory budget (in bytes) of the kernel block computed at once.
+
+    Returns
+    -------
+    V: 'np.ndarray'
+    The n x d vector field values on x.
+    """
+
+    x, y = np.atleast_2d(x), np.atleast_2d(y)
+    C = np.asarray(C).reshape((y.shape[0], -1))
+    n, m = x.shape[0], y.shape[0]
+    chunk_size = int(max(1, max_mem // (m * np.dtype(np.float64 if dtype is None else dtype).itemsize)))
+
+    V = np.zeros((n, C.shape[1]), dtype=np.result_type(C.dtype, np.float64 if dtype is None else dtype))
+    for i in range(0, n, chunk_size):
+        V[i:i + chunk_size] = con_K(x[i:i + chunk_size], y, beta, dtype=dtype).reshape((-1, m)).dot(C)
+
+    return V
 
 
 def get_P(Y, V, sigma2, gamma, a):
@@ -230,7 +349,8 @@ def get_P(Y, V, sigma2, gamma, a):
     D = Y.shape[1]
     temp1 = np.exp(-np.sum((Y - V)**2, 1) / (2 * sigma2))
     temp2 = (2 * np.pi * sigma2)**(D/2) * (1 - gamma) / (gamma * a)
-    temp1[temp1==0] = np.min(temp1[temp1!=0])
+    # replace underflowed likelihoods by the smallest non-zero one (or the smallest positive float if all underflowed)
+    temp1[temp1==0] = np.min(temp1[temp1!=0]) if np.any(temp1) else np.finfo(float).tiny
     P = temp1 / (temp1 + temp2)
     E = P.T.dot(np.sum((Y - V)**2, 1)) / (2 * sigma2) + np.sum(P) * np.log(sigma2) * D / 2
 
@@ -254,7 +374,10 @@ def VectorField(adata, basis='trimap', grid_velocity=False, grid_num=50, velocit
             grids) on 32 G memory computer. Although grid velocity may not be generated, the vector field function can still
             be learned for thousands of dimensions and we can still predict the transcriptomic cell states over long time period.
         grid_num: `int` (default: 50)
-            The number of grids in each dimension for generating the grid velocity.
+            The number of grids in each dimension for generating the grid velocity. The grid velocity is not computed
+            eagerly; only the bounds (`grid_domain`) and resolution (`grid_num`) of the grid are stored in the `VecFld`
+            dictionary and the velocities are computed in tiles when a region of the grid is requested (see
+            `get_grid_velocity`).
         velocity_key: `str` (default: `velocity_S`)
             The key from the adata layer that corresponds to the velocity matrix.
         method: `str` (default: `sparseVFC`)
@@ -275,22 +398,19 @@ def VectorField(adata, basis='trimap', grid_velocity=False, grid_num=50, velocit
     if issparse(X) and basis is 'X':
         X, V = X.A[:, adata.var.use_for_dynamo], V.A[:, adata.var.use_for_dynamo]
 
-    Grid = None
-    if X.shape[1] < 4 or grid_velocity:
-        # smart way for generating high dimensional grids and convert into a row matrix
-        min_vec, max_vec = X.min(0) - 0.01 * abs(X.min(0)), X.max(0) + 0.01 * abs(X.max(0))
-
-        Grid_list = np.meshgrid(*[np.linspace(i, j, grid_num) for i, j in zip(min_vec, max_vec)])
-        Grid = np.array([i.flatten() for i in Grid_list]).T
-
     if X is None:
         raise Exception(f'X is None. Make sure you passed the correct X or {basis} dimension reduction method.')
     elif V is None:
         raise Exception('V is None. Make sure you passed the correct V.')
 
-    VecFld = vectorfield(X, V, Grid, **kwargs)
+    VecFld = vectorfield(X, V, None, **kwargs)
     func = VecFld.fit(normalize=False, method=method)
 
+    if X.shape[1] < 4 or grid_velocity:
+        min_vec, max_vec = X.min(0) - 0.01 * abs(X.min(0)), X.max(0) + 0.01 * abs(X.max(0))
+        func['grid_domain'] = np.array([min_vec, max_vec]).T
+        func['grid_num'] = np.broadcast_to(grid_num, (X.shape[1],)).astype(int)
+
     if basis is not 'X':
         adata.uns['VecFld_' + basis] = func
     else:
@@ -300,7 +420,7 @@ def VectorField(adata, basis='trimap', grid_velocity=False, grid_num=50, velocit
 
 
 class vectorfield:
-    def __init__(self, X=None, V=None, Grid=None, M=100, a=5, beta=0.1, ecr=1e-5, gamma=0.9, lambda_=3, minP=1e-5, MaxIter=500, theta=0.75, div_cur_free_kernels=False):
+    def __init__(self, X=None, V=None, Grid=None, M=100, a=5, beta=0.1, ecr=1e-5, gamma=0.9, lambda_=3, minP=1e-5, MaxIter=500, theta=0.75, div_cur_free_kernels=False, batch_size=None):
         """Initialize the VectorField class.
 
         Parameters
@@ -335,11 +455,13 @@ class vectorfield:
         div_cur_free_kernels: `bool` (default: False)
             A logic flag to determine whether the divergence-free or curl-free kernels will be used for learning the vector
             field.
+        batch_size: `int` or None (default: None)
+            If not None, the number of cells streamed at a time in the low memory EM mode of SparseVFC.
         """
 
         self.data = {"X": X, "V": V, "Grid": Grid}
 
-        self.parameters = {'M': M, "a": a, "beta": beta, "ecr": ecr, "gamma": gamma, "lambda_": lambda_, "minP": minP, "MaxIter": MaxIter, "theta": theta, "div_cur_free_kernels": div_cur_free_kernels}
+        self.parameters = {'M': M, "a": a, "beta": beta, "ecr": ecr, "gamma": gamma, "lambda_": lambda_, "minP": minP, "MaxIter": MaxIter, "theta": theta, "div_cur_free_kernels": div_cur_free_kernels, "batch_size": batch_size}
         self.norm_dict = {}
 
     def fit(self, normalize = False, method='SparseVFC'):
@@ -371,7 +493,7 @@ class vectorfield:
             VecFld = SparseVFC(self.data['X'], self.data['V'], self.data['Grid'], M = self.parameters['M'], a = self.parameters['a'],
                                beta = self.parameters['beta'], ecr = self.parameters['ecr'], gamma = self.parameters['gamma'],
                                lambda_ = self.parameters['lambda_'], minP = self.parameters['minP'], MaxIter = self.parameters['MaxIter'],
-                               theta = self.parameters['theta'])
+                               theta = self.parameters['theta'], batch_size = self.parameters['batch_size'])
 
         return VecFld
 
@@ -496,10 +618,238 @@ def vector_field_function(x, t, VecFld):
     Reference: Regularized vector field learning with sparse approximation for mismatch removal, Ma, Jiayi, etc. al, Pattern Recognition
     """
     x=np.array(x).reshape((1, -1))
-    if(len(x.shape) == 1):
-        x = x[None, :]
-    K= con_K(x, VecFld['X'], VecFld['beta'])
-
-    K = K.dot(VecFld['C'])
+    K = con_K_dot(x, VecFld['X'], VecFld['beta'], VecFld['C'])[0]
 
     return K.T
+
+
+class KernelVectorField:
+    def __init__(self, VecFld, dtype=None, max_mem=2**28):
+        """A reusable evaluator of the vector field learned by SparseVFC, f(x) = sum_j exp(-beta * ||x - y_j||^2) C_j.
+        The control points y_j, coefficients C_j and their derived quantities are cached once, so the vector field, its
+        analytic Jacobian, divergence and curl can be evaluated in batch on many points.
+
+        Parameters
+        ----------
+            VecFld: `dict`
+                The dictionary returned by SparseVFC (or `adata.uns['VecFld']`) that includes the control points `X`, the
+                coefficients `C` and the kernel parameter `beta`.
+            dtype: `np.dtype` or None (default: None)
+                The data type of the kernel, see `con_K`.
+            max_mem: `int` (default: 2**28)
+                The memory budget (in bytes) of the kernel block computed at once.
+        """
+
+        self.beta, self.dtype, self.max_mem = VecFld['beta'], np.float64 if dtype is None else dtype, max_mem
+        self.C = np.asarray(VecFld['C'], dtype=np.float64)
+        Y = np.atleast_2d(VecFld['X'])
+        # coordinates are centered on the control points (distances are translation invariant)
+        self.center = Y.mean(0)
+        self.Y = (Y - self.center).astype(self.dtype)
+        self.Y2 = np.sum(self.Y**2, 1)
+        self.m, self.dim = self.Y.shape
+        # C_j y_j^T for the Jacobian and sum_i C_ji y_ji for the divergence
+        self.CY = (self.C[:, :, None] * self.Y[:, None, :]).reshape((self.m, -1))
+        self.CY_trace = np.sum(self.C * self.Y, 1)
+
+    def __call__(self, x, t=None):
+        """Evaluate the vector field with the same input / output conventions as `vector_field_function` in topology,
+        so that the object can be passed as the function of odeint, fsolve, fate, etc."""
+        x = np.asarray(x)
+        V = self.evaluate(x)
+        return V[0] if x.ndim == 1 else V
+
+    def _chunks(self, X):
+        X = np.atleast_2d(X)
+        chunk_size = int(max(1, self.max_mem // (self.m * np.dtype(self.dtype).itemsize)))
+        for i in range(0, X.shape[0], chunk_size):
+            x = (X[i:i + chunk_size] - self.center).astype(self.dtype, copy=False)
+            K = np.dot(x, self.Y.T)
+            K *= -2
+            K += np.sum(x**2, 1)[:, None]
+            K += self.Y2[None, :]
+            np.maximum(K, 0, out=K)
+            K *= - self.beta
+            np.exp(K, out=K)
+            yield slice(i, i + chunk_size), x, K
+
+    def evaluate(self, X):
+        """Evaluate the vector field on a n_obs x n_features matrix X. Returns a n_obs x n_features matrix."""
+        X = np.atleast_2d(X)
+        V = np.zeros((X.shape[0], self.C.shape[1]))
+        for idx, _, K in self._chunks(X):
+            V[idx] = K.dot(self.C)
+        return V
+
+    def jacobian(self, X):
+        """Compute the analytic Jacobian J_ik = df_i / dx_k = -2 beta sum_j K(x, y_j) C_ji (x_k - y_jk) of the vector field.
+
+        Arguments
+        ---------
+            X: 'np.ndarray'
+                A single point (1d array) or a n_obs x n_features matrix.
+
+        Returns
+        -------
+            J: 'np.ndarray'
+                The n_features x n_features Jacobian of a single point or the n_obs x n_features x n_features Jacobians.
+        """
+        X = np.asarray(X)
+        J = np.zeros((np.atleast_2d(X).shape[0], self.C.shape[1], self.dim))
+        for idx, x, K in self._chunks(X):
+            V = K.dot(self.C)
+            J[idx] = -2 * self.beta * (V[:, :, None] * x[:, None, :] - K.dot(self.CY).reshape((-1, self.C.shape[1], self.dim)))
+        return J[0] if X.ndim == 1 else J
+
+    def divergence(self, X):
+        """Compute the divergence (trace of the Jacobian) of the vector field on a single point or a set of points."""
+        X = np.asarray(X)
+        div = np.zeros(np.atleast_2d(X).shape[0])
+        for idx, x, K in self._chunks(X):
+            div[idx] = -2 * self.beta * (np.sum(K.dot(self.C) * x, 1) - K.dot(self.CY_trace))
+        return div[0] if X.ndim == 1 else div
+
+    def curl(self, X):
+        """Compute the curl of a two (scalar curl dv/dx - du/dy) or three (vector curl) dimensional vector field on a
+        single point or a set of points."""
+        J = np.atleast_3d(self.jacobian(np.atleast_2d(X)))
+        if self.dim == 2:
+            curl = J[:, 1, 0] - J[:, 0, 1]
+        elif self.dim == 3:
+            curl = np.array([J[:, 2, 1] - J[:, 1, 2], J[:, 0, 2] - J[:, 2, 0], J[:, 1, 0] - J[:, 0, 1]]).T
+        else:
+            raise Exception('curl is only defined for two or three dimensional vector fields.')
+        return curl[0] if np.asarray(X).ndim == 1 else curl
+
+
+_LAZY_GRID_CACHE = OrderedDict()
+_LAZY_GRID_CACHE_SIZE = 4
+
+
+class LazyGridVelocity:
+    def __init__(self, VecFld, domain, grid_num=50, tile_size=None):
+        """A grid of the vector field whose velocities are computed in tiles only when a region of the grid is requested.
+        The computed tiles are cached, so repeated or overlapping requests at the same resolution are free. This avoids
+        materializing the grid_num^d grid points in high dimensions.
+
+        Parameters
+        ----------
+            VecFld: `dict`
+                The dictionary returned by SparseVFC.
+            domain: `numpy.ndarray`
+                A n_features x 2 array of the lower and upper bounds of the grid in each dimension.
+            grid_num: `int` or `list` (default: 50)
+                The default number of grids in each dimension.
+            tile_size: `int` or None (default: None)
+                The number of grid points of a tile in each dimension. By default, it is chosen so that a tile has at
+                most 4096 grid points.
+        """
+
+        self.func = KernelVectorField(VecFld)
+        self.domain = np.asarray(domain, dtype=float)
+        self.dim = self.domain.shape[0]
+        self.grid_num = self._grid_num(grid_num)
+        self.tile_size = max(1, int(4096 ** (1 / self.dim) + 1e-8)) if tile_size is None else tile_size
+        self.tiles = {}
+
+    def _grid_num(self, grid_num):
+        return tuple(int(i) for i in np.broadcast_to(grid_num, (self.dim,)))
+
+    def axes(self, grid_num=None):
+        """The coordinates of the grid along each dimension."""
+        grid_num = self.grid_num if grid_num is None else self._grid_num(grid_num)
+        return [np.linspace(lo, hi, n) for (lo, hi), n in zip(self.domain, grid_num)]
+
+    def _tile(self, grid_num, axes, tile_idx):
+        key = (grid_num, tile_idx)
+        if key not in self.tiles:
+            sub_axes = [axis[i * self.tile_size:(i + 1) * self.tile_size] for axis, i in zip(axes, tile_idx)]
+            points = np.array([i.flatten() for i in np.meshgrid(*sub_axes, indexing='ij')]).T
+            self.tiles[key] = self.func.evaluate(points).reshape([len(i) for i in sub_axes] + [-1])
+        return self.tiles[key]
+
+    def get(self, region=None, grid_num=None):
+        """Get the grid points and their velocities in a region of the grid.
+
+        Arguments
+        ---------
+            region: `numpy.ndarray` or None (default: None)
+                A n_features x 2 array of the lower and upper bounds of the requested region. The whole grid is returned
+                if it is None.
+            grid_num: `int`, `list` or None (default: None)
+                The resolution (number of grids in each dimension over the whole domain). Defaults to the grid_num used at
+                initialization.
+
+        Returns
+        -------
+            Grid: `numpy.ndarray`
+                The grid points (one point per row) in the same order as the flattened `np.meshgrid` of the axes.
+            V: `numpy.ndarray`
+                The velocities on the grid points.
+        """
+
+        grid_num = self.grid_num if grid_num is None else self._grid_num(grid_num)
+        axes = self.axes(grid_num)
+        region = self.domain if region is None else np.asarray(region, dtype=float)
+        bounds = [(np.searchsorted(axis, lo, 'left'), np.searchsorted(axis, hi, 'right')) for axis, (lo, hi) in zip(axes, region)]
+
+        V = np.zeros([i1 - i0 for i0, i1 in bounds] + [self.dim])
+        for tile_idx in np.ndindex(*[(i1 - 1) // self.tile_size - i0 // self.tile_size + 1 if i1 > i0 else 0 for i0, i1 in bounds]):
+            tile_idx = tuple(i0 // self.tile_size + i for (i0, _), i in zip(bounds, tile_idx))
+            tile = self._tile(grid_num, axes, tile_idx)
+            # the intersection of the tile with the requested region
+            src, dst = [], []
+            for (i0, i1), t in zip(bounds, tile_idx):
+                lo, hi = max(i0, t * self.tile_size), min(i1, (t + 1) * self.tile_size)
+                src.append(slice(lo - t * self.tile_size, hi - t * self.tile_size))
+                dst.append(slice(lo - i0, hi - i0))
+            V[tuple(dst)] = tile[tuple(src)]
+
+        sub_axes = [axis[i0:i1] for axis, (i0, i1) in zip(axes, bounds)]
+        Grid = np.array([i.flatten() for i in np.meshgrid(*sub_axes)]).T
+        # np.meshgrid uses the 'xy' indexing, i.e. the first two dimensions are swapped
+        V = np.swapaxes(V, 0, 1) if self.dim > 1 else V
+
+        return Grid, V.reshape((-1, self.dim))
+
+
+def _lazy_grid(VecFld):
+    """The (cached) `LazyGridVelocity` of a `VecFld` dictionary, keyed by the content of the vector field and grid."""
+    key = _fingerprint(np.hstack([np.ravel(VecFld[i]) for i in ['X', 'C', 'beta', 'grid_domain', 'grid_num']]))
+    if key in _LAZY_GRID_CACHE:
+        _LAZY_GRID_CACHE.move_to_end(key)
+    else:
+        _LAZY_GRID_CACHE[key] = LazyGridVelocity(VecFld, VecFld['grid_domain'], VecFld['grid_num'])
+        if len(_LAZY_GRID_CACHE) > _LAZY_GRID_CACHE_SIZE:
+            _LAZY_GRID_CACHE.popitem(last=False)
+    return _LAZY_GRID_CACHE[key]
+
+
+def get_grid_velocity(VecFld, region=None, grid_num=None):
+    """Get the grid points and the grid velocities of a learned vector field, either stored in the `grid` and `grid_V`
+    keys or computed on demand from the `grid_domain` and `grid_num` keys of the `VecFld` dictionary. The computed tiles
+    of the grid are cached for the few most recently used vector fields.
+
+    Arguments
+    ---------
+        VecFld: `dict`
+            The dictionary returned by `VectorField` (`adata.uns['VecFld_' + basis]`).
+        region: `numpy.ndarray` or None (default: None)
+            A n_features x 2 array of the lower and upper bounds of the requested region, see `LazyGridVelocity.get`.
+        grid_num: `int`, `list` or None (default: None)
+            The resolution of the grid, see `LazyGridVelocity.get`.
+
+    Returns
+    -------
+        Grid: `numpy.ndarray`
+            The grid points.
+        V: `numpy.ndarray`
+            The velocities on the grid points.
+    """
+
+    if region is None and grid_num is None and VecFld.get('grid_V') is not None:
+        return VecFld['grid'], VecFld['grid_V']
+    if VecFld.get('grid_domain') is None:
+        raise Exception('The grid velocity is not available. Run VectorField with grid_velocity=True.')
+
+    return _lazy_grid(VecFld).get(region, grid_num)
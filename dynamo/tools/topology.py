@@ -5,7 +5,7 @@ from scipy.optimize import fsolve
 from scipy.spatial.distance import pdist
 from scipy.linalg import eig
 from scipy.integrate import odeint
-from .scVectorField import con_K
+from .scVectorField import con_K_dot
 
 def vector_field_function(x, VecFld, dim=None):
     """Learn an analytical function of vector field from sparse single cell samples on the entire space robustly.
@@ -15,13 +15,11 @@ def vector_field_function(x, VecFld, dim=None):
     x = np.array(x)
     if (x.ndim == 1):
         x = x[None, :]
-    K = con_K(x, VecFld['X'], VecFld['beta'])
+    C = VecFld['C'] if dim is None else VecFld['C'][:, dim]
+    K = con_K_dot(x, VecFld['X'], VecFld['beta'], C)
+    K = K[0] if K.shape[0] == 1 else K
 
-    if dim is None:
-        K = K.dot(VecFld['C'])
-    else:
-        K = K.dot(VecFld['C'][:, dim])
-    return K
+    return K if dim is None or np.ndim(dim) > 0 else K[..., 0]
 
 
 def index_condensed_matrix(n, i, j):
@@ -64,16 +62,21 @@ def find_fixed_points(X0, func_vf, tol_redundant=1e-4, full_output=False):
     X = []
     J = []
     fval = []
+    # use the analytic Jacobian if the vector field provides one (e.g. KernelVectorField)
+    fprime = func_vf.jacobian if hasattr(func_vf, 'jacobian') else None
     for x0 in X0:
         if full_output:
-            x, info_dict, _, _ = fsolve(func_vf, x0, full_output=True)
+            x, info_dict, _, _ = fsolve(func_vf, x0, fprime=fprime, full_output=True)
             fval.append(info_dict['fvec'])
             # compute Jacobian
-            Q = info_dict['fjac']
-            R = form_triu_matrix(info_dict['r'])
-            J.append(Q.T @ R)
+            if fprime is None:
+                Q = info_dict['fjac']
+                R = form_triu_matrix(info_dict['r'])
+                J.append(Q.T @ R)
+            else:
+                J.append(fprime(x))
         else:
-            x = fsolve(func_vf, x0)
+            x = fsolve(func_vf, x0, fprime=fprime)
         X.append(x)
     X = np.array(X)
     if full_output:
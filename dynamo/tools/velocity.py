@@ -1,4 +1,5 @@
 import numpy as np
+from functools import partial
 from scipy.optimize import least_squares
 from scipy.sparse import issparse, csr_matrix
 from warnings import warn
@@ -223,6 +224,161 @@ def fit_linreg(x, y, intercept=False):
     r2 = 1 - SS_res_n / SS_tot_n
     return k, b, r2
 
+def _fit_linreg_rows(x, y, intercept=False):
+    """Row-wise version of `fit_linreg` that fits y = kx + b for each row of two (genes x samples) arrays at once."""
+    mask = np.logical_and(~np.isnan(x), ~np.isnan(y))
+    x, y = np.where(mask, x, 0), np.where(mask, y, 0)
+    n = mask.sum(1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xm, ym = x.sum(1) / n, y.sum(1) / n
+        if intercept:
+            cov = (x * y).sum(1) / n - xm * ym
+            var_x = (x * x).sum(1) / n - xm * xm
+            k = cov / var_x
+            b = ym - k * xm
+        else:
+            k = ym / xm
+            b = np.zeros_like(k)
+
+        SS_tot_n = (np.where(mask, y - ym[:, None], 0) ** 2).sum(1) / n
+        SS_res_n = (np.where(mask, y - k[:, None] * x - b[:, None], 0) ** 2).sum(1) / n
+        r2 = 1 - SS_res_n / SS_tot_n
+    return k, b, r2
+
+def _extreme_inds_sparse(U, S, i_left, i_right, normalize=True):
+    """Select the extreme cells of each gene from sparse U, S and gather them into padded (genes x cells) arrays.
+
+    The stored entries of U and S are aligned on the union of their sparsity patterns and sorted within each gene by
+    (su, cell index). Each implicit zero is ranked as a value of zero at its cell index, so that the selected cells are
+    the same as the stable `np.argsort(su)[mask]` in `estimation.fit_gamma_steady_state`. Selected implicit zeros are
+    represented by the zero padding of the output.
+    """
+    U, S = csr_matrix(U), csr_matrix(S)
+    n_genes, n_cells = U.shape
+
+    keys_u = np.repeat(np.arange(n_genes, dtype=np.int64), np.diff(U.indptr)) * n_cells + U.indices
+    keys_s = np.repeat(np.arange(n_genes, dtype=np.int64), np.diff(S.indptr)) * n_cells + S.indices
+    keys = np.sort(np.concatenate((keys_u, keys_s)), kind='stable') # merging two sorted runs is close to linear
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    u, s = np.zeros(len(keys)), np.zeros(len(keys))
+    u[np.searchsorted(keys, keys_u)], s[np.searchsorted(keys, keys_s)] = U.data, S.data
+    rows = keys // n_cells
+
+    if normalize:
+        max_u, max_s = U.max(1).A.flatten(), S.max(1).A.flatten()
+        su = s / np.clip(max_s, 1e-3, None)[rows] + u / np.clip(max_u, 1e-3, None)[rows]
+    else:
+        su = s + u
+
+    nnz = np.bincount(rows, minlength=n_genes)
+    start = np.concatenate(([0], np.cumsum(nnz)[:-1]))
+    # stored entries of value zero tie with the implicit zeros, and are ranked among them by their cell index
+    nonzero = su != 0
+    n_nonzero_before = np.cumsum(nonzero) - nonzero - np.concatenate(([0], np.cumsum(nonzero)))[start][rows]
+    zero_rank = np.bincount(rows, weights=su < 0, minlength=n_genes)[rows].astype(np.int64) + keys % n_cells - \
+        n_nonzero_before
+
+    # sort the entries by gene and then by su, with ties kept in cell order (the entries are sorted by gene and cell):
+    # a single integer key is much faster than np.lexsort
+    global_rank = np.empty(len(su), dtype=np.int64)
+    global_rank[np.argsort(su, kind='stable')] = np.arange(len(su))
+    order = np.argsort(rows * len(su) + global_rank)
+    rows, u, s, su, zero_rank = rows[order], u[order], s[order], su[order], zero_rank[order]
+
+    # rank of each stored entry among all the cells of its gene: implicit zeros sit right after the negative entries
+    rank = np.arange(len(rows)) - start[rows]
+    rank = np.where(su < 0, rank, np.where(su == 0, zero_rank, rank + (n_cells - nnz)[rows]))
+    sel = np.logical_or(rank < i_left, rank >= i_right)
+
+    rows, u, s = rows[sel], u[sel], s[sel]
+    n_sel = np.bincount(rows, minlength=n_genes)
+    pos = np.arange(len(rows)) - np.concatenate(([0], np.cumsum(n_sel)[:-1]))[rows]
+    m = i_left + n_cells - i_right
+    u_ext, s_ext = np.zeros((n_genes, m)), np.zeros((n_genes, m))
+    u_ext[rows, pos], s_ext[rows, pos] = u, s
+
+    return u_ext, s_ext
+
+def solve_gamma_steady_state(U, S, intercept=True, perc_left=5, perc_right=5, normalize=True, chunk_size=None):
+    """Estimate gamma of all genes at once using linear regression based on the steady state assumption.
+
+    This is a vectorized version of `estimation.fit_gamma_steady_state`. For each gene, the cells in the left and right
+    tails of the (normalized) u + s are picked with a partitioned sort instead of a full sort, and the slope, intercept and
+    r-squared of all genes are calculated with a few array reductions. For sparse U and S with a low density, only the
+    stored entries are sorted and the selected implicit zeros are accounted for analytically; otherwise the genes are
+    densified chunk by chunk. Both this and the per-gene fit order the cells by (su, cell index), so that cells tied at
+    a tail boundary (common for integer counts) are picked in the same way and the results agree.
+
+    Arguments
+    ---------
+    U: :class:`~numpy.ndarray` or sparse `csr_matrix`
+        A matrix of unspliced mRNA counts. Dimension: genes x cells.
+    S: :class:`~numpy.ndarray` or sparse `csr_matrix`
+        A matrix of spliced mRNA counts. Dimension: genes x cells.
+    intercept: bool
+        If using steady state assumption for fitting, then:
+        True -- the linear regression is performed with an unfixed intercept;
+        False -- the linear regresssion is performed with a fixed zero intercept.
+    perc_left: float
+        The percentage of samples included in the linear regression in the left tail. If set to None, then all the samples are included.
+    perc_right: float
+        The percentage of samples included in the linear regression in the right tail. If set to None, then all the samples are included.
+    normalize: bool
+        Whether to first normalize u and s by their maximum before selecting the extreme cells.
+    chunk_size: int or None (default: None)
+        The number of genes processed at once for dense input. If None, it is chosen so that each chunk has about 1e7 elements.
+
+    Returns
+    -------
+    k: :class:`~numpy.ndarray`
+        The slopes of the linear regression models, which are gammas under the steady state assumption.
+    b: :class:`~numpy.ndarray`
+        The intercepts of the linear regression models.
+    r2: :class:`~numpy.ndarray`
+        Coefficients of determination or r square.
+    """
+    n_genes, n = U.shape
+
+    i_left = int(perc_left/100.0*n) if perc_left is not None else n
+    i_right = int((100-perc_right)/100.0*n) if perc_right is not None else 0
+    use_all = i_left >= i_right
+
+    if issparse(U) and issparse(S) and not use_all and (U.nnz + S.nnz) < 0.2 * n_genes * n:
+        u, s = _extreme_inds_sparse(U, S, i_left, i_right, normalize)
+        return _fit_linreg_rows(s, u, intercept)
+
+    if chunk_size is None: chunk_size = max(1, int(1e7 // max(1, n)))
+    k, b, r2 = np.zeros(n_genes), np.zeros(n_genes), np.zeros(n_genes)
+    for start in range(0, n_genes, chunk_size):
+        end = min(start + chunk_size, n_genes)
+        u = U[start:end].A if issparse(U) else np.asarray(U[start:end], dtype=float)
+        s = S[start:end].A if issparse(S) else np.asarray(S[start:end], dtype=float)
+
+        if not use_all:
+            if normalize:
+                su = s / np.clip(np.max(s, 1), 1e-3, None)[:, None]
+                su += u / np.clip(np.max(u, 1), 1e-3, None)[:, None]
+            else:
+                su = s + u
+            sel = np.zeros(su.shape, dtype=bool)
+            # the cells below (above) the boundary value of the left (right) tail, and the first (last) of the cells tied
+            # at the boundary in cell order, as the stable sort on su does
+            if i_left > 0:
+                v = np.partition(su, i_left - 1, axis=1)[:, i_left - 1:i_left]
+                n_tied = i_left - (su < v).sum(1, keepdims=True)
+                sel |= (su < v) | ((su == v) & (np.cumsum(su == v, 1) <= n_tied))
+            if i_right < n:
+                v = np.partition(su, i_right, axis=1)[:, i_right:i_right + 1]
+                n_tied = n - i_right - (su > v).sum(1, keepdims=True)
+                sel |= (su > v) | ((su == v) & (np.cumsum((su == v)[:, ::-1], 1)[:, ::-1] <= n_tied))
+            m = i_left + n - i_right
+            u, s = u[sel].reshape((end - start, m)), s[sel].reshape((end - start, m))
+
+        k[start:end], b[start:end], r2[start:end] = _fit_linreg_rows(s, u, intercept)
+
+    return k, b, r2
+
 def fit_first_order_deg_lsq(t, l, bounds=(0, np.inf), fix_l0=False, beta_0=1):
     """Estimate beta with degradation data using least squares method.
 
@@ -556,8 +712,138 @@ def concat_time_series_matrices(mats, t=None):
     else:
         return ret_mat
 
+def _fit_gene_chunk(fit_func, genes, gene_args, args, kwargs):
+    """Apply `fit_func` to a chunk of genes. The i-th row (or element) of each of `gene_args` is passed for gene i."""
+    return [fit_func(*[a[i] for a in gene_args], *args, **kwargs) for i in genes]
+
+def gene_wise_fit(fit_func, n, gene_args, args=(), kwargs=None, n_jobs=1, backend='loky'):
+    """Apply a per-gene fitting function to all genes, optionally sharded across a pool of workers.
+
+    Genes are split into contiguous chunks (one per worker) and the results are concatenated in the gene order, so the
+    output does not depend on `n_jobs` or `backend`. With process based backends, joblib memory-maps the large numpy
+    arrays (including the buffers of sparse matrices) in `gene_args`, so that all workers share a read-only view of the
+    data instead of receiving a copy.
+
+    Arguments
+    ---------
+    fit_func: `function`
+        A picklable (i.e. module level) function that fits a single gene, called as
+        `fit_func(*[a[i] for a in gene_args], *args, **kwargs)`.
+    n: `int`
+        The number of genes.
+    gene_args: `tuple`
+        A tuple of gene x cell matrices or gene vectors, indexed by gene.
+    args: `tuple` (default: ())
+        Additional positional arguments shared by all genes.
+    kwargs: `dict` or None (default: None)
+        Additional keyword arguments shared by all genes.
+    n_jobs: `int` (default: 1)
+        The number of workers. 1 runs the fits serially in the current process; -1 uses all cores.
+    backend: `str` (default: `loky`)
+        The joblib backend, either a process based backend (`loky` or `multiprocessing`) or `threading`.
+
+    Returns
+    -------
+    res: `list`
+        A list of length n with the return value of `fit_func` for each gene.
+    """
+    kwargs = {} if kwargs is None else kwargs
+    if n_jobs == 1 or n < 2:
+        return _fit_gene_chunk(fit_func, range(n), gene_args, args, kwargs)
+
+    from joblib import Parallel, delayed, effective_n_jobs
+
+    chunks = np.array_split(np.arange(n), min(n, effective_n_jobs(n_jobs)))
+    res = Parallel(n_jobs=n_jobs, backend=backend, max_nbytes='1M', mmap_mode='r')(
+        delayed(_fit_gene_chunk)(fit_func, c, gene_args, args, kwargs) for c in chunks)
+    return [r for chunk in res for r in chunk]
+
+def _fit_beta_gamma_lsq_gene(u, s, t):
+    """Estimate beta and gamma of a single gene with degradation data, see `estimation.fit_beta_gamma_lsq`."""
+    beta, u0 = fit_first_order_deg_lsq(t, u)
+    if np.isfinite(u0):
+        gamma, s0 = fit_gamma_lsq(t, s, beta, u0)
+    else:
+        gamma, s0 = np.nan, np.nan
+    return beta, gamma, u0, s0
+
+def _fit_gamma_nosplicing_lsq_gene(l, t):
+    """Estimate gamma and l0 of a single gene without splicing data, see `estimation.fit_gamma_nosplicing_lsq`."""
+    l = l.A[0] if issparse(l) else l
+    return fit_first_order_deg_lsq(t, l)
+
+def _fit_alpha_oneshot_gene(u, beta, t, clusters):
+    """Estimate alpha of a single gene for each cluster with one-shot data, see `estimation.fit_alpha_oneshot`."""
+    u = u.A.flatten() if issparse(u) else u
+    return np.array([fit_alpha_synthesis(t, u[c], beta) if len(c) > 0 else np.nan for c in clusters])
+
+def _solve_alpha_mix_std_stm_gene(l, alpha_std, beta, t, t_uniq, t_max):
+    """Solve the stimulation transcription rate of a single gene at each time point, see `estimation.solve_alpha_mix_std_stm`."""
+    l = l.A.flatten() if issparse(l) else l
+    return np.array([solve_alpha_2p(t_max - t_uniq[t_ind], t_uniq[t_ind], alpha_std, beta, l[t == t_uniq[t_ind]])
+                     for t_ind in np.arange(1, len(t_uniq))])
+
+def _cell_wise_param(param, t, n_cells):
+    """Reshape a kinetic parameter so that it can be broadcast against a (genes x cells) matrix.
+
+    Returns
+    -------
+    p: :class:`~numpy.ndarray`
+        A genes x 1 (per gene), genes x n_time_points (per time point) or genes x cells (per cell) matrix.
+    cols: :class:`~numpy.ndarray` or None
+        For per time point parameters, the column of p that each cell uses. None otherwise.
+    """
+    p = np.asarray(param)
+    if p.ndim == 1:
+        return p[:, None], None
+    # per time point parameters take precedence, as there may be as many time points as cells
+    if t is not None:
+        t_uniq, cols = np.unique(t, return_inverse=True)
+        if p.shape[1] == len(t_uniq) and len(t_uniq) > 1:
+            return p, cols
+    if p.shape[1] == n_cells:
+        return p, None
+    if p.shape[1] != 1:
+        raise Exception('The kinetic parameter should be specified for each gene, each time point or each cell.')
+    return p, None
+
+def _scale_by_param(param, X, t=None, dtype=None):
+    """Calculate param * X for a (genes x cells) matrix X without repeating param across cells.
+
+    Sparse X stays sparse: only the stored entries are scaled by the parameter of their gene (and cell or time point).
+    """
+    p, cols = _cell_wise_param(param, t, X.shape[1])
+    dtype = np.result_type(p.dtype, X.dtype) if dtype is None else dtype
+    p = p.astype(dtype, copy=False)
+
+    if issparse(X):
+        Y = csr_matrix(X, dtype=dtype, copy=True)
+        rows = np.repeat(np.arange(Y.shape[0]), np.diff(Y.indptr))
+        if p.shape[1] == 1:
+            Y.data *= p[rows, 0]
+        else:
+            Y.data *= p[rows, Y.indices if cols is None else cols[Y.indices]]
+        return Y
+
+    X = np.asarray(X, dtype=dtype)
+    if cols is None:
+        return p * X
+    Y = np.empty(X.shape, dtype=dtype)
+    for i in range(p.shape[1]):
+        cell_inds = cols == i
+        Y[:, cell_inds] = p[:, i:i + 1] * X[:, cell_inds]
+    return Y
+
+def _subtract(A, B):
+    """A - B for two (genes x cells) matrices of which either can be sparse. The result is sparse only if both are."""
+    if issparse(A) and issparse(B):
+        return A - B
+    A = A.A if issparse(A) else A
+    B = B.A if issparse(B) else B
+    return A - B
+
 class velocity:
-    def __init__(self, alpha=None, beta=None, gamma=None, eta=None, delta=None, t=None, estimation=None):
+    def __init__(self, alpha=None, beta=None, gamma=None, eta=None, delta=None, t=None, estimation=None, dtype=None):
         """The class that computes RNA/protein velocity given unknown parameters.
 
         Arguments
@@ -576,6 +862,9 @@ class velocity:
             A vector of the measured time points for cells
         estimation: :class:`~estimation`
             An instance of the estimation class. If this not None, the parameters will be taken from this class instead of the input arguments.
+        dtype: `numpy.dtype` or None (default: None)
+            The dtype of the calculated velocities, for example `np.float32` to halve the memory. If None, the dtype is
+            inferred from the parameters and the input data.
         """
         if estimation is not None:
             self.parameters = {}
@@ -587,6 +876,7 @@ class velocity:
             self.parameters['t'] = estimation.t
         else:
             self.parameters = {'alpha': alpha, 'beta': beta, 'gamma': gamma, 'eta': eta, 'delta': delta, 't': t}
+        self.dtype = dtype
 
     def vel_u(self, U):
         """Calculate the unspliced mRNA velocity.
@@ -598,46 +888,26 @@ class velocity:
 
         Returns
         -------
-        V: :class:`~numpy.ndarray` or sparse `csr_matrix`
-            Each column of V is a velocity vector for the corresponding cell. Dimension: genes x cells.
+        V: :class:`~numpy.ndarray`
+            Each column of V is a velocity vector for the corresponding cell. Dimension: genes x cells. V is dense also
+            for a sparse U, since alpha - beta * U is non-zero wherever alpha is.
         """
 
         t = self.parameters['t']
-        t_uniq, t_uniq_cnt = np.unique(self.parameters['t'], return_counts=True)
         if self.parameters['alpha'] is not None and self.parameters['beta'] is not None:
-            if type(self.parameters['alpha']) is not tuple:
-                if self.parameters['alpha'].shape[1] == U.shape[1]:
-                    alpha = self.parameters['alpha']
-                elif self.parameters['alpha'].shape[1] == len(t_uniq) and len(t_uniq) > 1:
-                    alpha = np.zeros(U.shape)
-                    for i in range(len(t_uniq)):
-                        cell_inds = t == t_uniq[i]
-                        alpha[:, cell_inds] = np.repeat(self.parameters['alpha'][:, i], t_uniq_cnt[i], axis=1)
-                else:
-                    alpha = np.repeat(self.parameters['alpha'], U.shape[1], axis=1)
-            else: # need to correct the velocity vector prediction when you use mix_std_stm experiments
-                if self.parameters['alpha'][1].shape[1] == U.shape[1]:
-                    alpha = self.parameters['alpha'][1]
-                elif self.parameters['alpha'][1].shape[1] == len(t_uniq) and len(t_uniq) > 1:
-                    alpha = np.zeros(U.shape)
-                    for i in range(len(t_uniq)):
-                        cell_inds = t == t_uniq[i]
-                        alpha[:, cell_inds] = np.repeat(self.parameters['alpha'][1][:, i].reshape(-1, 1), t_uniq_cnt[i], axis=1)
-                else:
-                    alpha = np.repeat(self.parameters['alpha'][1], U.shape[1], axis=1)
-
-            if len(self.parameters['beta'].shape) == 1:
-                beta = np.repeat(self.parameters['beta'].reshape((-1, 1)), U.shape[1], axis=1)
-            elif self.parameters['beta'].shape[1] == len(t_uniq) and len(t_uniq) > 1:
-                beta = np.zeros_like(U.shape)
-                for i in range(len(t_uniq)):
-                    cell_inds = t == t_uniq[i]
-                    beta[:, cell_inds] = np.repeat(self.parameters['beta'][:, i].reshape(-1, 1), t_uniq_cnt[i], axis=1)
+            # need to correct the velocity vector prediction when you use mix_std_stm experiments
+            alpha = self.parameters['alpha'] if type(self.parameters['alpha']) is not tuple else self.parameters['alpha'][1]
+            alpha, cols = _cell_wise_param(alpha, t, U.shape[1])
+            alpha = alpha if cols is None else alpha[:, cols]
+
+            beta_U = _scale_by_param(self.parameters['beta'], U, t, self.dtype)
+            if issparse(beta_U):
+                # alpha is non-zero for every cell, so V is structurally dense and returned as an array: subtract the
+                # stored entries of beta * U from the broadcast alpha
+                V = np.array(np.broadcast_to(alpha, U.shape), dtype=beta_U.dtype)
+                V[np.repeat(np.arange(V.shape[0]), np.diff(beta_U.indptr)), beta_U.indices] -= beta_U.data
             else:
-                beta = np.repeat(self.parameters['beta'], U.shape[1], axis=1)
-
-            V = csr_matrix(alpha) - (csr_matrix(beta).multiply(U)) if issparse(U) else \
-                    alpha - beta * U
+                V = (alpha - beta_U).astype(beta_U.dtype, copy=False)
         else:
             V = np.nan
         return V
@@ -659,30 +929,9 @@ class velocity:
         """
 
         t = self.parameters['t']
-        t_uniq, t_uniq_cnt = np.unique(self.parameters['t'], return_counts=True)
         if self.parameters['beta'] is not None and self.parameters['gamma'] is not None:
-            if len(self.parameters['beta'].shape) == 1:
-                beta = np.repeat(self.parameters['beta'].reshape((-1, 1)), U.shape[1], axis=1)
-            elif self.parameters['beta'].shape[1] == len(t_uniq) and len(t_uniq) > 1:
-                beta = np.zeros_like(U.shape)
-                for i in range(len(t_uniq)):
-                    cell_inds = t == t_uniq[i]
-                    beta[:, cell_inds] = np.repeat(self.parameters['beta'][:, i], t_uniq_cnt[i], axis=1)
-            else:
-                beta = np.repeat(self.parameters['beta'], U.shape[1], axis=1)
-
-            if len(self.parameters['gamma'].shape) == 1:
-                gamma = np.repeat(self.parameters['gamma'].reshape((-1, 1)), U.shape[1], axis=1)
-            elif self.parameters['gamma'].shape[1] == len(t_uniq) and len(t_uniq) > 1:
-                gamma = np.zeros_like(U.shape)
-                for i in range(len(t_uniq)):
-                    cell_inds = t == t_uniq[i]
-                    gamma[:, cell_inds] = np.repeat(self.parameters['gamma'][:, i], t_uniq_cnt[i], axis=1)
-            else:
-                gamma = np.repeat(self.parameters['gamma'], U.shape[1], axis=1)
-
-            V = csr_matrix(beta).multiply(U) - csr_matrix(gamma).multiply(S) if issparse(U) \
-                    else beta * U - gamma * S
+            V = _subtract(_scale_by_param(self.parameters['beta'], U, t, self.dtype),
+                          _scale_by_param(self.parameters['gamma'], S, t, self.dtype))
         else:
             V = np.nan
         return V
@@ -704,30 +953,9 @@ class velocity:
         """
 
         t = self.parameters['t']
-        t_uniq, t_uniq_cnt = np.unique(self.parameters['t'], return_counts=True)
         if self.parameters['eta'] is not None and self.parameters['delta'] is not None:
-            if len(self.parameters['eta'].shape) == 1:
-                eta = np.repeat(self.parameters['eta'].reshape((-1, 1)), S.shape[1], axis=1)
-            elif self.parameters['eta'].shape[1] == len(t_uniq) and len(t_uniq) > 1:
-                eta = np.zeros_like(S.shape)
-                for i in range(len(t_uniq)):
-                    cell_inds = t == t_uniq[i]
-                    eta[:, cell_inds] = np.repeat(self.parameters['eta'][:, i], t_uniq_cnt[i], axis=1)
-            else:
-                eta = np.repeat(self.parameters['eta'], S.shape[1], axis=1)
-
-            if len(self.parameters['delta'].shape) == 1:
-                delta = np.repeat(self.parameters['delta'].reshape((-1, 1)), S.shape[1], axis=1)
-            elif self.parameters['delta'].shape[1] == len(t_uniq) and len(t_uniq) > 1:
-                delta = np.zeros_like(S.shape)
-                for i in range(len(t_uniq)):
-                    cell_inds = t == t_uniq[i]
-                    delta[:, cell_inds] = np.repeat(self.parameters['delta'][:, i], t_uniq_cnt[i], axis=1)
-            else:
-                delta = np.repeat(self.parameters['delta'], S.shape[1], axis=1)
-
-            V = csr_matrix(eta).multiply(S) - csr_matrix(delta).multiply(P) if issparse(P) else \
-                    eta * S - delta * P
+            V = _subtract(_scale_by_param(self.parameters['eta'], S, t, self.dtype),
+                          _scale_by_param(self.parameters['delta'], P, t, self.dtype))
         else:
             V = np.nan
         return V
@@ -839,7 +1067,7 @@ class estimation:
                           'delta_r2': None, "uu0": None, "ul0": None, "su0": None, "sl0": None, 'U0': None, 'S0': None, 'total0': None} # note that alpha_intercept also corresponds to u0 in fit_alpha_degradation, similar to fit_first_order_deg_lsq
         self.ind_for_proteins = ind_for_proteins
 
-    def fit(self, intercept=True, perc_left=5, perc_right=5, clusters=None):
+    def fit(self, intercept=True, perc_left=5, perc_right=5, clusters=None, n_jobs=1, backend='loky'):
         """Fit the input data to estimate all or a subset of the parameters
 
         Arguments
@@ -854,27 +1082,26 @@ class estimation:
             The percentage of samples included in the linear regression in the right tail. If set to None, then all the samples are included.
         clusters: `list`
             A list of n clusters, each element is a list of indices of the samples which belong to this cluster.
+        n_jobs: `int` (default: 1)
+            The number of parallel workers used for the gene-wise fits, see `gene_wise_fit`. -1 uses all cores.
+        backend: `str` (default: `loky`)
+            The joblib backend used when n_jobs is not 1, either `loky`, `multiprocessing` or `threading`.
         """
         n = self.get_n_genes()
+        par = {'n_jobs': n_jobs, 'backend': backend}
         # fit mRNA
         if self.asspt_mRNA == 'ss':
             if np.all(self._exist_data('uu', 'su')):
                 self.parameters['beta'] = np.ones(n)
-                gamma, gamma_intercept, gamma_r2 = np.zeros(n), np.zeros(n), np.zeros(n)
                 U = self.data['uu'] if self.data['ul'] is None else self.data['uu'] + self.data['ul']
                 S = self.data['su'] if self.data['sl'] is None else self.data['su'] + self.data['sl']
-                for i in range(n):
-                    gamma[i], gamma_intercept[i], gamma_r2[i] = self.fit_gamma_steady_state(U[i], S[i],
-                            intercept, perc_left, perc_right)
+                gamma, gamma_intercept, gamma_r2 = solve_gamma_steady_state(U, S, intercept, perc_left, perc_right)
                 self.parameters['gamma'], self.aux_param['gamma_intercept'], self.aux_param['gamma_r2'] = gamma, gamma_intercept, gamma_r2
             elif np.all(self._exist_data('uu', 'ul')):
                 self.parameters['beta'] = np.ones(n)
-                gamma, gamma_intercept, gamma_r2 = np.zeros(n), np.zeros(n), np.zeros(n)
                 U = self.data['ul']
                 S = self.data['uu'] + self.data['ul']
-                for i in range(n):
-                    gamma[i], gamma_intercept[i], gamma_r2[i] = self.fit_gamma_steady_state(U[i], S[i],
-                            intercept, perc_left, perc_right)
+                gamma, gamma_intercept, gamma_r2 = solve_gamma_steady_state(U, S, intercept, perc_left, perc_right)
                 self.parameters['gamma'], self.aux_param['gamma_intercept'], self.aux_param['gamma_r2'] = gamma, gamma_intercept, gamma_r2
         else:
             if self.extyp == 'deg':
@@ -883,25 +1110,25 @@ class estimation:
                     ul_m, ul_v, t_uniq = cal_12_mom(self.data['ul'], self.t)
                     sl_m, sl_v, _ = cal_12_mom(self.data['sl'], self.t)
                     self.parameters['beta'], self.parameters['gamma'], self.aux_param['ul0'], self.aux_param['sl0'] = \
-                        self.fit_beta_gamma_lsq(t_uniq, ul_m, sl_m)
+                        self.fit_beta_gamma_lsq(t_uniq, ul_m, sl_m, **par)
                     if self._exist_data('uu'):
                         # alpha estimation
                         uu_m, uu_v, _ = cal_12_mom(self.data['uu'], self.t)
-                        alpha, uu0, r2 = np.zeros((n, 1)), np.zeros(n), np.zeros(n)
-                        for i in range(n):
-                            alpha[i], uu0[i], r2[i] = fit_alpha_degradation(t_uniq, uu_m[i], self.parameters['beta'][i], intercept=True)
+                        res = gene_wise_fit(partial(fit_alpha_degradation, t_uniq), n, (uu_m, self.parameters['beta']),
+                                            kwargs={'intercept': True}, **par)
+                        alpha, uu0, r2 = np.array(res).T
+                        alpha = alpha[:, None]
                         self.parameters['alpha'], self.aux_param['alpha_intercept'], self.aux_param['uu0'], self.aux_param['alpha_r2'] = alpha, uu0, uu0, r2
                 elif self._exist_data('ul'):
                     # gamma estimation
                     # use mean + var for fitting degradation parameter k
                     ul_m, ul_v, t_uniq = cal_12_mom(self.data['ul'], self.t)
-                    self.parameters['gamma'], self.aux_param['ul0'] = self.fit_gamma_nosplicing_lsq(t_uniq, ul_m)
+                    self.parameters['gamma'], self.aux_param['ul0'] = self.fit_gamma_nosplicing_lsq(t_uniq, ul_m, **par)
                     if self._exist_data('uu'):
                         # alpha estimation
-                        alpha, alpha_b, alpha_r2 = np.zeros(n), np.zeros(n), np.zeros(n)
                         uu_m, uu_v, _ = cal_12_mom(self.data['uu'], self.t)
-                        for i in range(n):
-                            alpha[i], alpha_b[i], alpha_r2[i] = fit_alpha_degradation(t_uniq, uu_m[i], self.parameters['gamma'][i])
+                        res = gene_wise_fit(partial(fit_alpha_degradation, t_uniq), n, (uu_m, self.parameters['gamma']), **par)
+                        alpha, alpha_b, alpha_r2 = np.array(res).T
                         self.parameters['alpha'], self.aux_param['alpha_intercept'], self.aux_param['uu0'], self.aux_param['alpha_r2'] = alpha, alpha_b, alpha_b, alpha_r2
             elif (self.extyp == 'kin' or self.extyp == 'one_shot') and len(np.unique(self.t)) > 1:
                 if np.all(self._exist_data('ul', 'uu', 'su')):
@@ -910,28 +1137,25 @@ class estimation:
                         uu_m, uu_v, t_uniq = cal_12_mom(self.data['uu'], self.t)
                         su_m, su_v, _ = cal_12_mom(self.data['su'], self.t)
 
-                        self.parameters['beta'], self.parameters['gamma'], self.aux_param['uu0'], self.aux_param['su0'] = self.fit_beta_gamma_lsq(t_uniq, uu_m, su_m)
+                        self.parameters['beta'], self.parameters['gamma'], self.aux_param['uu0'], self.aux_param['su0'] = \
+                            self.fit_beta_gamma_lsq(t_uniq, uu_m, su_m, **par)
                     # alpha estimation
                     ul_m, ul_v, t_uniq = cal_12_mom(self.data['ul'], self.t)
                     alpha = np.zeros_like(self.data['ul'].A) if issparse(self.data['ul']) else np.zeros_like(self.data['ul'])
                     # assume constant alpha across all cells
-                    for i in range(n):
-                        # for j in range(len(self.data['ul'][i])):
-                        alpha[i, :] = fit_alpha_synthesis(t_uniq, ul_m[i], self.parameters['beta'][i])
+                    alpha[:] = np.array(gene_wise_fit(partial(fit_alpha_synthesis, t_uniq), n,
+                                                      (ul_m, self.parameters['beta']), **par))[:, None]
                     self.parameters['alpha'] = alpha
                 elif np.all(self._exist_data('ul', 'uu')):
                     n = self.data['uu'].shape[0]  # self.get_n_genes(data=U)
-                    u0, gamma = np.zeros(n), np.zeros(n)
                     uu_m, uu_v, t_uniq = cal_12_mom(self.data['uu'], self.t)
-                    for i in range(n):
-                        gamma[i], u0[i] = fit_first_order_deg_lsq(t_uniq, uu_m[i])
+                    gamma, u0 = np.array(gene_wise_fit(partial(fit_first_order_deg_lsq, t_uniq), n, (uu_m,), **par)).T
                     self.parameters['gamma'], self.aux_param['uu0'] = gamma, u0
                     alpha = np.zeros_like(self.data['ul'].A) if issparse(self.data['ul']) else np.zeros_like(self.data['ul'])
                     # assume constant alpha across all cells
                     ul_m, ul_v, _ = cal_12_mom(self.data['ul'], self.t)
-                    for i in range(n):
-                        # for j in range(len(self.data['ul'][i])):
-                        alpha[i, :] = fit_alpha_synthesis(t_uniq, ul_m[i], self.parameters['gamma'][i])
+                    alpha[:] = np.array(gene_wise_fit(partial(fit_alpha_synthesis, t_uniq), n,
+                                                      (ul_m, self.parameters['gamma']), **par))[:, None]
                     self.parameters['alpha'] = alpha
                     # alpha: one-shot
             # 'one_shot'
@@ -942,61 +1166,55 @@ class estimation:
                 # calculate when having splicing or no splicing
                 if np.all(self._exist_data('ul', 'uu', 'sl', 'su')):
                     if self._exist_data('ul') and self._exist_parameter('beta', 'gamma').all():
-                        self.parameters['alpha'] = self.fit_alpha_oneshot(self.t, self.data['ul'], self.parameters['beta'], clusters)
+                        self.parameters['alpha'] = self.fit_alpha_oneshot(self.t, self.data['ul'], self.parameters['beta'], clusters, **par)
                     else:
-                        beta, gamma, U0, S0 = np.zeros(n), np.zeros(n), np.zeros(n), np.zeros(n)
-                        for i in range(n): # can also use the two extreme time points and apply sci-fate like approach.
-                            S, U = self.data['su'][i] + self.data['sl'][i], self.data['uu'][i] + self.data['ul'][i]
-
-                            S0[i], gamma[i] = np.mean(S), solve_gamma(np.max(self.t), self.data['su'][i], S)
-                            U0[i], beta[i] = np.mean(U), solve_gamma(np.max(self.t), self.data['uu'][i], U)
+                        # can also use the two extreme time points and apply sci-fate like approach.
+                        S, U = self.data['su'] + self.data['sl'], self.data['uu'] + self.data['ul']
+                        S0, U0 = np.asarray(S.mean(1)).flatten(), np.asarray(U.mean(1)).flatten()
+                        gamma = np.array(gene_wise_fit(partial(solve_gamma, np.max(self.t)), n, (self.data['su'], S), **par))
+                        beta = np.array(gene_wise_fit(partial(solve_gamma, np.max(self.t)), n, (self.data['uu'], U), **par))
                         self.aux_param['U0'], self.aux_param['S0'], self.parameters['beta'], self.parameters['gamma'] = U0, S0, beta, gamma
 
-                        self.parameters['alpha'] = self.fit_alpha_oneshot(self.t, self.data['ul'], self.parameters['beta'], clusters)
+                        self.parameters['alpha'] = self.fit_alpha_oneshot(self.t, self.data['ul'], self.parameters['beta'], clusters, **par)
                 else:
                     if self._exist_data('ul') and self._exist_parameter('gamma'):
-                        self.parameters['alpha'] = self.fit_alpha_oneshot(self.t, self.data['ul'], self.parameters['gamma'], clusters)
+                        self.parameters['alpha'] = self.fit_alpha_oneshot(self.t, self.data['ul'], self.parameters['gamma'], clusters, **par)
                     elif self._exist_data('ul') and self._exist_data('uu'):
-                        gamma, total0 = np.zeros(n), np.zeros(n)
-                        for i in range(n):
-                            total = self.data['uu'][i] + self.data['ul'][i]
-                            total0[i], gamma[i] = np.mean(total), solve_gamma(np.max(self.t), self.data['uu'][i], total)
+                        total = self.data['uu'] + self.data['ul']
+                        total0 = np.asarray(total.mean(1)).flatten()
+                        gamma = np.array(gene_wise_fit(partial(solve_gamma, np.max(self.t)), n, (self.data['uu'], total), **par))
                         self.aux_param['total0'], self.parameters['gamma'] = total0, gamma
 
-                        self.parameters['alpha'] = self.fit_alpha_oneshot(self.t, self.data['ul'], self.parameters['gamma'], clusters)
+                        self.parameters['alpha'] = self.fit_alpha_oneshot(self.t, self.data['ul'], self.parameters['gamma'], clusters, **par)
 
             elif self.extyp == 'mix_std_stm':
                 t_min, t_max = np.min(self.t), np.max(self.t)
                 if np.all(self._exist_data('ul', 'uu', 'su')):
-                    gamma, beta, total, U = np.zeros(n), np.zeros(n), np.zeros(n), np.zeros(n)
-                    for i in range(n): # can also use the two extreme time points and apply sci-fate like approach.
-                        tmp = self.data['uu'][i, self.t == t_max] + self.data['ul'][i, self.t == t_max] + self.data['su'][i, self.t == t_max] + self.data['sl'][i, self.t == t_max]
-                        total[i] = np.mean(tmp)
-                        gamma[i] = solve_gamma(t_max, self.data['uu'][i, self.t == t_max] + self.data['su'][i, self.t ==t_max], tmp)
-                        # same for beta
-                        tmp = self.data['uu'][i, self.t == t_max] + self.data['ul'][i, self.t == t_max]
-                        U[i] = np.mean(tmp)
-                        beta[i] = solve_gamma(np.max(self.t), self.data['uu'][i, self.t == t_max], tmp)
+                    # can also use the two extreme time points and apply sci-fate like approach.
+                    uu, ul, su, sl = [self.data[k][:, self.t == t_max] for k in ['uu', 'ul', 'su', 'sl']]
+                    tmp = uu + ul + su + sl
+                    total = np.asarray(tmp.mean(1)).flatten()
+                    gamma = np.array(gene_wise_fit(partial(solve_gamma, t_max), n, (uu + su, tmp), **par))
+                    # same for beta
+                    tmp = uu + ul
+                    U = np.asarray(tmp.mean(1)).flatten()
+                    beta = np.array(gene_wise_fit(partial(solve_gamma, np.max(self.t)), n, (uu, tmp), **par))
 
                     self.parameters['beta'], self.parameters['gamma'], self.aux_param['total0'], self.aux_param['U0'] = beta, gamma, total, U
                     # alpha estimation
-                    self.parameters['alpha'] = self.solve_alpha_mix_std_stm(self.t, self.data['ul'], self.parameters['beta'])
+                    self.parameters['alpha'] = self.solve_alpha_mix_std_stm(self.t, self.data['ul'], self.parameters['beta'], **par)
                 elif np.all(self._exist_data('ul', 'uu')):
                     n = self.data['uu'].shape[0]  # self.get_n_genes(data=U)
-                    gamma, U = np.zeros(n), np.zeros(n)
-                    for i in range(n): # apply sci-fate like approach (can also use one-single time point to estimate gamma)
-                        # tmp = self.data['uu'][i, self.t == 0] + self.data['ul'][i, self.t == 0]
-                        tmp_ = self.data['uu'][i, self.t == t_max] + self.data['ul'][i, self.t == t_max]
-
-                        U[i] = np.mean(tmp_)
-                        # gamma_1 = solve_gamma(np.max(self.t), self.data['uu'][i, self.t == 0], tmp) # steady state
-                        gamma_2 = solve_gamma(t_max, self.data['uu'][i, self.t == t_max], tmp_) # stimulation
-                        # gamma_3 = solve_gamma(np.max(self.t), self.data['uu'][i, self.t == np.max(self.t)], tmp) # sci-fate
-                        gamma[i] = gamma_2
-                        # print('Steady state, stimulation, sci-fate like gamma values are ', gamma_1, '; ', gamma_2, '; ', gamma_3)
+                    # apply sci-fate like approach (can also use one-single time point to estimate gamma)
+                    uu, ul = self.data['uu'][:, self.t == t_max], self.data['ul'][:, self.t == t_max]
+                    tmp_ = uu + ul
+                    U = np.asarray(tmp_.mean(1)).flatten()
+                    # gamma_1 = solve_gamma(np.max(self.t), self.data['uu'][i, self.t == 0], tmp) # steady state
+                    # gamma_3 = solve_gamma(np.max(self.t), self.data['uu'][i, self.t == np.max(self.t)], tmp) # sci-fate
+                    gamma = np.array(gene_wise_fit(partial(solve_gamma, t_max), n, (uu, tmp_), **par)) # stimulation
                     self.parameters['gamma'], self.aux_param['U0'], self.parameters['beta'] = gamma, U, np.ones(gamma.shape)
                     # alpha estimation
-                    self.parameters['alpha'] = self.solve_alpha_mix_std_stm(self.t, self.data['ul'], self.parameters['gamma'])
+                    self.parameters['alpha'] = self.solve_alpha_mix_std_stm(self.t, self.data['ul'], self.parameters['gamma'], **par)
 
         # fit protein
         if np.all(self._exist_data('p', 'su')):
@@ -1005,17 +1223,15 @@ class estimation:
 
             if self.asspt_prot == 'ss' and n > 0:
                 self.parameters['eta'] = np.ones(n)
-                delta, delta_intercept, delta_r2 = np.zeros(n), np.zeros(n), np.zeros(n)
 
                 s = self.data['su'][ind_for_proteins] + self.data['sl'][ind_for_proteins] \
                     if self._exist_data('sl') else self.data['su'][ind_for_proteins]
 
-                for i in range(n):
-                    delta[i], delta_intercept[i], delta_r2[i] = self.fit_gamma_steady_state(s[i], self.data['p'][i],
-                            intercept, perc_left, perc_right)
+                delta, delta_intercept, delta_r2 = solve_gamma_steady_state(s, self.data['p'], intercept, perc_left, perc_right)
                 self.parameters['delta'], self.aux_param['delta_intercept'], self.aux_param['delta_r2'] = delta, delta_intercept, delta_r2
 
-    def fit_gamma_steady_state(self, u, s, intercept=True, perc_left=5, perc_right=5, normalize=True):
+    @staticmethod
+    def fit_gamma_steady_state(u, s, intercept=True, perc_left=5, perc_right=5, normalize=True):
         """Estimate gamma using linear regression based on the steady state assumption.
 
         Arguments
@@ -1049,8 +1265,8 @@ class estimation:
 
         n = len(u)
 
-        i_left = np.int(perc_left/100.0*n) if perc_left is not None else n
-        i_right = np.int((100-perc_right)/100.0*n) if perc_right is not None else 0
+        i_left = int(perc_left/100.0*n) if perc_left is not None else n
+        i_right = int((100-perc_right)/100.0*n) if perc_right is not None else 0
 
         mask = np.zeros(n, dtype=bool)
         mask[:i_left] = mask[i_right:] = True
@@ -1061,11 +1277,12 @@ class estimation:
         else:
             su = s + u
 
-        extreme_ind = np.argsort(su)[mask]
+        # order the cells by (su, cell index) so that ties at the tail boundaries are broken deterministically
+        extreme_ind = np.argsort(su, kind='stable')[mask]
 
         return fit_linreg(s[extreme_ind], u[extreme_ind], intercept)
 
-    def fit_beta_gamma_lsq(self, t, U, S):
+    def fit_beta_gamma_lsq(self, t, U, S, n_jobs=1, backend='loky'):
         """Estimate beta and gamma with the degradation data using the least squares method.
 
         Arguments
@@ -1076,6 +1293,10 @@ class estimation:
             A matrix of unspliced mRNA counts. Dimension: genes x cells.
         S: :class:`~numpy.ndarray`
             A matrix of spliced mRNA counts. Dimension: genes x cells.
+        n_jobs: `int` (default: 1)
+            The number of parallel workers, see `gene_wise_fit`.
+        backend: `str` (default: `loky`)
+            The joblib backend used when n_jobs is not 1.
 
         Returns
         -------
@@ -1089,19 +1310,11 @@ class estimation:
             Initial value of s.
         """
         n = U.shape[0] # self.get_n_genes(data=U)
-        beta = np.zeros(n)
-        gamma = np.zeros(n)
-        u0, s0 = np.zeros(n), np.zeros(n)
-
-        for i in range(n):
-            beta[i], u0[i] = fit_first_order_deg_lsq(t, U[i])
-            if np.isfinite(u0[i]):
-                gamma[i], s0[i] = fit_gamma_lsq(t, S[i], beta[i], u0[i])
-            else:
-                gamma[i], s0[i] = np.nan, np.nan
+        res = gene_wise_fit(_fit_beta_gamma_lsq_gene, n, (U, S), (t,), n_jobs=n_jobs, backend=backend)
+        beta, gamma, u0, s0 = np.array(res, dtype=float).T
         return beta, gamma, u0, s0
 
-    def fit_gamma_nosplicing_lsq(self, t, L):
+    def fit_gamma_nosplicing_lsq(self, t, L, n_jobs=1, backend='loky'):
         """Estimate gamma with the degradation data using the least squares method when there is no splicing data.
 
         Arguments
@@ -1110,6 +1323,10 @@ class estimation:
             A vector of time points.
         L: :class:`~numpy.ndarray`
             A matrix of labeled mRNA counts. Dimension: genes x cells.
+        n_jobs: `int` (default: 1)
+            The number of parallel workers, see `gene_wise_fit`.
+        backend: `str` (default: `loky`)
+            The joblib backend used when n_jobs is not 1.
 
         Returns
         -------
@@ -1119,14 +1336,11 @@ class estimation:
             The estimated value for the initial spliced, labeled mRNA count.
         """
         n = L.shape[0] # self.get_n_genes(data=L)
-        gamma = np.zeros(n)
-        l0 = np.zeros(n)
-
-        for i in range(n):
-            gamma[i], l0[i] = fit_first_order_deg_lsq(t, L[i].A[0]) if issparse(L) else fit_first_order_deg_lsq(t, L[i])
+        res = gene_wise_fit(_fit_gamma_nosplicing_lsq_gene, n, (L,), (t,), n_jobs=n_jobs, backend=backend)
+        gamma, l0 = np.array(res, dtype=float).T
         return gamma, l0
 
-    def solve_alpha_mix_std_stm(self, t, ul, beta, clusters=None, alpha_time_dependent=True):
+    def solve_alpha_mix_std_stm(self, t, ul, beta, clusters=None, alpha_time_dependent=True, n_jobs=1, backend='loky'):
         """Estimate the steady state transcription rate and analytically calculate the stimulation transcription rate
         given beta and steady state alpha for a mixed steady state and stimulation labeling experiment. 
         
@@ -1144,6 +1358,10 @@ class estimation:
             A list of n clusters, each element is a list of indices of the samples which belong to this cluster.
         alpha_time_dependent: `bool`
             Whether or not to model the simulation alpha rate as a time dependent variable.
+        n_jobs: `int` (default: 1)
+            The number of parallel workers, see `gene_wise_fit`.
+        backend: `str` (default: `loky`)
+            The joblib backend used when n_jobs is not 1.
 
         Returns
         -------
@@ -1156,19 +1374,19 @@ class estimation:
         t = np.array(t) if type(t) is list else t
         t_std, t_stm, t_uniq, t_max, t_min = np.max(t) - t, t, np.unique(t), np.max(t), np.min(t)
 
-        alpha_std_ini = self.fit_alpha_oneshot(np.array([t_max]), np.mean(ul[:, t == t_min], 1), beta, clusters).flatten()
+        alpha_std_ini = self.fit_alpha_oneshot(np.array([t_max]), np.mean(ul[:, t == t_min], 1), beta, clusters,
+                                               n_jobs=n_jobs, backend=backend).flatten()
         alpha_std, alpha_stm = alpha_std_ini, np.zeros((ul.shape[0], len(t_uniq)))
         alpha_stm[:, 0] = alpha_std_ini # 0 stimulation point is the steady state transcription
-        for i in range(ul.shape[0]):
-            l = ul[i].A.flatten() if issparse(ul) else ul[i]
-            for t_ind in np.arange(1, len(t_uniq)):
-                alpha_stm[i, t_ind] = solve_alpha_2p(t_max - t_uniq[t_ind], t_uniq[t_ind], alpha_std[i], beta[i], l[t==t_uniq[t_ind]])
+        if len(t_uniq) > 1:
+            alpha_stm[:, 1:] = gene_wise_fit(_solve_alpha_mix_std_stm_gene, ul.shape[0], (ul, alpha_std, beta),
+                                             (t, t_uniq, t_max), n_jobs=n_jobs, backend=backend)
         if not alpha_time_dependent:
             alpha_stm = alpha_stm.mean(1)
 
         return (alpha_std, alpha_stm)
 
-    def fit_alpha_oneshot(self, t, U, beta, clusters=None):
+    def fit_alpha_oneshot(self, t, U, beta, clusters=None, n_jobs=1, backend='loky'):
         """Estimate alpha with the one-shot data.
 
         Arguments
@@ -1181,6 +1399,10 @@ class estimation:
             A vector of betas for all the genes.
         clusters: list
             A list of n clusters, each element is a list of indices of the samples which belong to this cluster.
+        n_jobs: `int` (default: 1)
+            The number of parallel workers, see `gene_wise_fit`.
+        backend: `str` (default: `loky`)
+            The joblib backend used when n_jobs is not 1.
 
         Returns
         -------
@@ -1191,12 +1413,8 @@ class estimation:
         if clusters is None:
             clusters = [[i] for i in range(n_cells)]
         alpha = np.zeros((n_genes, len(clusters)))
-        for i, c in enumerate(clusters):
-            for j in range(n_genes):
-                if len(c) > 0:
-                    alpha[j, i] = fit_alpha_synthesis(t, U[j].A[0][c], beta[j]) if issparse(U) else fit_alpha_synthesis(t, U[j][c], beta[j])
-                else:
-                    alpha[j, i] = np.nan
+        if n_genes > 0:
+            alpha[:] = gene_wise_fit(_fit_alpha_oneshot_gene, n_genes, (U, beta), (t, clusters), n_jobs=n_jobs, backend=backend)
         return alpha
 
     def concatenate_data(self):
@@ -100,7 +100,8 @@ def jaccard(X, V, n_pca_components, n_neigh, X_neighbors):
     X_fit = transformer.fit(Xt)
     Xt_pca = X_fit.transform(Xt)[:, 1:]
 
-    V_neighbors, _, _, _ = umap_conn_indices_dist_embedding(Xt_pca, n_neighbors=n_neigh)
+    # the graph of the future states depends on the velocities, so it is built here rather than registered in adata
+    V_neighbors, _, _, _ = umap_conn_indices_dist_embedding(Xt_pca, n_neighbors=n_neigh, graph_only=True)
     X_neighbors_, V_neighbors_ = X_neighbors.dot(X_neighbors), V_neighbors.dot(V_neighbors)
     union_ = X_neighbors_ + V_neighbors_ > 0
     intersect_ = mnn_from_list([X_neighbors_, V_neighbors_]) > 0
@@ -116,7 +117,7 @@ def consensus(x, y):
     return consensus
 
 def curl(f,x):
-    jac = nd.Jacobian(f)(x)
+    jac = f.jacobian(x) if hasattr(f, 'jacobian') else nd.Jacobian(f)(x)
     return sp.array([jac[1,0]-jac[0,1]]) # 2D curl
 
 
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from dynamo.tools.cell_velocities import _pca_project
+
+
+@pytest.mark.parametrize('sparse', [True, False])
+def test_pca_project_chunked(sparse):
+    rng = np.random.default_rng(0)
+    L = rng.normal(size=(500, 5)) * [10, 8, 6, 4, 3]
+    X = np.maximum(L.dot(rng.normal(size=(5, 100))) + rng.normal(size=(500, 100)), 0)
+    V = rng.normal(size=(500, 100)) * (rng.random((500, 100)) < 0.1)
+    ref_X, ref_V = _pca_project(X, V, 5)
+
+    X_pca, V_pca = _pca_project(sp.csr_matrix(X) if sparse else X, sp.csr_matrix(V) if sparse else V, 5, chunk_size=64)
+    # the principal axes are only defined up to their signs
+    sign = np.sign((X_pca * ref_X).sum(0))
+    assert np.allclose(X_pca * sign, ref_X, atol=1e-6 * np.abs(ref_X).max())
+    assert np.allclose(V_pca * sign, ref_V, atol=1e-6 * np.abs(ref_V).max())
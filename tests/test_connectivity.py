@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from anndata import AnnData
+from dynamo.tools.neighbor_index import NeighborIndex, get_neighbor_index, clear_neighbor_index_cache
+from dynamo.tools.connectivity import get_neighbor_graph, umap_conn_indices_dist_embedding, smooth_layers
+
+
+def _brute_force_knn(X, Y, k):
+    """The k nearest neighbors of each query point found one point at a time."""
+    dists, indices = [], []
+    for y in Y:
+        d = np.sqrt(((X - y) ** 2).sum(1))
+        idx = np.argsort(d, kind='stable')[:k]
+        dists.append(d[idx])
+        indices.append(idx)
+    return np.array(dists), np.array(indices)
+
+
+@pytest.mark.parametrize('method', ['auto', 'exact', 'ball_tree', 'kd_tree'])
+def test_neighbor_index(method):
+    rng = np.random.default_rng(0)
+    X, Y = rng.normal(size=(300, 4)), rng.normal(size=(20, 4))
+    index = NeighborIndex(X, method=method)
+
+    dists, indices = index.query(Y, k=10)
+    ref_dists, ref_indices = _brute_force_knn(X, Y, 10)
+    assert np.allclose(dists, ref_dists) and np.array_equal(indices, ref_indices)
+
+    # self queries are cached and sliced for smaller k
+    dists, indices = index.query(k=15)
+    ref_dists, ref_indices = _brute_force_knn(X, X, 15)
+    assert np.allclose(dists, ref_dists) and np.array_equal(indices, ref_indices)
+    dists, indices = index.query(k=5)
+    assert np.array_equal(indices, ref_indices[:, :5])
+
+    # modifying the returned arrays leaves the cached self query intact
+    indices[:] = 0
+    assert np.array_equal(index.query(k=5)[1], ref_indices[:, :5])
+
+
+def test_get_neighbor_index():
+    clear_neighbor_index_cache()
+    X = np.random.default_rng(0).normal(size=(100, 3))
+
+    index = get_neighbor_index(X)
+    assert get_neighbor_index(X.copy()) is index
+    assert get_neighbor_index(X, method='exact') is not index
+    assert get_neighbor_index(X, n_jobs=1) is not index
+    X[0] += 1
+    assert get_neighbor_index(X) is not index
+    clear_neighbor_index_cache()
+
+
+def test_get_neighbor_graph():
+    pytest.importorskip('umap')
+    X = np.random.default_rng(0).normal(size=(200, 5))
+    adata = AnnData(np.zeros((200, 2)), obsm={'X_pca': X})
+    adata.uns['neighbors'] = {'params': {'n_neighbors': 15, 'method': 'trimap'}, 'connectivities': None,
+                              'distances': None, 'indices': None}
+
+    graph, knn_indices, knn_dists, _ = umap_conn_indices_dist_embedding(X, n_neighbors=15, graph_only=True)
+    neighbor_graph = get_neighbor_graph(adata, 'X_pca', n_neighbors=15)
+    assert (neighbor_graph['connectivities'] != graph).nnz == 0
+    assert np.array_equal(neighbor_graph['indices'], knn_indices)
+    assert np.allclose(neighbor_graph['distances'], knn_dists)
+    # the incomplete `neighbors` entry is replaced by the rebuilt graph
+    assert sp.issparse(adata.uns['neighbors']['connectivities'])
+
+    assert get_neighbor_graph(adata, 'X_pca', n_neighbors=15) is adata.uns['neighbor_graphs']['X_pca_euclidean_15']
+    adata.obsm['X_pca'] = X + 1e-3
+    assert get_neighbor_graph(adata, 'X_pca', n_neighbors=15)['params']['data_hash'] != \
+        neighbor_graph['params']['data_hash']
+
+
+def test_get_neighbor_graph_adopts_valid_neighbors():
+    X = np.random.default_rng(0).normal(size=(50, 3))
+    adata = AnnData(np.zeros((50, 2)), obsm={'X_pca': X})
+    dists, indices = _brute_force_knn(X, X, 20)
+    graph = sp.csr_matrix((np.ones(50 * 20), indices.flatten(), np.arange(0, 50 * 20 + 1, 20)), shape=(50, 50))
+    adata.uns['neighbors'] = {'params': {'n_neighbors': 10}, 'connectivities': graph, 'distances': dists,
+                              'indices': indices}
+
+    neighbor_graph = get_neighbor_graph(adata, 'X_pca', n_neighbors=10)
+    assert neighbor_graph['params']['source'] == 'neighbors'
+    assert np.array_equal(neighbor_graph['indices'], indices[:, :10])
+
+
+@pytest.mark.parametrize('output', ['auto', 'dense', 'sparse'])
+def test_smooth_layers(output):
+    rng = np.random.default_rng(0)
+    kNN = sp.random(100, 100, density=0.1, format='csr', random_state=0) + sp.identity(100, format='csr')
+    kNN = sp.csr_matrix(kNN.multiply(1 / kNN.sum(1)))
+    dense, sparse = rng.random((100, 8)), sp.random(100, 8, density=0.3, format='csr', random_state=1)
+    layers = {'dense': dense, 'sparse': sparse}
+    sparse_data = sparse.data.copy()
+
+    smoothed = smooth_layers(kNN, layers, chunk_size=30, output=output)
+    for key, X in layers.items():
+        ref = kNN.dot(X.toarray() if sp.issparse(X) else X)
+        res = smoothed[key]
+        assert sp.issparse(res) == (output == 'sparse' or (output == 'auto' and key == 'sparse'))
+        assert np.allclose(res.toarray() if sp.issparse(res) else res, ref, atol=1e-5)
+    assert np.array_equal(sparse.data, sparse_data)
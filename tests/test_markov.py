@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from scipy.linalg import eig
+from dynamo.tools.Markov import compute_markov_trans_prob, compute_markov_trans_prob_batch, \
+    stationary_distribution_sparse, DiscreteTimeMarkovChain, KernelMarkovChain, sample_neighbor_indices, \
+    iterative_neighbor_indices_csr
+
+
+def _qp_objective(X, V, idx, i, p, s=None):
+    """The objective of the per-cell quadratic program of compute_markov_trans_prob."""
+    R = X[idx] - X[i]
+    scale = np.abs(R.max(0) - R.min(0))
+    A, b = R / scale, V[i] / scale
+    if s is not None:
+        A, b = np.hstack((A, 0.5 * A * A)), np.hstack((b, 0.5 * (s / scale) ** 2))
+    return 0.5 * p @ A @ A.T @ p - b @ A.T @ p
+
+
+def _random_chain(n=80, seed=0):
+    rng = np.random.default_rng(seed)
+    M = rng.random((n, n)) * (rng.random((n, n)) < 0.1) + np.eye(n)
+    return M / M.sum(1)[:, None]
+
+
+@pytest.mark.parametrize('s, cont_time', [(None, False), (np.array([0.1, 0.2]), False), (None, True)])
+def test_compute_markov_trans_prob_batch(s, cont_time):
+    pytest.importorskip('cvxopt')
+    from cvxopt import solvers
+    solvers.options['show_progress'] = False
+
+    rng = np.random.default_rng(0)
+    X, V = rng.normal(size=(40, 2)), rng.normal(size=(40, 2)) * 0.3
+    Idx = np.argsort(((X[:, None] - X[None]) ** 2).sum(2), 1)[:, 1:9]
+
+    P = compute_markov_trans_prob_batch(X, V, Idx, s, cont_time=cont_time)
+    assert P.shape == Idx.shape and P.min() >= 0
+    if not cont_time:
+        assert P.sum(1).max() <= 1 + 1e-10
+
+    # the quadratic programs may have several minimizers, so the objectives are compared
+    for i in range(X.shape[0]):
+        p = compute_markov_trans_prob(X[i], V[i], X[Idx[i]], s, cont_time=cont_time)
+        assert _qp_objective(X, V, Idx[i], i, P[i], s) <= _qp_objective(X, V, Idx[i], i, p, s) + 1e-6
+
+
+@pytest.mark.parametrize('method', ['eigs', 'power', 'solve'])
+def test_stationary_distribution_sparse(method):
+    M = _random_chain()
+    D, U = eig(M.T)
+    p_ref = np.real(U[:, np.argmax(np.real(D))])
+    p_ref /= p_ref.sum()
+
+    for M_ in [M, sp.csr_matrix(M)]:
+        p = stationary_distribution_sparse(M_, method=method)
+        assert np.allclose(p, p_ref, atol=1e-8)
+
+
+def test_discrete_time_markov_chain_sparse_distribution():
+    P = _random_chain().T # column stochastic
+    p0 = np.ones(P.shape[0]) / P.shape[0]
+    dense, sparse = DiscreteTimeMarkovChain(P=P), DiscreteTimeMarkovChain(P=sp.csc_matrix(P))
+
+    p = p0
+    for _ in range(5):
+        p = P @ p
+    assert np.allclose(dense.solve_distribution(p0, 5, method='eig'), p)
+    assert np.allclose(sparse.solve_distribution(p0, 5), p)
+    with pytest.raises(Exception):
+        sparse.solve_distribution(p0, 5, method='eig')
+
+
+@pytest.mark.parametrize('num_prop', [1, 3])
+@pytest.mark.parametrize('normalize_vector', [False, True])
+def test_kernel_markov_chain_density_corrected_drift(num_prop, normalize_vector):
+    rng = np.random.default_rng(0)
+    X, V = rng.normal(size=(60, 2)), rng.normal(size=(60, 2)) * 0.3
+    Idx = np.argsort(((X[:, None] - X[None]) ** 2).sum(2), 1)[:, :10]
+    kmc = KernelMarkovChain()
+    kmc.fit(X, V, M_diff=1, neighbor_idx=Idx)
+
+    P_t = np.linalg.matrix_power(kmc.P.A, num_prop)
+    ref = np.zeros_like(X)
+    for i in range(X.shape[0]):
+        D = X[Idx[i]] - X[i]
+        # one step stays within the neighbors, while several steps reach every state
+        drift = D.T.dot(P_t[Idx[i], i]) if num_prop == 1 else (X - X[i]).T.dot(P_t[:, i])
+        ref[i] = drift - P_t[:, i].sum() / len(Idx[i]) * D.sum(0)
+        if normalize_vector:
+            ref[i] /= np.linalg.norm(D, 1)
+
+    res = kmc.compute_density_corrected_drift(X, num_prop=num_prop, normalize_vector=normalize_vector, chunk_size=7)
+    assert np.allclose(res, ref)
+
+
+def test_markov_chain_sparse_eigsys():
+    P = _random_chain(seed=1).T
+    dense, sparse = DiscreteTimeMarkovChain(P=P), DiscreteTimeMarkovChain(P=sp.csc_matrix(P))
+    dense.eigsys()
+    sparse.eigsys(k=6)
+
+    assert np.allclose(sparse.D, dense.D[:6])
+    for i in range(6):
+        # every left and right eigenvector belongs to the eigenvalue in the same position
+        assert np.allclose(P.dot(sparse.W[:, i]), sparse.D[i] * sparse.W[:, i])
+        assert np.allclose(sparse.U[:, i].conj().dot(P), sparse.D[i] * sparse.U[:, i].conj())
+    with pytest.raises(Exception):
+        sparse.eigsys()
+
+
+def test_kernel_markov_chain_sample_fraction():
+    rng = np.random.default_rng(0)
+    X, V = rng.normal(size=(60, 2)), rng.normal(size=(60, 2)) * 0.3
+    Idx = np.argsort(((X[:, None] - X[None]) ** 2).sum(2), 1)[:, :10]
+    indptr, nbrs = iterative_neighbor_indices_csr(Idx, 2)
+    recursive = sp.csr_matrix((np.ones(len(nbrs), dtype=bool), nbrs, indptr), shape=(60, 60))
+
+    np.random.seed(0)
+    sampled = sample_neighbor_indices(Idx, 0.5)
+    assert sampled.shape == (60, 5)
+    for i in range(60):
+        # a subset of the neighbors in their original order, without the cell itself
+        pos = [list(Idx[i]).index(j) for j in sampled[i]]
+        assert i not in sampled[i] and pos == sorted(pos)
+
+    sampled = sp.csr_matrix(sample_neighbor_indices(recursive, 0.5))
+    for i in range(60):
+        kept = sampled[i].indices
+        assert i not in kept and len(kept) == min(int(0.5 * (recursive[i].nnz + 1)), recursive[i].nnz - 1)
+        assert set(kept) <= set(recursive[i].indices)
+
+    kmc = KernelMarkovChain()
+    kmc.fit(X, V, M_diff=1, neighbor_idx=Idx, n_recurse_neighbors=2, sample_fraction=0.5)
+    assert np.allclose(kmc.P.sum(0), 1)
+    assert (kmc.P.T.astype(bool) > sp.csr_matrix(kmc.Idx)).nnz == 0
+
+
+def test_stationary_distribution_sparse_power_not_converged():
+    # two weakly coupled blocks mix slowly
+    M = sp.block_diag([_random_chain(20, 0), _random_chain(20, 1)]).tolil()
+    M[0, 20] = M[20, 0] = 1e-6
+    M = sp.csr_matrix(M.multiply(1 / M.sum(1)))
+    with pytest.warns(UserWarning):
+        stationary_distribution_sparse(M, method='power', max_iter=50)
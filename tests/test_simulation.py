@@ -0,0 +1,50 @@
+import numpy as np
+from numba import njit
+from dynamo.simulation.gillespie_utils import directMethod, directMethod_batch
+
+
+@njit
+def _prop_birth_death(C, params):
+    return np.array([params[0], params[1] * C[0]])
+
+
+STOICH = np.array([[1.], [-1.]])
+PARAMS = np.array([5., 0.5])
+
+
+def _state_at(T, C, t):
+    """The (piecewise constant) state of a recorded trajectory at the time points t."""
+    return C[:, np.searchsorted(T, t, side='right') - 1]
+
+
+def test_directMethod_batch_matches_loop():
+    n_traj, tspan, t_eval = 400, [0, 4], np.array([1., 2., 4.])
+
+    np.random.seed(0)
+    ref = np.array([_state_at(*directMethod(lambda c: np.array([PARAMS[0], PARAMS[1] * c[0]]),
+                                            lambda c, mu: c + STOICH[mu], tspan, np.zeros(1)), t_eval)
+                    for _ in range(n_traj)])
+    _, res = directMethod_batch(_prop_birth_death, STOICH, tspan, np.zeros(1), PARAMS, n_traj=n_traj, t_eval=t_eval,
+                                seed=0)
+
+    # both sample the same Poisson distributions, whose mean is k / g * (1 - exp(-g t))
+    mean = PARAMS[0] / PARAMS[1] * (1 - np.exp(-PARAMS[1] * t_eval))
+    for C in [ref, res]:
+        assert np.all(np.abs(C.mean(0)[0] - mean) < 5 * np.sqrt(mean / n_traj))
+        assert np.all(np.abs(C.var(0)[0] - mean) < 0.3 * mean)
+
+
+def test_directMethod_batch_recorded_events():
+    C0 = np.array([[0.], [3.], [10.]])
+    trajs_T, trajs_C = directMethod_batch(_prop_birth_death, STOICH, [0, 4], C0, PARAMS, seed=1)
+    t_eval, C_eval = directMethod_batch(_prop_birth_death, STOICH, [0, 4], C0, PARAMS, t_eval=np.linspace(0, 4, 9),
+                                        seed=1)
+
+    for i, (T, C) in enumerate(zip(trajs_T, trajs_C)):
+        assert T[0] == 0 and T[-2] <= 4 < T[-1] and np.all(np.diff(T) > 0)
+        assert np.array_equal(C[:, 0], C0[i]) and set(np.abs(np.diff(C[0]))) == {1}
+        # the same random streams give the same trajectories whether all events or only the grid are recorded
+        assert np.array_equal(_state_at(T, C, t_eval), C_eval[i])
+
+    trajs_T_again, _ = directMethod_batch(_prop_birth_death, STOICH, [0, 4], C0, PARAMS, seed=1)
+    assert all(np.array_equal(a, b) for a, b in zip(trajs_T, trajs_T_again))
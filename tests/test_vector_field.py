@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from scipy.integrate import odeint
+from dynamo.tools.scVectorField import SparseVFC, KernelVectorField, LazyGridVelocity, get_grid_velocity, \
+    vector_field_function
+from dynamo.tools.fate import integrate_vf
+
+
+def _vector_field(dim=2, n_ctrl=30, seed=0):
+    """A synthetic vector field in the format returned by SparseVFC."""
+    rng = np.random.default_rng(seed)
+    return {'X': rng.normal(size=(n_ctrl, dim)), 'C': rng.normal(size=(n_ctrl, dim)), 'beta': 0.5}
+
+
+def test_integrate_vf():
+    A = np.array([[-0.5, 1.], [-1., -0.5]])
+    V_func = lambda x, t=None: np.asarray(x).dot(A.T)
+    init_states = np.random.default_rng(0).normal(size=(5, 2))
+
+    for t in [np.linspace(0, 3, 50), -np.linspace(0, 3, 50)]:
+        Y = integrate_vf(init_states, t, V_func, rtol=1e-8, atol=1e-10)
+        ref = np.vstack([odeint(V_func, x0, t, rtol=1e-10, atol=1e-12) for x0 in init_states])
+        assert np.allclose(Y, ref, atol=1e-6)
+
+
+@pytest.mark.parametrize('dim', [2, 3])
+def test_kernel_vector_field_jacobian(dim):
+    VecFld = _vector_field(dim)
+    vf = KernelVectorField(VecFld)
+    X = np.random.default_rng(1).normal(size=(20, dim))
+
+    assert np.allclose(vf.evaluate(X), np.vstack([vector_field_function(x, None, VecFld) for x in X]))
+
+    J, eps = vf.jacobian(X), 1e-6
+    for x, J_x in zip(X, J):
+        J_ref = np.array([(vector_field_function(x + eps * e, None, VecFld) -
+                           vector_field_function(x - eps * e, None, VecFld)) / (2 * eps) for e in np.eye(dim)]).T
+        assert np.allclose(J_x, J_ref, atol=1e-6)
+    assert np.allclose(vf.jacobian(X[0]), J[0])
+    assert np.allclose(vf.divergence(X), np.trace(J, axis1=1, axis2=2))
+
+
+@pytest.mark.parametrize('dim, grid_num', [(1, 20), (2, 25), (3, 9)])
+def test_lazy_grid_velocity(dim, grid_num):
+    VecFld = _vector_field(dim)
+    vf = KernelVectorField(VecFld)
+    domain = np.array([[-2., 2.]] * dim)
+    lazy_grid = LazyGridVelocity(VecFld, domain, grid_num, tile_size=4)
+
+    Grid, V = lazy_grid.get()
+    ref_grid = np.array([i.flatten() for i in np.meshgrid(*[np.linspace(-2, 2, grid_num)] * dim)]).T
+    assert np.allclose(Grid, ref_grid)
+    assert np.allclose(V, vf.evaluate(ref_grid))
+
+    region = np.array([[-1., 0.5]] * dim)
+    Grid, V = lazy_grid.get(region)
+    inside = np.all((ref_grid >= -1 - 1e-12) & (ref_grid <= 0.5 + 1e-12), 1)
+    assert np.allclose(np.sort(Grid, 0), np.sort(ref_grid[inside], 0))
+    assert np.allclose(V, vf.evaluate(Grid))
+
+
+def test_get_grid_velocity():
+    VecFld = _vector_field(2)
+    VecFld.update({'grid_domain': np.array([[-2., 2.], [-1., 1.]]), 'grid_num': np.array([10, 10])})
+
+    Grid, V = get_grid_velocity(VecFld)
+    assert Grid.shape == (100, 2)
+    assert np.allclose(V, KernelVectorField(VecFld).evaluate(Grid))
+    Grid, V = get_grid_velocity(VecFld, grid_num=5)
+    assert Grid.shape == (25, 2)
+
+    with pytest.raises(Exception):
+        get_grid_velocity(_vector_field(2))
+
+
+def test_sparse_vfc_batch():
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(300, 2))
+    Y = X.dot(np.array([[-0.5, 1.], [-1., -0.5]]).T) + rng.normal(size=(300, 2)) * 0.05
+    Y[:10] = rng.normal(size=(10, 2)) * 100 # outliers whose likelihoods underflow
+
+    ref = SparseVFC(X, Y.copy(), None, M=20, beta=1, MaxIter=10)
+    for batch_size in [7, 64]:
+        res = SparseVFC(X, Y.copy(), None, M=20, beta=1, MaxIter=10, batch_size=batch_size)
+        assert np.allclose(res['C'], ref['C'], atol=1e-6) and np.allclose(res['P'], ref['P'], atol=1e-6)
+
+    with pytest.raises(Exception):
+        SparseVFC(X, Y.copy(), None, M=30, div_cur_free_kernels=True, batch_size=64)
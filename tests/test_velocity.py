@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from functools import partial
+from dynamo.tools.velocity import solve_gamma_steady_state, gene_wise_fit, fit_first_order_deg_lsq, estimation, velocity
+
+
+def _counts(n_genes=30, n_cells=400, density=0.3, seed=0):
+    """Integer (u, s) counts, which have many ties at the tail boundaries."""
+    rng = np.random.default_rng(seed)
+    U = np.round(rng.random((n_genes, n_cells)) * 4) * (rng.random((n_genes, n_cells)) < density)
+    S = np.round(rng.random((n_genes, n_cells)) * 6) * (rng.random((n_genes, n_cells)) < density)
+    return U, S
+
+
+@pytest.mark.parametrize('density', [0.05, 0.5])
+@pytest.mark.parametrize('kwargs', [{}, {'intercept': False}, {'perc_left': None}, {'perc_left': 30, 'perc_right': 20},
+                                    {'normalize': False}])
+def test_solve_gamma_steady_state(density, kwargs):
+    U, S = _counts(density=density)
+    ref = np.array([estimation.fit_gamma_steady_state(U[i], S[i], **kwargs) for i in range(U.shape[0])]).T
+
+    for U_, S_ in [(U, S), (sp.csr_matrix(U), sp.csr_matrix(S))]:
+        res = np.array(solve_gamma_steady_state(U_, S_, chunk_size=7, **kwargs))
+        assert np.allclose(res, ref, rtol=1e-8, atol=1e-10, equal_nan=True)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_gene_wise_fit(n_jobs):
+    rng = np.random.default_rng(0)
+    t = np.repeat([0., 1, 2, 4], 20)
+    L = np.exp(-0.5 * t)[None, :] * rng.uniform(2, 5, (6, 1)) + rng.random((6, len(t))) * 0.1
+    ref = np.array([fit_first_order_deg_lsq(t, L[i]) for i in range(L.shape[0])])
+
+    for L_ in [L, sp.csr_matrix(L)]:
+        res = gene_wise_fit(partial(fit_first_order_deg_lsq, t), L.shape[0], (L_,), n_jobs=n_jobs)
+        assert np.allclose(np.array(res), ref)
+
+
+@pytest.mark.parametrize('n_time_points', [3, 12])
+def test_velocity_broadcast(n_time_points):
+    rng = np.random.default_rng(0)
+    U, S = _counts(n_genes=5, n_cells=12)
+    t = rng.permutation(np.arange(12) % n_time_points).astype(float)
+    t_inds = np.unique(t, return_inverse=True)[1]
+    alpha, beta, gamma = rng.random((5, n_time_points)), rng.random(5), rng.random((5, n_time_points))
+
+    # the parameters of each cell, repeated as the per-cell loops did
+    ref_u = alpha[:, t_inds] - beta[:, None] * U
+    ref_s = beta[:, None] * U - gamma[:, t_inds] * S
+
+    vel = velocity(alpha=alpha, beta=beta, gamma=gamma, t=t)
+    for U_, S_ in [(U, S), (sp.csr_matrix(U), sp.csr_matrix(S))]:
+        V_u, V_s = vel.vel_u(U_), vel.vel_s(U_, S_)
+        assert isinstance(V_u, np.ndarray) and np.allclose(V_u, ref_u)
+        assert np.allclose(V_s.A if sp.issparse(V_s) else V_s, ref_s)